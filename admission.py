@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Chengye
+"""
+
+import numpy as np
+
+# Admission result of a trade, index into rejectReasons
+ACCEPTED = 0
+UNKNOWN_SYMBOL = 1
+AGREE_TYPE_MISMATCH = 2
+BREACH_TOTAL_VEGA = 3
+BREACH_STOCK_VEGA = 4
+rejectReasons = ['Accepted',
+                 'tradeSymbol not appear in the past',
+                 'Agree type not match',
+                 'Breach total vega',
+                 'Breach stock vega']
+
+def vegaLimitKernel(thisVega, stockIds, reasons, totVega, stockVega, vegaLimit):
+    '''
+    Sequential vega limit checks of a batch of trades, in batch order.
+    Trades with a non-zero reason are skipped. Breaching trades get their
+    reason set, accepted trades are added to totVega and stockVega.
+
+    Parameters:
+    thisVega -- vega of each trade
+    stockIds -- stock position of each trade's underlying
+    reasons -- admission result of each trade, updated in place
+    totVega -- portfolio vega before the batch
+    stockVega -- vega of each stock before the batch, updated in place
+    vegaLimit -- vega limit on stock and portfolio
+
+    Returns:
+    totVega after the batch
+    '''
+    for i in range(len(thisVega)):
+        if reasons[i] != ACCEPTED:
+            continue
+        vega = thisVega[i]
+        stockId = stockIds[i]
+        if abs(totVega + vega) > vegaLimit:
+            reasons[i] = BREACH_TOTAL_VEGA
+            continue
+        if abs(stockVega[stockId] + vega) > vegaLimit:
+            reasons[i] = BREACH_STOCK_VEGA
+            continue
+        totVega += vega
+        stockVega[stockId] += vega
+    return totVega
+
+# numba kernel, compiled on first use, False if numba is not installed.
+# numba is only imported then, it takes longer to import than the backtest 
+# of a short date range
+compiledKernel = None
+
+def getCompiledKernel():
+    global compiledKernel
+    if compiledKernel is None:
+        try:
+            from numba import njit
+            compiledKernel = njit(cache=True, nogil=True)(vegaLimitKernel)
+        except ImportError:
+            compiledKernel = False
+    return compiledKernel
+
+def admitTrades(thisVega, stockIds, reasons, totVega, stockVega, vegaLimit):
+    '''
+    Run the vega limit checks of a batch of trades, with the same results
+    as checking the trades one by one.
+
+    If no running sum can reach the limit, i.e. the current vega plus the sum
+    of absolute trade vegas stays within the limit for the portfolio and for
+    every stock, all remaining trades are accepted with array operations.
+    Otherwise the sequential kernel is used, compiled with numba if installed.
+
+    Parameters:
+    thisVega -- array of vega of each trade
+    stockIds -- array of int, stock position of each trade's underlying
+    reasons -- array of int, admission result of each trade, trades already
+               rejected are skipped, updated in place
+    totVega -- portfolio vega before the batch
+    stockVega -- array of vega of each stock, updated in place
+    vegaLimit -- vega limit on stock and portfolio
+
+    Returns:
+    totVega after the batch
+    '''
+    candidate = reasons == ACCEPTED
+    vega = thisVega[candidate]
+    ids = stockIds[candidate]
+    absVega = np.abs(vega)
+    totalBound = abs(totVega) + absVega.sum()
+    stockBound = np.abs(stockVega) + np.bincount(ids, weights=absVega,
+                                                 minlength=len(stockVega))
+    # allow for rounding of the running sums
+    tolerance = 4 * (len(vega) + 1) * np.finfo(np.float64).eps
+    if totalBound * (1 + tolerance) <= vegaLimit and \
+            (stockBound * (1 + tolerance) <= vegaLimit).all():
+        # no trade can breach a limit, accept all, adding in order
+        np.add.at(stockVega, ids, vega)
+        return float(np.cumsum(np.r_[totVega, vega])[-1])
+    kernel = getCompiledKernel()
+    if kernel:
+        # fixed argument types, so the kernel is compiled only once
+        return kernel(thisVega.astype(np.float64), stockIds.astype(np.int64), 
+                              reasons, float(totVega), stockVega, float(vegaLimit))
+    # python kernel runs faster on lists than on numpy scalars
+    reasonList = reasons.tolist()
+    stockVegaList = stockVega.tolist()
+    totVega = vegaLimitKernel(thisVega.tolist(), stockIds.tolist(), reasonList,
+                              totVega, stockVegaList, vegaLimit)
+    reasons[:] = reasonList
+    stockVega[:] = stockVegaList
+    return totVega
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Chengye
+"""
+
+import os
+import glob
+import logging
+import numpy as np
+import pandas as pd
+from positionBook import dayNumber
+
+class AttributionStore(object):
+    '''
+    Per contract, per day pnl attribution of a portfolio
+
+    Each end-of-day appends array blocks of rows (dateId, contractId,
+    optionPnl, stockPnl, tradePnl): one row per option position marked that
+    day, with its option and hedge (stock) pnl, and one row per accepted
+    trade, with its trade pnl. dateId is the day number of the date (see
+    positionBook.dayNumber) and contractId the id of the option symbol in
+    the SymbolTable.
+
+    Blocks are buffered and written out every chunkRows rows to a columnar
+    directory: one part-NNNNN.npz file per chunk holding one array per
+    column, its contract ids numbered within the chunk, and the option
+    symbols of those ids. Chunks do not depend on the ids of the
+    SymbolTable, so a run resumed from a checkpoint appends its chunks to
+    the ones of the earlier run. Read it back with readAttribution. 
+    Without a path no rows are kept.
+
+    A new run replaces the chunks already in path. With resumeAfter the
+    chunks are kept, rows of the dates after resumeAfter (e.g. of an
+    earlier resume from the same checkpoint) are dropped, and the new
+    chunks are numbered after the kept ones.
+
+    Every block is also grouped by contract as it is appended, the running
+    totals give contractTotPnl. Rows are added to the totals one by one in
+    row order, each contract's total starting from -0.0, so the totals are
+    the same as adding each pnl to a dictionary entry.
+
+    Inputs:
+        symbolTable -- positionBook.SymbolTable of the contract ids
+        path -- directory to write the attribution to, None to keep only
+                the contract totals
+        chunkRows -- number of rows buffered before a chunk is written
+        resumeAfter -- datetime, date of the checkpoint a run resumes from,
+                       None for a new run
+    '''
+    columns = ['dateId', 'contractId', 'optionPnl', 'stockPnl', 'tradePnl']
+
+    def __init__(self, symbolTable, path=None, chunkRows=1 << 20, resumeAfter=None):
+        self.symbolTable = symbolTable
+        self.path = path
+        self.chunkRows = chunkRows
+        # contract totals indexed by contract id, and the contract ids
+        # in order of first appearance
+        self.totals = np.zeros(0)
+        self.seen = np.zeros(0, dtype=bool)
+        self.order = []
+        # buffered blocks of the chunk being filled
+        self.blocks = []
+        self.bufferedRows = 0
+        self.nChunks = 0
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+            fileNames = partFiles(path)
+            if resumeAfter is None:
+                if fileNames:
+                    logging.warning("Replacing the %d attribution chunks in %s", 
+                                    len(fileNames), path)
+                for fileName in fileNames:
+                    os.remove(fileName)
+            else:
+                self.nChunks = self.truncate(fileNames, dayNumber(resumeAfter))
+
+    def truncate(self, fileNames, lastDay):
+        '''
+        Drop the rows after lastDay from existing chunks, and the chunks 
+        left empty
+
+        Returns:
+        number of the next chunk
+        '''
+        nChunks = 0
+        for fileName in fileNames:
+            with np.load(fileName) as chunk:
+                chunk = dict(chunk)
+            keep = chunk['dateId'] <= lastDay
+            if keep.all():
+                nChunks = chunkNumber(fileName) + 1
+            elif keep.any():
+                chunk = {name: values[keep] if name in self.columns else values
+                         for name, values in chunk.items()}
+                writeChunk(fileName, chunk)
+                nChunks = chunkNumber(fileName) + 1
+            else:
+                os.remove(fileName)
+        return nChunks
+
+    def growTotals(self, contractIds):
+        '''
+        Add the contracts not seen before to the totals,
+        in order of first appearance, starting from -0.0
+        '''
+        nIds = len(self.symbolTable)
+        if nIds > len(self.totals):
+            grown = max(2 * len(self.totals), nIds)
+            self.totals = np.r_[self.totals, np.full(grown - len(self.totals), -0.0)]
+            self.seen = np.r_[self.seen, np.zeros(grown - len(self.seen), dtype=bool)]
+        newIds = pd.unique(contractIds[~self.seen[contractIds]])
+        if len(newIds) > 0:
+            self.seen[newIds] = True
+            self.order.extend(newIds.tolist())
+
+    def append(self, date, contractIds, optionPnl=None, stockPnl=None, tradePnl=None):
+        '''
+        Append a block of rows of one date, missing pnl columns are zeros
+
+        Parameters:
+        date -- datetime
+        contractIds -- array of int, contract id of each row
+        optionPnl, stockPnl, tradePnl -- arrays of pnl of each row
+        '''
+        n = len(contractIds)
+        if n == 0:
+            return
+        zeros = np.zeros(n)
+        contractIds = np.asarray(contractIds, dtype=np.int64)
+        optionPnl = zeros if optionPnl is None else np.asarray(optionPnl, dtype=np.float64)
+        stockPnl = zeros if stockPnl is None else np.asarray(stockPnl, dtype=np.float64)
+        tradePnl = zeros if tradePnl is None else np.asarray(tradePnl, dtype=np.float64)
+        # group by contract
+        self.growTotals(contractIds)
+        np.add.at(self.totals, contractIds, optionPnl + stockPnl + tradePnl)
+        if self.path is None:
+            return
+        self.blocks.append((np.full(n, dayNumber(date), dtype=np.int64), contractIds,
+                            optionPnl, stockPnl, tradePnl))
+        self.bufferedRows += n
+        if self.bufferedRows >= self.chunkRows:
+            self.flush()
+
+    def seedTotals(self, contractIds, totals):
+        '''
+        Start the contract totals from earlier totals, e.g. of a checkpoint,
+        without attribution rows
+        '''
+        contractIds = np.asarray(contractIds, dtype=np.int64)
+        self.growTotals(contractIds)
+        np.add.at(self.totals, contractIds, totals)
+
+    def flush(self):
+        '''
+        Write the buffered rows as a chunk, with the symbols of its contracts
+        '''
+        if self.path is None or not self.blocks:
+            return
+        chunk = {name: np.concatenate([block[i] for block in self.blocks])
+                 for i, name in enumerate(self.columns)}
+        # number the contracts within the chunk
+        contractIds, chunk['contractId'] = np.unique(chunk['contractId'], 
+                                                     return_inverse=True)
+        chunk['symbols'] = np.array(self.symbolTable.symbolsOf(contractIds), dtype=str)
+        writeChunk(os.path.join(self.path, 'part-%05d.npz' % self.nChunks), chunk)
+        self.nChunks += 1
+        self.blocks = []
+        self.bufferedRows = 0
+
+    def close(self):
+        self.flush()
+
+    def contractTotals(self):
+        '''
+        Returns:
+        contractIds -- array of int, in order of first appearance
+        totals -- array of total pnl of each contract
+        '''
+        contractIds = np.array(self.order, dtype=np.int64)
+        return contractIds, self.totals[contractIds]
+
+    def contractTotPnl(self):
+        '''
+        Total pnl of every contract, as a dictionary of option symbol to pnl,
+        in order of first appearance
+        '''
+        contractIds, totals = self.contractTotals()
+        return dict(zip(self.symbolTable.symbolsOf(contractIds), totals.tolist()))
+
+def partFiles(path):
+    ''' Chunk files of an attribution directory, in chunk order '''
+    return sorted(glob.glob(os.path.join(path, 'part-*.npz')))
+
+def chunkNumber(fileName):
+    return int(os.path.basename(fileName)[len('part-'):-len('.npz')])
+
+def writeChunk(fileName, chunk):
+    ''' Write a chunk to a temporary file first and rename it '''
+    tempName = fileName + '.tmp'
+    with open(tempName, 'wb') as f:
+        np.savez(f, **chunk)
+    os.replace(tempName, fileName)
+
+def readAttribution(path):
+    '''
+    Read the attribution written by an AttributionStore
+
+    Parameters:
+    path -- directory of the attribution
+
+    Returns:
+    dataFrame with columns Date, OptionSymbol, OptionPnl, StockPnl and
+    TradePnl, in the order the rows were appended
+    '''
+    chunks = []
+    for fileName in partFiles(path):
+        with np.load(fileName) as chunk:
+            chunk = {name: chunk[name] for name in AttributionStore.columns + ['symbols']}
+        chunk['OptionSymbol'] = chunk['symbols'].astype(object)[chunk['contractId']]
+        chunks.append(chunk)
+    columns = {name: np.concatenate([chunk[name] for chunk in chunks]) if chunks
+               else np.zeros(0, dtype=np.float64)
+               for name in AttributionStore.columns + ['OptionSymbol']}
+    return pd.DataFrame({'Date': columns['dateId'].astype(np.int64)
+                                                  .astype('datetime64[D]')
+                                                  .astype('datetime64[ns]'),
+                         'OptionSymbol': columns['OptionSymbol'].astype(object),
+                         'OptionPnl': columns['optionPnl'],
+                         'StockPnl': columns['stockPnl'],
+                         'TradePnl': columns['tradePnl']})
@@ -3,14 +3,17 @@
 @author: Chengye
 """
 
-import os
+import time
+import numpy as np
 import pandas as pd
 import logging
+import warnings
 from datetime import datetime
-from base import Trade
-from base import Option
 from portfolio import Portfolio
-from evaluation import Metrics
+from positionBook import SymbolTable
+from snapshot import OptionSnapshotIndex, TradeBlotter
+from dataCache import ColumnCache
+from instrumentation import nullInstrumentation
 
 '''
 PNL Metrics Definition:
@@ -31,7 +34,10 @@ class BackTest(object):
     Class for running a backtest session
     
     Inputs:
-        optionData -- dataFrame of all options information
+        optionData -- dataFrame of all options information, or a streaming 
+                      option source (see snapshot.CsvOptionSource and 
+                      snapshot.PartitionedOptionSource) which is read one date 
+                      at a time when the history does not fit in memory
         tradeData -- dataFrame of all trade information
         vegaLimit -- vega limit on stock and portfolio
         ir -- overnight interest rate, assume it's constant
@@ -39,157 +45,323 @@ class BackTest(object):
                 assume it's constant for both options and stock trading
                 accounts for slippage, commission fee, finance cost, etc
                 assume no transaction cost for option expire and stock rebalance   
+        eodMode -- end-of-day update mode of the portfolios, 'vectorized', 
+                   'loop' or 'sharded'
+        nShards -- number of underlying shards of the 'sharded' mode, 
+                   default number of cores
+        executor -- concurrent.futures executor running the shards, default 
+                    a thread pool shared by all portfolios
     '''
-    def __init__(self, optionData, tradeData, vegaLimit, ir, cost=0):
+    def __init__(self, optionData, tradeData, vegaLimit, ir, cost=0, 
+                 eodMode='vectorized', nShards=None, executor=None):
         # Input
         self.optionData = optionData
         self.tradeData = tradeData
         self.vegaLimit = vegaLimit
         self.ir = ir
         self.cost = cost
+        self.eodMode = eodMode
+        self.nShards = nShards
+        self.executor = executor
         
+        if isinstance(optionData, pd.DataFrame):
+            # option snapshot index, partitioned by date once and shared by all runs
+            self.optionSource = OptionSnapshotIndex(optionData)
+        else:
+            # streaming option source, yields one date's chain at a time
+            self.optionSource = optionData
+        # trade index, sorted by date and time once
+        self.tradeBlotter = TradeBlotter(tradeData)
         # date range list
-        self.dateList = list(set(optionData['DataDate']))
-        self.dateList.sort()
+        self.dateList = self.optionSource.dateList
         # underlying ticker list
-        self.stockList = list(set(optionData['UnderlyingSymbol']))
+        self.stockList = self.optionSource.tickers
+        # option symbols interned to integer ids, shared by all portfolios
+        self.symbolTable = SymbolTable()
+        # portfolios of the last run, with their pnl metrics
+        self.portfolios = []
                 
     def loadTrades(self, date):
         '''
-        Store all the trades for a certain date and sort them by trade time
+        Load all the trades for a certain date, sorted by trade time
 
         Parameters: 
         date -- datetime
 
         Returns:
-        tradeList -- list of Trade objects, in trade time ascending order
+        tradeBatch -- TradeBatch, in trade time ascending order
         '''
-        tempTradeData = self.tradeData.loc[self.tradeData['Date'] == date].sort_values('Time')
-        tradeList = []
-        for index, row in tempTradeData.iterrows():
-            tradeList.append(Trade(row['Date'], row['Time'], row['OptionSymbol'], 
-                                   row['Price'], row['Vega'], row['Quantity']))
-        return tradeList
+        return self.tradeBlotter.getBatch(date)
     
     def loadOptions(self, date):
         '''
-        Store all the option information for a certain date
+        Load the option chain of a certain date, 
+        only for option data held in memory
 
         Parameters:
         date -- datetime
 
         Returns:
-        optionDict -- dictionary of Option objects
+        optionChain -- OptionChain, option information of that date
         '''
-        optionDict={}
-        tempOptionData = self.optionData.loc[self.optionData['DataDate'] == date]
-        for index, row in tempOptionData.iterrows():
-            option = Option(row['DataDate'], 
-                            row['UnderlyingSymbol'], 
-                            row['OptionSymbol'], 
-                            row['Delta'], 
-                            row['UnderlyingPrice'], 
-                            row['Signal'], 
-                            row['Multiplier'], 
-                            row['Vega'], 
-                            row['Last'])
-            optionDict[row['OptionSymbol']] = option
-        return optionDict                           
+        return self.optionSource.getChain(date)
         
-    def run(self, agreeType):
+    def makePortfolio(self, spec, optionChain, date):
+        '''
+        Create a Portfolio from a portfolio spec
+
+        Parameters:
+        spec -- dictionary with key 'agreeType' and optional keys 'vegaLimit', 
+                'ir' and 'cost', which default to the BackTest's values, 
+                'rollingWindow', the number of days of the rolling pnl 
+                metrics, 'checkpoint', the path of a checkpoint to resume from, 
+                and 'attribution', the directory to write the per contract, 
+                per day pnl attribution to
+        optionChain -- OptionChain of the start date, not used when resuming
+        date -- datetime, the start date, not used when resuming
+
+        Returns:
+        Portfolio object
+        '''
+        if spec.get('checkpoint') is not None:
+            pf = Portfolio.loadCheckpoint(spec['checkpoint'], self.stockList, 
+                                          self.eodMode, self.symbolTable, 
+                                          spec.get('attribution'))
+            if pf.agreeType != spec['agreeType']:
+                raise ValueError("Checkpoint %s has agreeType %r" % 
+                                 (spec['checkpoint'], pf.agreeType))
+            # parameters given in the spec apply from the resumed date on
+            pf.vegaLimit = spec.get('vegaLimit', pf.vegaLimit)
+            pf.ir = spec.get('ir', pf.ir)
+            pf.cost = spec.get('cost', pf.cost)
+            return pf
+        return Portfolio(spec['agreeType'], 
+                         spec.get('vegaLimit', self.vegaLimit), 
+                         self.stockList, optionChain, date, 
+                         spec.get('ir', self.ir), 
+                         spec.get('cost', self.cost), 
+                         self.eodMode, 
+                         spec.get('rollingWindow'), 
+                         self.symbolTable, 
+                         spec.get('attribution'))
+    
+    def run(self, agreeType, instrument=None, startCheckpoint=None, dateRange=None,
+            saveCheckpoint=None, attributionPath=None):
         '''
         Run backtest
 
         Parameters:
         agreeType -- bool, true if portfolio trades agree with previous day's signal, 
                      false otherwise
+        instrument -- Instrumentation object collecting per-stage timings and 
+                      counters, read them with instrument.toFrame() after the run
+        startCheckpoint -- path of a portfolio checkpoint, the run resumes 
+                           from the checkpoint's date and only processes the 
+                           dates after it
+        dateRange -- (start, end) tuple of dates, inclusive, to run over, 
+                     None for no limit on either side
+        saveCheckpoint -- path to save the portfolio checkpoint to after the 
+                          last date
+        attributionPath -- directory to write the option, hedge and trade pnl 
+                           of each contract and date to, read it back with 
+                           attribution.readAttribution
 
         Returns:
         dailyPnls -- dataframe that contains daily trade pnl, daily position pnl, 
                      daily total pnl and cumulative total pnl for each day
         contractTotPnl -- dictionary of doubles, total pnl of each option symbol
         '''
-        
-        portfolioPnls = pd.DataFrame(0, index = self.dateList, 
-                                      columns = ['DailyTradePnl', 
-                                                 'DailyPositionPnl', 
-                                                 'DailyTotPnl',
-                                                 'CumTotPnl'])        
-        date = self.dateList[0]
-        optionDict = self.loadOptions(date)          
-        pf = Portfolio(agreeType, self.vegaLimit, self.stockList, optionDict, 
-                       date, self.ir, self.cost)
-        for date in self.dateList[1:]:
-            logging.info('BtDate = ' + str(date)[:11])
-            tradeList = self.loadTrades(date)
-            if len(tradeList)==0:
-                continue
-            # handle each trade one by one, in ascending tradetime 
-            for trade in tradeList:
-                pf.handleTrade(trade) 
-            # update option info at COB, calculate daily pnls and rehedge
-            optionDictNew = self.loadOptions(date)
-            pf.updateEOD(optionDictNew, date)
-            # store daily pnls
-            portfolioPnls.loc[date] = [pf.dailyTradePnl, 
-                                       pf.dailyPositionPnl, 
-                                       pf.dailyTotPnl,
-                                       pf.totPnl]
-        contractTotPnl = pf.contractTotPnl
-        return portfolioPnls, contractTotPnl
+        spec = {'agreeType': agreeType, 'checkpoint': startCheckpoint, 
+                'saveCheckpoint': saveCheckpoint, 'attribution': attributionPath}
+        return self.runMany([spec], instrument, dateRange)[0]
     
-def readData(optionFileName, tradeFileName):
+    def runDates(self, dateRange=None, startDate=None):
+        '''
+        Dates of a run, within an inclusive (start, end) date range and after
+        startDate, the date of a resumed portfolio
+        '''
+        dates = self.dateList
+        if dateRange is not None:
+            dates = [date for date, keep in 
+                     zip(dates, inDateRange(pd.Series(dates), dateRange)) if keep]
+        if startDate is not None:
+            dates = [date for date in dates if date > startDate]
+        return dates
+    
+    def runMany(self, portfolioSpecs, instrument=None, dateRange=None):
+        '''
+        Run backtest for several portfolios in a single pass over the dates.
+        Each day's options and trades are loaded once and routed to every 
+        portfolio. Option chains are pulled from the option source one date at 
+        a time, the portfolios only keep the previous date's chain.
+        Every portfolio is updated at the end of every date, dates without 
+        trades only mark positions, settle expiries and rehedge.
+
+        Each portfolio updates its pnl metrics (Portfolio.metrics and 
+        Portfolio.rollingMetrics) at every end-of-day, the portfolios of the 
+        last run are kept in self.portfolios.
+        Portfolios resumed from checkpoints start from the checkpoint's date 
+        and chain, and their results only cover the dates after it, so they 
+        can be appended to the results of the earlier runs.
+
+        Parameters:
+        portfolioSpecs -- list of dictionaries, each with key 'agreeType' and 
+                          optional keys 'vegaLimit', 'ir', 'cost' and 
+                          'rollingWindow', 'checkpoint' to resume from a portfolio checkpoint, 
+                          'saveCheckpoint' to save one after the last date and 
+                          'attribution', the directory of the portfolio's pnl 
+                          attribution
+        instrument -- Instrumentation object collecting per-stage timings and 
+                      counters, None for no instrumentation
+        dateRange -- (start, end) tuple of dates, inclusive, to run over, 
+                     None for no limit on either side, a new run raises 
+                     ValueError if the range has no option dates
+
+        Returns:
+        list of (dailyPnls, contractTotPnl) tuples, one per portfolio spec, 
+        in the same format as run()
+        '''
+        if instrument is None:
+            instrument = nullInstrumentation
+        infoEnabled = logging.getLogger().isEnabledFor(logging.INFO)
+        resumed = [spec.get('checkpoint') is not None for spec in portfolioSpecs]
+        if any(resumed) and not all(resumed):
+            raise ValueError("Either all or none of the portfolios resume from a checkpoint")
+        instrument.startProfile()
+        try:
+            if all(resumed) and portfolioSpecs:
+                portfolios = [self.makePortfolio(spec, None, None) 
+                              for spec in portfolioSpecs]
+                startDate = portfolios[0].today
+                if any(pf.today != startDate for pf in portfolios):
+                    raise ValueError("Checkpoints are not all of the same date")
+                dateList = self.runDates(dateRange, startDate)
+                chains = self.optionSource.iterChains(dateList)
+                first = 0
+            else:
+                dateList = self.runDates(dateRange)
+                if not dateList:
+                    raise ValueError("No option dates in the date range %r" % (dateRange,))
+                chains = self.optionSource.iterChains(
+                        None if dateList is self.dateList else dateList)
+                optionChain = next(chains)
+                portfolios = [self.makePortfolio(spec, optionChain, optionChain.date) 
+                              for spec in portfolioSpecs]
+                del optionChain
+                first = 1
+            for pf in portfolios:
+                pf.instrument = instrument
+                if self.nShards is not None:
+                    pf.nShards = self.nShards
+                pf.executor = self.executor
+            portfolioPnls = [np.zeros((len(dateList), 4)) for spec in portfolioSpecs]
+            for i in range(first, len(dateList)):
+                # option info at COB of each date, shared by all portfolios
+                start = time.perf_counter()
+                optionChainNew = next(chains)
+                date = optionChainNew.date
+                instrument.setDate(date)
+                instrument.addTime('loadOptions', time.perf_counter() - start)
+                if infoEnabled:
+                    logging.info('BtDate = %s', str(date)[:11])
+                with instrument.stage('loadTrades'):
+                    tradeBatch = self.loadTrades(date)
+                for pf, pnls in zip(portfolios, portfolioPnls):
+                    # handle the trades in ascending tradetime 
+                    if len(tradeBatch) > 0:
+                        pf.handleTrades(tradeBatch) 
+                    # calculate daily pnls and rehedge
+                    pf.updateEOD(optionChainNew, date)
+                    # store daily pnls
+                    pnls[i] = [pf.dailyTradePnl, 
+                               pf.dailyPositionPnl, 
+                               pf.dailyTotPnl,
+                               pf.totPnl]
+            instrument.setDate(None)
+        finally:
+            instrument.stopProfile()
+        self.portfolios = portfolios
+        for pf in portfolios:
+            pf.attribution.close()
+        for spec, pf in zip(portfolioSpecs, portfolios):
+            if spec.get('saveCheckpoint') is not None:
+                pf.saveCheckpoint(spec['saveCheckpoint'])
+        results = []
+        for pf, pnls in zip(portfolios, portfolioPnls):
+            dailyPnls = pd.DataFrame(pnls, index = dateList, 
+                                     columns = ['DailyTradePnl', 
+                                                'DailyPositionPnl', 
+                                                'DailyTotPnl',
+                                                'CumTotPnl'])
+            results.append((dailyPnls, pf.contractTotPnl))
+        return results
+    
+def readData(optionFileName, tradeFileName, cacheDir=None, optionColumns=None, 
+             dateRange=None):
     '''
     Read csv files for option and trade, sotre into pandas dataframe
-    '''
-    optionData = pd.read_csv(optionFileName)
-    optionData['DataDate'] = pd.to_datetime(optionData['DataDate'])
     
-    tradeData = pd.read_csv(tradeFileName)
-    tradeData['Date'] = pd.to_datetime(tradeData['Date'])
-    tradeData['Time'] = [datetime.strptime(x, '%H:%M:%S').time() for x in tradeData['Time']]
+    Parameters:
+    optionFileName, tradeFileName -- paths of the csv files
+    cacheDir -- directory of the binary column caches, if given the csv files
+                are parsed once into the cache and memory-mapped afterwards
+    optionColumns -- list of option columns to load, default all columns
+    dateRange -- (start, end) tuple of dates, inclusive, to load a date range
+    '''
+    if cacheDir is None:
+        optionData = pd.read_csv(optionFileName, usecols=optionColumns)
+        optionData['DataDate'] = pd.to_datetime(optionData['DataDate'])
+        tradeData = pd.read_csv(tradeFileName)
+        tradeData['Date'] = pd.to_datetime(tradeData['Date'])
+        if dateRange is not None:
+            optionData = optionData.loc[inDateRange(optionData['DataDate'], dateRange)]
+            tradeData = tradeData.loc[inDateRange(tradeData['Date'], dateRange)]
+    else:
+        optionData = ColumnCache(optionFileName, cacheDir, ['DataDate'], 'DataDate').read(
+                optionColumns, dateRange)
+        tradeData = ColumnCache(tradeFileName, cacheDir, ['Date'], 'Date').read(
+                None, dateRange)
+    tradeData['Time'] = parseTimes(tradeData['Time'])
     
     return optionData, tradeData
 
+def inDateRange(dates, dateRange):
+    '''
+    Boolean mask of dates within an inclusive (start, end) range, 
+    None for no limit on either side
+    '''
+    start, end = dateRange
+    mask = np.ones(len(dates), dtype=bool)
+    if start is not None:
+        mask &= (dates >= pd.Timestamp(start)).to_numpy()
+    if end is not None:
+        mask &= (dates <= pd.Timestamp(end)).to_numpy()
+    return mask
+
+def parseTimes(times):
+    '''
+    Parse trade time strings, each distinct time string is parsed only once
+    '''
+    codes, uniques = pd.factorize(times)
+    parsed = np.array([datetime.strptime(x, '%H:%M:%S').time() for x in uniques], 
+                      dtype=object)
+    return parsed.take(codes)
+
 def saveToCsv(portfolioPnls, contractTotPnl, maxDrawdown, longestUnprofit, 
                sharpeRatio, savePath, agreeType):
     '''
-    save all pnl metrics to csv files
+    save all pnl metrics to csv files, 
+    deprecated, use resultSink.CsvSink
     '''
-    portfolioPnls.to_csv(os.path.join(savePath, "portfolio_pnls_%r.csv"%agreeType))
-    pd.DataFrame.from_dict(data=contractTotPnl, orient='index').to_csv(
-            os.path.join(savePath, "contract_total_pnls_%r.csv"%agreeType), header=['totalPnls'])
-    metrics = pd.Series([maxDrawdown, longestUnprofit, sharpeRatio], 
-                        index = ['maxDrawDown','longestUnprofitDays', 'sharpeRatio'])
-    metrics.to_csv(os.path.join(savePath, "other_metrics_%r.csv"%agreeType), header=['values'])
+    warnings.warn("saveToCsv is deprecated, use resultSink.CsvSink", 
+                  DeprecationWarning, stacklevel=2)
+    from resultSink import CsvSink
+    CsvSink(savePath).write({'agreeType': agreeType}, portfolioPnls, contractTotPnl, 
+                            {'maxDrawDown': maxDrawdown, 
+                             'longestUnprofitDays': longestUnprofit, 
+                             'sharpeRatio': sharpeRatio})
     
 if __name__ == '__main__':
-    path = os.path.abspath(os.path.join(__file__, '..'))
-    optionFileName = os.path.join(path, "option_sample.csv")
-    tradeFileName = os.path.join(path, "trade_sample.csv")
-    
-    optionData, tradeData = readData(optionFileName, tradeFileName)
-    vegaLimit = 5000
-    ir = 0.015
-    cost = 0.005
-    bt = BackTest(optionData, tradeData, vegaLimit, ir, cost)
-
-    resultDict = {True:{}, False:{}} # result dictionary for both portfolios
-    for agreeType in [True, False]:
-        logging.info("Backtesting for agreeType = %r" %agreeType)
-        portfolioPnls, contractTotPnl = bt.run(agreeType)
-        maxDrawdown, longestUnprofit = Metrics.calcDrawdowns(portfolioPnls['DailyTotPnl'])
-        sharpeRatio = Metrics.calcSharpeRatio(portfolioPnls['DailyTotPnl'])
-        result = {'DailyTradePnl': portfolioPnls['DailyTradePnl'],
-                  'DailyPositionPnl': portfolioPnls['DailyPositionPnl'],
-                  'DailyTotalPnl': portfolioPnls['DailyTotPnl'],
-                  'CumTotalPnl': portfolioPnls['CumTotPnl'],
-                  'ContractTotalPnl': contractTotPnl,
-                  'longestUnprofitDays': longestUnprofit,
-                  'MaxDrawdown': maxDrawdown,
-                  'SharpeRatio': sharpeRatio}
-        resultDict[agreeType] = result
-        saveToCsv(portfolioPnls, contractTotPnl, maxDrawdown, longestUnprofit, 
-               sharpeRatio, path, agreeType)
-        
-    
\ No newline at end of file
+    # command line arguments, see cli.py
+    import cli
+    cli.main()
@@ -3,6 +3,8 @@
 @author: Chengye
 """
 
+import numpy as np
+
 class Option(object):
     ''' Class for an option'''
     def __init__(self, optionDate, underlyingTicker, optionSymbol, delta,
@@ -114,3 +116,167 @@ class Trade(object):
         
     def setQuantity(self, quantity):
         self.__quantity = quantity        
+
+
+class OptionChain(object):
+    ''' 
+    Class for one day's option chain, stored column-wise in numpy arrays
+
+    OptionChain inputs:
+        optionDate -- date of the chain
+        optionSymbols -- array of option symbols
+        underlyingIds -- array of int, index of each option's underlying in tickers
+        tickers -- list of underlying tickers shared by all chains of a backtest
+        delta, spot, signal, contractMultiplier, vega, optionPrice -- arrays, 
+            one value per option symbol
+        symbolIndex -- dictionary of option symbol to array position, 
+                       built from optionSymbols if not given
+    '''
+    def __init__(self, optionDate, optionSymbols, underlyingIds, tickers, 
+                 delta, spot, signal, contractMultiplier, vega, optionPrice,
+                 symbolIndex=None):
+        self.date = optionDate
+        self.symbols = np.asarray(optionSymbols, dtype=object)
+        self.underlyingIds = np.asarray(underlyingIds, dtype=np.int64)
+        self.tickers = tickers
+        self.delta = np.asarray(delta, dtype=np.float64)
+        self.spot = np.asarray(spot, dtype=np.float64)
+        self.signal = np.asarray(signal, dtype=np.float64)
+        self.multiplier = np.asarray(contractMultiplier, dtype=np.float64)
+        self.vega = np.asarray(vega, dtype=np.float64)
+        self.price = np.asarray(optionPrice, dtype=np.float64)
+        if symbolIndex is None:
+            symbolIndex = dict(zip(self.symbols.tolist(), range(len(self.symbols))))
+        self.symbolIndex = symbolIndex
+
+    @classmethod
+    def fromOptions(cls, optionDict, tickers=None):
+        '''
+        Build a chain from a dictionary of Option objects
+
+        Parameters:
+        optionDict -- dictionary of Option objects, keyed by option symbol
+        tickers -- list of underlying tickers, default all tickers in optionDict
+        '''
+        options = list(optionDict.values())
+        if tickers is None:
+            tickers = sorted(set(option.getUnderlyingTicker() for option in options))
+        tickerIndex = dict(zip(tickers, range(len(tickers))))
+        optionDate = options[0].getOptionDate() if options else None
+        return cls(optionDate,
+                   [option.getOptionSymbol() for option in options],
+                   [tickerIndex[option.getUnderlyingTicker()] for option in options],
+                   tickers,
+                   [option.getDelta() for option in options],
+                   [option.getSpot() for option in options],
+                   [option.getSignal() for option in options],
+                   [option.getContractMultiplier() for option in options],
+                   [option.getVega() for option in options],
+                   [option.getOptionPrice() for option in options])
+
+    def indexOf(self, optionSymbols):
+        '''
+        Array positions of a list of option symbols, -1 if not in the chain
+        '''
+        get = self.symbolIndex.get
+        return np.array([get(symbol, -1) for symbol in optionSymbols], 
+                        dtype=np.int64)
+
+    def getOption(self, optionSymbol):
+        '''
+        Option view of one row of the chain
+        '''
+        i = self.symbolIndex[optionSymbol]
+        return Option(self.date, 
+                      self.tickers[self.underlyingIds[i]], 
+                      optionSymbol, 
+                      self.delta[i], 
+                      self.spot[i], 
+                      self.signal[i], 
+                      self.multiplier[i], 
+                      self.vega[i], 
+                      self.price[i])
+
+    def keys(self):
+        return self.symbolIndex.keys()
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def __contains__(self, optionSymbol):
+        return optionSymbol in self.symbolIndex
+
+    def __iter__(self):
+        return iter(self.symbolIndex)
+
+    def __getitem__(self, optionSymbol):
+        return self.getOption(optionSymbol)
+
+
+class TradeBatch(object):
+    ''' 
+    Class for a batch of trades of one date, stored column-wise in numpy 
+    arrays, in trade time ascending order
+    
+    TradeBatch inputs:
+        tradeDate -- date of the trades
+        tradeTimes, optionSymbols, tradePrices, tradeVegas, quantities -- 
+            arrays, one value per trade
+    '''
+    def __init__(self, tradeDate, tradeTimes, optionSymbols, tradePrices, 
+                 tradeVegas, quantities):
+        self.date = tradeDate
+        self.times = np.asarray(tradeTimes, dtype=object)
+        self.symbols = np.asarray(optionSymbols, dtype=object)
+        self.prices = np.asarray(tradePrices, dtype=np.float64)
+        self.vegas = np.asarray(tradeVegas, dtype=np.float64)
+        self.quantities = np.asarray(quantities)
+    
+    @classmethod
+    def fromTrades(cls, tradeList):
+        '''
+        Build a batch from a list of Trade objects of the same date
+        '''
+        tradeDate = tradeList[0].getTradeDate() if tradeList else None
+        return cls(tradeDate,
+                   [trade.getTradeTime() for trade in tradeList],
+                   [trade.getOptionSymbol() for trade in tradeList],
+                   [trade.getTradePrice() for trade in tradeList],
+                   [trade.getTradeVega() for trade in tradeList],
+                   [trade.getQuantity() for trade in tradeList])
+    
+    @classmethod
+    def concat(cls, batches):
+        '''
+        Concatenate a list of batches of the same date into one batch
+        '''
+        if len(batches) == 1:
+            return batches[0]
+        return cls(batches[0].date if batches else None,
+                   np.concatenate([batch.times for batch in batches]),
+                   np.concatenate([batch.symbols for batch in batches]),
+                   np.concatenate([batch.prices for batch in batches]),
+                   np.concatenate([batch.vegas for batch in batches]),
+                   np.concatenate([batch.quantities for batch in batches]))
+    
+    def take(self, indices):
+        '''
+        Batch of the trades at the given positions or boolean mask
+        '''
+        return TradeBatch(self.date, self.times[indices], self.symbols[indices], 
+                          self.prices[indices], self.vegas[indices], 
+                          self.quantities[indices])
+    
+    def getTrade(self, i):
+        '''
+        Trade view of one row of the batch
+        '''
+        return Trade(self.date, self.times[i], self.symbols[i], self.prices[i], 
+                     self.vegas[i], self.quantities[i])
+    
+    def __len__(self):
+        return len(self.symbols)
+    
+    def __iter__(self):
+        for i in range(len(self.symbols)):
+            yield self.getTrade(i)
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Chengye
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+import platform
+import subprocess
+import tracemalloc
+import numpy as np
+import pandas as pd
+from benchmarks.benchmarks import benchmarkClasses, scales
+
+'''
+Run the benchmark cases and record the results as json, e.g.
+
+    python -m benchmarks --scale medium --repeat 5
+
+Each time_* method is run repeat times after its setup and the min, median
+and max seconds are recorded. Each peakmem_* method is run once under
+tracemalloc and the peak traced memory is recorded in bytes. Results are
+saved to benchmarks/results/<timestamp>-<commit>-<scale>.json with the git
+commit and library versions, so runs can be compared over time.
+'''
+
+def gitCommit(path):
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], 
+                                       cwd=path, stderr=subprocess.DEVNULL
+                                       ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def libraryVersions():
+    versions = {'python': platform.python_version(), 
+                'numpy': np.__version__, 
+                'pandas': pd.__version__}
+    try:
+        import numba
+        versions['numba'] = numba.__version__
+    except ImportError:
+        versions['numba'] = None
+    return versions
+
+def benchmarkCases(pattern=None):
+    '''
+    List the (className, methodName, param) cases, optionally only those whose
+    'className.methodName' contains pattern
+    '''
+    cases = []
+    for cls in benchmarkClasses:
+        for name in sorted(dir(cls)):
+            if not name.startswith(('time_', 'peakmem_')):
+                continue
+            if pattern is not None and pattern not in '%s.%s' % (cls.__name__, name):
+                continue
+            for param in getattr(cls, 'params', [None]):
+                cases.append((cls, name, param))
+    return cases
+
+def runCase(cls, name, param, scale, repeat):
+    '''
+    Run one benchmark case
+
+    Returns:
+    dictionary of the case name and its measurements
+    '''
+    bench = cls(scale)
+    args = () if param is None else (param,)
+    bench.setup(*args)
+    method = getattr(bench, name)
+    try:
+        result = {'name': '%s.%s' % (cls.__name__, name), 'param': param}
+        if name.startswith('time_'):
+            times = []
+            for i in range(repeat):
+                start = time.perf_counter()
+                method(*args)
+                times.append(time.perf_counter() - start)
+            result.update({'min': min(times), 'median': float(np.median(times)), 
+                           'max': max(times), 'repeat': repeat})
+        else:
+            tracemalloc.start()
+            try:
+                method(*args)
+                result['peakBytes'] = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+    finally:
+        bench.teardown()
+    return result
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description='Backtest performance benchmarks')
+    parser.add_argument('--scale', default='small', choices=sorted(scales))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--bench', default=None, 
+                        help='only run cases whose Class.method contains this')
+    parser.add_argument('--output', default=None, 
+                        help='json file, default benchmarks/results/<timestamp>-<commit>-<scale>.json')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parseArgs(argv)
+    # expiry warnings of the synthetic runs would flood the output
+    logging.getLogger().setLevel(logging.ERROR)
+    path = os.path.dirname(os.path.abspath(__file__))
+    commit = gitCommit(path)
+    timestamp = time.strftime('%Y%m%dT%H%M%S')
+    results = []
+    for cls, name, param in benchmarkCases(args.bench):
+        result = runCase(cls, name, param, args.scale, args.repeat)
+        results.append(result)
+        if 'median' in result:
+            value = '%10.4f s' % result['median']
+        else:
+            value = '%10.1f MB' % (result['peakBytes'] / 2 ** 20)
+        label = result['name'] + ('' if param is None else '(%s)' % param)
+        print('%-40s %s' % (label, value))
+        sys.stdout.flush()
+    output = args.output
+    if output is None:
+        os.makedirs(os.path.join(path, 'results'), exist_ok=True)
+        output = os.path.join(path, 'results', '%s-%s-%s.json' % 
+                              (timestamp, commit or 'nogit', args.scale))
+    with open(output, 'w') as f:
+        json.dump({'timestamp': timestamp, 
+                   'commit': commit, 
+                   'scale': args.scale, 
+                   'sizes': dict(zip(['nTickers', 'nStrikes', 'nExpiries', 'nDays', 
+                                      'fillsPerDay'], scales[args.scale])), 
+                   'machine': platform.machine(), 
+                   'cpuCount': os.cpu_count(), 
+                   'versions': libraryVersions(), 
+                   'results': results}, f, indent=2)
+    print('Results saved to %s' % output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Chengye
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+
+# benchmarks run from the repo root or from asv, make the library importable
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from backTester import BackTest, readData
+from evaluation import Metrics, OnlineMetrics, RollingMetrics
+from benchmarks.synthetic import generateOptions, generateTrades, writeCsv
+
+'''
+Benchmark cases in asv style: every class has a setup method, methods named
+time_* are timed and methods named peakmem_* are measured for peak memory.
+Run them with `python -m benchmarks`, or with asv pointed at this directory.
+'''
+
+# Synthetic data sizes, (nTickers, nStrikes, nExpiries, nDays, fillsPerDay)
+scales = {'small': (20, 10, 4, 40, 200),
+          'medium': (100, 20, 6, 120, 2000),
+          'large': (500, 30, 8, 252, 10000)}
+
+# Scale used by asv, which does not pass one in
+defaultScale = 'small'
+
+dataCache = {}
+
+def makeData(scale):
+    '''
+    Generate the synthetic option and trade data of a scale, once per process
+    '''
+    if scale not in dataCache:
+        nTickers, nStrikes, nExpiries, nDays, fillsPerDay = scales[scale]
+        optionData = generateOptions(nTickers, nStrikes, nExpiries, nDays)
+        tradeData = generateTrades(optionData, fillsPerDay)
+        dataCache[scale] = (optionData, tradeData)
+    return dataCache[scale]
+
+class Benchmark(object):
+    ''' Base class of the benchmarks, holds synthetic data of one scale '''
+    vegaLimit = 5000
+    ir = 0.015
+    cost = 0.005
+
+    def __init__(self, scale=defaultScale):
+        self.scale = scale
+
+    def setup(self):
+        optionData, tradeData = makeData(self.scale)
+        self.optionData = optionData
+        # trade times as parsed by readData
+        self.tradeData = tradeData.copy()
+        self.tradeData['Time'] = pd.to_datetime(tradeData['Time'], 
+                                                format='%H:%M:%S').dt.time
+
+    def teardown(self):
+        pass
+
+    def makeBackTest(self):
+        return BackTest(self.optionData, self.tradeData, self.vegaLimit, self.ir, 
+                        self.cost)
+
+class ReadData(Benchmark):
+    ''' readData from csv files, without and with the column cache '''
+    def setup(self):
+        Benchmark.setup(self)
+        self.path = tempfile.mkdtemp()
+        self.optionFileName = os.path.join(self.path, 'options.csv')
+        self.tradeFileName = os.path.join(self.path, 'trades.csv')
+        # trade times are written as the original strings
+        writeCsv(self.optionData, makeData(self.scale)[1], 
+                 self.optionFileName, self.tradeFileName)
+        self.cacheDir = os.path.join(self.path, '.cache')
+        # build the cache once, so time_readCached measures cache hits
+        readData(self.optionFileName, self.tradeFileName, self.cacheDir)
+
+    def teardown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def time_readCsv(self):
+        readData(self.optionFileName, self.tradeFileName)
+
+    def time_readCached(self):
+        readData(self.optionFileName, self.tradeFileName, self.cacheDir)
+
+    def peakmem_readCsv(self):
+        readData(self.optionFileName, self.tradeFileName)
+
+class LoadOptions(Benchmark):
+    ''' Option snapshot index build and per-date chain lookups '''
+    def setup(self):
+        Benchmark.setup(self)
+        self.bt = self.makeBackTest()
+
+    def time_buildIndex(self):
+        self.makeBackTest()
+
+    def time_loadOptions(self):
+        for date in self.bt.dateList:
+            self.bt.loadOptions(date)
+
+    def time_loadTrades(self):
+        for date in self.bt.dateList:
+            self.bt.loadTrades(date)
+
+class HandleTrades(Benchmark):
+    ''' Trade admission of every date's trades, for both portfolios '''
+    def setup(self):
+        Benchmark.setup(self)
+        bt = self.makeBackTest()
+        self.bt = bt
+        self.chains = [bt.loadOptions(date) for date in bt.dateList]
+        self.batches = [bt.loadTrades(date) for date in bt.dateList]
+
+    def makePortfolios(self):
+        return [self.bt.makePortfolio({'agreeType': agreeType}, self.chains[0], 
+                                      self.bt.dateList[0])
+                for agreeType in (True, False)]
+
+    def time_handleTrades(self):
+        for pf in self.makePortfolios():
+            for batch in self.batches[1:]:
+                if len(batch) > 0:
+                    pf.handleTrades(batch)
+                # drop the day's fills, only the admission is measured
+                pf.newDailyTrade = []
+
+    def time_handleTrade(self):
+        # one fill at a time, for comparison with the batched admission
+        for pf in self.makePortfolios():
+            for batch in self.batches[1:]:
+                for trade in batch:
+                    pf.handleTrade(trade)
+                pf.newDailyTrade = []
+
+class UpdateEOD(Benchmark):
+    ''' End-of-day pnl and rehedge, with each day's trades already admitted '''
+    params = ['vectorized', 'loop', 'sharded']
+    param_names = ['eodMode']
+
+    def setup(self, eodMode='vectorized'):
+        Benchmark.setup(self)
+        bt = self.makeBackTest()
+        bt.eodMode = eodMode
+        self.bt = bt
+        self.chains = [bt.loadOptions(date) for date in bt.dateList]
+        self.batches = [bt.loadTrades(date) for date in bt.dateList]
+
+    def time_updateEOD(self, eodMode='vectorized'):
+        pf = self.bt.makePortfolio({'agreeType': True}, self.chains[0], 
+                                   self.bt.dateList[0])
+        for date, chain, batch in zip(self.bt.dateList[1:], self.chains[1:], 
+                                      self.batches[1:]):
+            if len(batch) > 0:
+                pf.handleTrades(batch)
+            pf.updateEOD(chain, date)
+
+class Run(Benchmark):
+    ''' Full backtest runs '''
+    def setup(self):
+        Benchmark.setup(self)
+        self.bt = self.makeBackTest()
+
+    def time_run(self):
+        self.bt.run(True)
+
+    def time_runMany(self):
+        self.bt.runMany([{'agreeType': True}, {'agreeType': False}])
+
+    def peakmem_run(self):
+        self.makeBackTest().run(True)
+
+class EvalMetrics(Benchmark):
+    ''' Drawdown and Sharpe ratio of a daily pnl series '''
+    def setup(self):
+        Benchmark.setup(self)
+        self.dailyPnl = self.makeBackTest().run(True)[0]['DailyTotPnl']
+        self.checkRollingMetrics()
+
+    def checkRollingMetrics(self, window=20):
+        ''' RollingMetrics must match its pandas reference day by day '''
+        rolling = RollingMetrics(window)
+        values = []
+        for pnl in self.dailyPnl.tolist():
+            rolling.update(pnl)
+            values.append((rolling.sharpeRatio(), rolling.drawdown(), rolling.maxDrawdown()))
+        reference = Metrics.calcRollingMetrics(self.dailyPnl, window)
+        values = pd.DataFrame(values, index=reference.index, columns=reference.columns)
+        # constant windows give nan or inf, the reference may lose them to rounding
+        finite = np.isfinite(reference['sharpeRatio'])
+        pd.testing.assert_frame_equal(values[finite], reference[finite], rtol=1e-7)
+
+    def time_calcRollingMetrics(self):
+        Metrics.calcRollingMetrics(self.dailyPnl, 20)
+
+    def time_calcDrawdowns(self):
+        Metrics.calcDrawdowns(self.dailyPnl)
+
+    def time_calcSharpeRatio(self):
+        Metrics.calcSharpeRatio(self.dailyPnl)
+
+    def time_onlineMetrics(self):
+        metrics = OnlineMetrics()
+        rolling = RollingMetrics(20)
+        for pnl in self.dailyPnl.tolist():
+            metrics.update(pnl)
+            rolling.update(pnl)
+
+benchmarkClasses = [ReadData, LoadOptions, HandleTrades, UpdateEOD, Run, EvalMetrics]
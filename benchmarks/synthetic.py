@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Chengye
+"""
+
+import math
+import numpy as np
+import pandas as pd
+
+def normCdf(x):
+    '''
+    Standard normal cdf, Abramowitz-Stegun approximation, accurate to 1e-7
+    '''
+    t = 1 / (1 + 0.2316419 * np.abs(x))
+    poly = t * (0.319381530 + t * (-0.356563782 + t * (1.781477937 +
+               t * (-1.821255978 + t * 1.330274429))))
+    upper = normPdf(x) * poly
+    return np.where(x >= 0, 1 - upper, upper)
+
+def normPdf(x):
+    return np.exp(-0.5 * x * x) / math.sqrt(2 * math.pi)
+
+def tickerNames(nTickers):
+    '''
+    Distinct 3 to 4 letter tickers, AAA, AAB, ...
+    '''
+    letters = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+    names = []
+    for i in range(nTickers):
+        name = ''
+        n = i
+        for j in range(3 if nTickers <= 26 ** 3 else 4):
+            name = letters[n % 26] + name
+            n //= 26
+        names.append(name)
+    return names
+
+def listedExpiries(date, nExpiries):
+    '''
+    The next nExpiries Friday expiries on or after date
+    '''
+    firstFriday = date + pd.Timedelta(days=(4 - date.weekday()) % 7)
+    return [firstFriday + pd.Timedelta(weeks=k) for k in range(nExpiries)]
+
+def generateOptions(nTickers=20, nStrikes=10, nExpiries=4, nDays=60,
+                    startDate='2019-01-02', seed=0):
+    '''
+    Generate a deterministic synthetic option chain history with the same
+    columns as option_sample.csv
+
+    Each ticker follows a geometric brownian motion. Every business day lists
+    calls and puts on a fixed strike grid for the next nExpiries weekly Friday
+    expiries, so options expire on Fridays and a new expiry is listed the next
+    day. Prices and Greeks are Black-Scholes with a constant vol per ticker,
+    signals are random +1/-1.
+
+    Parameters:
+    nTickers -- number of underlying tickers
+    nStrikes -- number of strikes per expiry
+    nExpiries -- number of listed weekly expiries
+    nDays -- number of business days
+    startDate -- first date
+    seed -- random seed
+
+    Returns:
+    dataFrame of options, rows grouped by date in ascending order
+    '''
+    rng = np.random.default_rng(seed)
+    tickers = tickerNames(nTickers)
+    dates = pd.bdate_range(startDate, periods=nDays)
+    spot0 = rng.uniform(20, 500, nTickers)
+    vols = rng.uniform(0.2, 0.6, nTickers)
+    # daily log returns of the spots
+    returns = rng.normal(-0.5 * vols ** 2 / 252, vols / math.sqrt(252), (nDays, nTickers))
+    returns[0] = 0
+    spots = np.round(spot0 * np.exp(np.cumsum(returns, axis=0)), 2)
+    # strike grid around the initial spot, rounded to 0.5
+    strikeSteps = np.linspace(-0.2, 0.2, nStrikes)
+    strikes = np.round(spot0[:, None] * (1 + strikeSteps[None, :]) * 2) / 2
+    symbolCache = {}
+    frames = []
+    for d, date in enumerate(dates):
+        expiries = listedExpiries(date, nExpiries)
+        # rows: ticker x expiry x strike x call/put
+        tickerIds = np.repeat(np.arange(nTickers), nExpiries * nStrikes * 2)
+        expiryIds = np.tile(np.repeat(np.arange(nExpiries), nStrikes * 2), nTickers)
+        strikeIds = np.tile(np.repeat(np.arange(nStrikes), 2), nTickers * nExpiries)
+        isCall = np.tile([True, False], nTickers * nExpiries * nStrikes)
+        symbols = []
+        for expiry in expiries:
+            if expiry not in symbolCache:
+                symbolCache[expiry] = [
+                        ['%s%s%s%08d' % (ticker, expiry.strftime('%y%m%d'), cp,
+                                         int(round(strike * 1000)))
+                         for strike in strikes[t] for cp in 'CP']
+                        for t, ticker in enumerate(tickers)]
+        for t in range(nTickers):
+            for expiry in expiries:
+                symbols.extend(symbolCache[expiry][t])
+        spot = spots[d, tickerIds]
+        strike = strikes[tickerIds, strikeIds]
+        vol = vols[tickerIds]
+        days = np.array([(expiry - date).days for expiry in expiries])[expiryIds]
+        T = np.maximum(days, 0) / 365.0
+        sqrtT = np.sqrt(T)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            d1 = (np.log(spot / strike) + 0.5 * vol ** 2 * T) / (vol * sqrtT)
+        d1 = np.where(T > 0, d1, np.where(spot > strike, np.inf, -np.inf))
+        d2 = d1 - vol * sqrtT
+        callPrice = spot * normCdf(d1) - strike * normCdf(d2)
+        callDelta = normCdf(d1)
+        price = np.where(isCall, callPrice, callPrice - spot + strike)
+        delta = np.where(isCall, callDelta, callDelta - 1)
+        vega = np.where(T > 0, spot * normPdf(np.where(T > 0, d1, 0)) * sqrtT, 0)
+        frames.append(pd.DataFrame({
+                'UnderlyingSymbol': np.array(tickers, dtype=object)[tickerIds],
+                'UnderlyingPrice': spot,
+                'OptionSymbol': np.array(symbols, dtype=object),
+                'DataDate': date,
+                'Last': np.round(np.maximum(price, 0), 2),
+                'Delta': np.round(delta, 4),
+                'Vega': np.round(vega, 4),
+                'Multiplier': 100,
+                'Signal': rng.choice([-1, 1], len(spot))}))
+    return pd.concat(frames, ignore_index=True)
+
+def generateTrades(optionData, fillsPerDay=500, seed=0):
+    '''
+    Generate a deterministic synthetic trade blotter for an option history
+
+    Every date but the first gets fillsPerDay fills on options that were
+    already listed the day before and do not expire that day, at random
+    times between 9:30 and 16:00, near the option's closing price.
+
+    Parameters:
+    optionData -- dataFrame of options, e.g. from generateOptions
+    fillsPerDay -- number of fills per date
+    seed -- random seed
+
+    Returns:
+    dataFrame with the same columns as trade_sample.csv, times as strings
+    '''
+    rng = np.random.default_rng(seed)
+    frames = []
+    previous = None
+    for date, chain in optionData.groupby('DataDate', sort=True):
+        symbols = set(chain['OptionSymbol'])
+        if previous is not None:
+            candidates = chain.loc[chain['OptionSymbol'].isin(previous).to_numpy() &
+                                   (chain['Delta'].abs() < 0.99).to_numpy()]
+            if len(candidates) > 0:
+                pick = candidates.iloc[rng.integers(0, len(candidates), fillsPerDay)]
+                seconds = np.sort(rng.integers(9 * 3600 + 1800, 16 * 3600, fillsPerDay))
+                quantity = rng.integers(1, 11, fillsPerDay) * rng.choice([-1, 1], fillsPerDay)
+                frames.append(pd.DataFrame({
+                        'Date': date,
+                        'Time': ['%d:%02d:%02d' % (s // 3600, s // 60 % 60, s % 60)
+                                 for s in seconds.tolist()],
+                        'OptionSymbol': pick['OptionSymbol'].to_numpy(),
+                        'Price': np.round(np.maximum(pick['Last'].to_numpy() *
+                                          (1 + rng.normal(0, 0.05, fillsPerDay)), 0.01), 2),
+                        'Vega': pick['Vega'].to_numpy(),
+                        'Quantity': quantity}))
+        previous = symbols
+    return pd.concat(frames, ignore_index=True)
+
+def writeCsv(optionData, tradeData, optionFileName, tradeFileName):
+    '''
+    Write synthetic data as csv files in the same format as the sample files
+    '''
+    optionData = optionData.copy()
+    optionData['DataDate'] = optionData['DataDate'].dt.strftime('%m/%d/%Y')
+    optionData.to_csv(optionFileName, index=False)
+    tradeData = tradeData.copy()
+    tradeData['Date'] = pd.to_datetime(tradeData['Date']).dt.strftime('%m/%d/%Y')
+    tradeData.to_csv(tradeFileName, index=False)
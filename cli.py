@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Chengye
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+
+'''
+Command line entry point of the backtester.
+
+Only the standard library is imported at start up, numpy, pandas and the
+backtest modules are imported once the arguments are parsed, so --help and
+argument errors return at once.
+
+One-shot mode runs one backtest and writes its results:
+    python cli.py --optionFile option_sample.csv --tradeFile trade_sample.csv
+                  --start 2019-08-22 --vegaLimit 5000 --format npz --output results
+
+Daemon mode (--daemon stdin or --daemon socket) loads the data once and
+then runs backtest jobs, one json object per line, e.g.
+    {"vegaLimit": 2000, "cost": 0.001, "agreeTypes": [true], "end": "2019-08-28"}
+Missing keys default to the command line arguments. Each job is answered
+with one json line holding the summary metrics of each agree type, or an
+"error" message. {"command": "stop"} stops the daemon. The socket listens
+on a local tcp port, one client is served at a time.
+'''
+
+# default data files, next to the library
+libraryPath = os.path.abspath(os.path.dirname(__file__))
+
+# job keys and the command line arguments they default to
+jobKeys = ['vegaLimit', 'ir', 'cost', 'agreeTypes', 'start', 'end', 'output', 'format']
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description='Backtest of option portfolios')
+    parser.add_argument('--optionFile', default=os.path.join(libraryPath, 'option_sample.csv'))
+    parser.add_argument('--tradeFile', default=os.path.join(libraryPath, 'trade_sample.csv'))
+    parser.add_argument('--cacheDir', default=None,
+                        help='directory of the binary column caches of the csv files')
+    parser.add_argument('--start', default=None, help='first date of the backtest')
+    parser.add_argument('--end', default=None, help='last date of the backtest')
+    parser.add_argument('--vegaLimit', type=float, default=5000)
+    parser.add_argument('--ir', type=float, default=0.015)
+    parser.add_argument('--cost', type=float, default=0.005)
+    parser.add_argument('--agreeType', nargs='+', default=['True', 'False'],
+                        choices=['True', 'False'])
+    parser.add_argument('--eodMode', default='vectorized',
+                        choices=['vectorized', 'loop', 'sharded'])
+    parser.add_argument('--output', default=libraryPath,
+                        help='directory of the results, empty to write no results')
+    parser.add_argument('--format', default='csv', choices=['csv', 'npz', 'parquet'])
+    parser.add_argument('--daemon', default=None, choices=['stdin', 'socket'],
+                        help='keep the data loaded and run json jobs from stdin '
+                             'or a local socket')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9200)
+    parser.add_argument('--logLevel', default='WARNING')
+    return parser.parse_args(argv)
+
+def defaultJob(args):
+    '''
+    Job of the command line arguments
+    '''
+    return {'vegaLimit': args.vegaLimit, 'ir': args.ir, 'cost': args.cost,
+            'agreeTypes': [agreeType == 'True' for agreeType in args.agreeType],
+            'start': args.start, 'end': args.end, 'output': args.output,
+            'format': args.format}
+
+def dateRangeOf(start, end):
+    ''' (start, end) date range, None if neither is given '''
+    return None if start is None and end is None else (start, end)
+
+def loadBackTest(args, dateRange=None):
+    '''
+    Read the data and build the BackTest, imports the backtest modules
+
+    Parameters:
+    args -- parsed command line arguments
+    dateRange -- (start, end) tuple of dates to read, None to read all dates
+    '''
+    from backTester import BackTest, readData
+    optionData, tradeData = readData(args.optionFile, args.tradeFile, args.cacheDir,
+                                     dateRange=dateRange)
+    return BackTest(optionData, tradeData, args.vegaLimit, args.ir, args.cost,
+                    eodMode=args.eodMode)
+
+def runJob(bt, job):
+    '''
+    Run the backtest of a job and write its results
+
+    Parameters:
+    bt -- BackTest object
+    job -- dictionary with the keys of jobKeys
+
+    Returns:
+    dictionary with the summary metrics of each agree type and the run time
+    '''
+    from evaluation import Metrics
+    from instrumentation import Instrumentation
+    from resultSink import makeSink
+    unknown = set(job) - set(jobKeys)
+    if unknown:
+        raise ValueError("Unknown job keys %s" % sorted(unknown))
+    start = time.perf_counter()
+    agreeTypes = job['agreeTypes']
+    instrument = Instrumentation()
+    specs = [{'agreeType': bool(agreeType), 'vegaLimit': job['vegaLimit'],
+              'ir': job['ir'], 'cost': job['cost']} for agreeType in agreeTypes]
+    logging.info("Backtesting for agreeTypes = %r", agreeTypes)
+    results = bt.runMany(specs, instrument, dateRangeOf(job['start'], job['end']))
+    summary = []
+    sink = None
+    if job['output']:
+        os.makedirs(job['output'], exist_ok=True)
+        sink = makeSink(job['output'], job['format'])
+    try:
+        for spec, (portfolioPnls, contractTotPnl) in zip(specs, results):
+            with instrument.stage('metrics'):
+                maxDrawdown, longestUnprofit = Metrics.calcDrawdowns(portfolioPnls['DailyTotPnl'])
+                sharpeRatio = Metrics.calcSharpeRatio(portfolioPnls['DailyTotPnl'])
+            metrics = {'maxDrawDown': maxDrawdown,
+                       'longestUnprofitDays': longestUnprofit,
+                       'sharpeRatio': sharpeRatio}
+            if sink is not None:
+                sink.write(spec if job['format'] != 'csv' else {'agreeType': spec['agreeType']},
+                           portfolioPnls, contractTotPnl, metrics)
+            row = dict(spec, totPnl=float(portfolioPnls['CumTotPnl'].iloc[-1])
+                       if len(portfolioPnls) else 0.0)
+            row.update({key: float(value) for key, value in metrics.items()})
+            summary.append(row)
+    finally:
+        if sink is not None:
+            sink.close()
+    logging.info("Stage timings:\n%s", instrument.summary())
+    return {'results': summary, 'elapsed': time.perf_counter() - start}
+
+def handleLine(bt, defaults, line):
+    '''
+    Run the job of a json line
+
+    Returns:
+    json reply line, None for the stop command
+    '''
+    try:
+        request = json.loads(line)
+        if request.get('command') == 'stop':
+            return None
+        reply = runJob(bt, dict(defaults, **request))
+    except Exception as e:
+        logging.exception("Job failed: %s", line.strip())
+        reply = {'error': '%s: %s' % (type(e).__name__, e)}
+    return json.dumps(reply)
+
+def serveStdin(bt, defaults, stdin=None, stdout=None):
+    '''
+    Run the jobs of stdin, one json line each, until the stop command or
+    the end of stdin
+    '''
+    stdin = stdin if stdin is not None else sys.stdin
+    stdout = stdout if stdout is not None else sys.stdout
+    for line in stdin:
+        if not line.strip():
+            continue
+        reply = handleLine(bt, defaults, line)
+        if reply is None:
+            break
+        stdout.write(reply + '\n')
+        stdout.flush()
+
+def serveSocket(bt, defaults, host, port):
+    '''
+    Run the jobs sent to a local tcp socket, one json line each,
+    until a client sends the stop command
+    '''
+    import socketserver
+
+    class JobHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                line = line.decode()
+                if not line.strip():
+                    continue
+                reply = handleLine(bt, defaults, line)
+                if reply is None:
+                    self.server.stopped = True
+                    break
+                self.wfile.write((reply + '\n').encode())
+                self.wfile.flush()
+
+    socketserver.TCPServer.allow_reuse_address = True
+    with socketserver.TCPServer((host, port), JobHandler) as server:
+        server.stopped = False
+        logging.warning("Serving backtest jobs on %s:%d", host, server.server_address[1])
+        while not server.stopped:
+            server.handle_request()
+
+def main(argv=None):
+    args = parseArgs(argv)
+    logging.getLogger().setLevel(args.logLevel.upper())
+    defaults = defaultJob(args)
+    if args.daemon is None:
+        bt = loadBackTest(args, dateRangeOf(args.start, args.end))
+        runJob(bt, defaults)
+        return
+    # jobs may run any date range, keep all the dates loaded
+    bt = loadBackTest(args)
+    if args.daemon == 'stdin':
+        serveStdin(bt, defaults)
+    else:
+        serveSocket(bt, defaults, args.host, args.port)
+
+if __name__ == '__main__':
+    main()
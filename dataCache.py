@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Chengye
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+import pandas as pd
+
+class ColumnCache(object):
+    '''
+    On-disk columnar cache of a csv file
+
+    The csv file is parsed once and every column is saved as a .npy file,
+    string columns as integer codes plus an array of unique values, date
+    columns as int64 nanoseconds. Rows are stored sorted by sortColumn, so a
+    date range is a contiguous slice. Later reads memory-map the .npy files.
+    The cache is keyed by the source path and invalidated automatically when
+    the source file's size or modification time changes.
+
+    Inputs:
+        fileName -- path of the source csv file
+        cacheDir -- directory holding the caches, default .cache next to the file
+        dateColumns -- list of columns to parse as dates
+        sortColumn -- column to sort the rows by, usually the date column
+    '''
+    def __init__(self, fileName, cacheDir=None, dateColumns=(), sortColumn=None):
+        self.fileName = os.path.abspath(fileName)
+        if cacheDir is None:
+            cacheDir = os.path.join(os.path.dirname(self.fileName), '.cache')
+        key = hashlib.sha1(self.fileName.encode('utf-8')).hexdigest()[:16]
+        self.path = os.path.join(cacheDir, '%s-%s' % (os.path.basename(fileName), key))
+        self.dateColumns = list(dateColumns)
+        self.sortColumn = sortColumn
+
+    def sourceStamp(self):
+        stat = os.stat(self.fileName)
+        # bump the version when the file layout changes, older caches are rebuilt
+        return {'version': 2, 'source': self.fileName, 'size': stat.st_size,
+                'mtime': stat.st_mtime_ns, 'dateColumns': self.dateColumns,
+                'sortColumn': self.sortColumn}
+
+    def readMeta(self):
+        try:
+            with open(os.path.join(self.path, 'meta.json')) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def isValid(self):
+        '''
+        True if the cache exists and was built from the current source file
+        '''
+        meta = self.readMeta()
+        return meta is not None and meta['stamp'] == self.sourceStamp()
+
+    def build(self):
+        '''
+        Parse the source csv file and write the cache
+        '''
+        stamp = self.sourceStamp()
+        data = pd.read_csv(self.fileName)
+        for col in self.dateColumns:
+            data[col] = pd.to_datetime(data[col])
+        if self.sortColumn is not None:
+            data = data.sort_values(self.sortColumn, kind='mergesort')
+        parent = os.path.dirname(self.path)
+        os.makedirs(parent, exist_ok=True)
+        # write to a temporary directory first, so readers never see a half cache
+        tempPath = tempfile.mkdtemp(dir=parent)
+        columns = []
+        for i, name in enumerate(data.columns):
+            values = data[name].to_numpy()
+            fileName = 'c%d' % i
+            if values.dtype.kind == 'M':
+                kind = 'datetime'
+                values = values.astype('datetime64[ns]').view(np.int64)
+            elif values.dtype == object:
+                kind = 'category'
+                codes, uniques = pd.factorize(values)
+                # plain strings are saved as a unicode array, mixed values
+                # (numbers, booleans) keep their types in an object array
+                if pd.api.types.infer_dtype(uniques, skipna=False) == 'string':
+                    uniques = np.asarray(uniques, dtype=str)
+                else:
+                    uniques = np.asarray(uniques, dtype=object)
+                np.save(os.path.join(tempPath, fileName + '.categories.npy'), uniques)
+                values = codes.astype(np.int32)
+            else:
+                kind = 'numeric'
+            np.save(os.path.join(tempPath, fileName + '.npy'), values)
+            columns.append({'name': name, 'file': fileName, 'kind': kind})
+        with open(os.path.join(tempPath, 'meta.json'), 'w') as f:
+            json.dump({'stamp': stamp, 'length': len(data), 'columns': columns}, f)
+        self.publish(tempPath, stamp)
+
+    def publish(self, tempPath, stamp):
+        '''
+        Move a finished build into place. Other processes may be building or
+        reading the same cache at the same time: a stale cache is renamed
+        aside before it is removed, and a cache of the same source stamp
+        finished by another build first is kept.
+        '''
+        for attempt in range(10):
+            try:
+                # fails if a cache directory is already in place
+                os.rename(tempPath, self.path)
+                return
+            except OSError as e:
+                error = e
+            meta = self.readMeta()
+            if meta is not None and meta['stamp'] == stamp:
+                shutil.rmtree(tempPath, ignore_errors=True)
+                return
+            oldPath = tempPath + '.old'
+            try:
+                os.rename(self.path, oldPath)
+            except FileNotFoundError:
+                # another build moved it aside first, or it was never there
+                continue
+            shutil.rmtree(oldPath, ignore_errors=True)
+        raise error
+
+    def read(self, columns=None, dateRange=None):
+        '''
+        Read the cached data, build or rebuild the cache first if needed
+
+        Parameters:
+        columns -- list of columns to load, default all columns
+        dateRange -- (start, end) tuple of dates, inclusive, to select rows by
+                     sortColumn, None for no limit on either side
+
+        Returns:
+        dataFrame, numeric and date columns are memory-mapped
+        '''
+        if not self.isValid():
+            self.build()
+        meta = self.readMeta()
+        rows = slice(0, meta['length'])
+        if dateRange is not None and self.sortColumn is not None:
+            sortInfo = [c for c in meta['columns'] if c['name'] == self.sortColumn][0]
+            keys = np.load(os.path.join(self.path, sortInfo['file'] + '.npy'), mmap_mode='r')
+            start, end = dateRange
+            first = 0 if start is None else np.searchsorted(
+                    keys, pd.Timestamp(start).value, side='left')
+            last = len(keys) if end is None else np.searchsorted(
+                    keys, pd.Timestamp(end).value, side='right')
+            rows = slice(int(first), int(last))
+        data = {}
+        for info in meta['columns']:
+            if columns is not None and info['name'] not in columns:
+                continue
+            values = np.load(os.path.join(self.path, info['file'] + '.npy'),
+                             mmap_mode='r')[rows]
+            if info['kind'] == 'datetime':
+                values = values.view('datetime64[ns]')
+            elif info['kind'] == 'category':
+                uniques = np.load(os.path.join(self.path, info['file'] + '.categories.npy'),
+                                  allow_pickle=True)
+                codes = values
+                values = uniques.astype(object).take(codes)
+                # missing values are stored as code -1
+                missing = codes < 0
+                if missing.any():
+                    values[missing] = np.nan
+            data[info['name']] = values
+        return pd.DataFrame(data, copy=False)
@@ -2,6 +2,8 @@
 """
 @author: Chengye
 """
+import math
+from collections import deque
 import pandas as pd
 import numpy as np
 
@@ -44,3 +46,276 @@ class Metrics():
             negative_dd).ffill().fillna(0).astype(int))
 
         return dd.min(), dd_duration.max()
+    
+    def calcRollingMetrics(pnls, window, periods=252):
+        """
+        Sharpe ratio, drawdown and max drawdown of the trailing window of
+        each day, computed on each window's pnls alone. The reference of 
+        RollingMetrics, which gives the same values one day at a time.
+        
+        Parameters:
+        pnls -- A pandas Series representing daily dollar pnls
+        window -- number of days in the window
+        periods -- number of periods in one year.
+        
+        Returns:
+        dataFrame indexed like pnls with columns sharpeRatio, drawdown and 
+        maxDrawDown
+        """
+        rolling = pnls.rolling(window, min_periods=1)
+        
+        def drawdowns(values):
+            cumPnls = values.cumsum()
+            return cumPnls - np.maximum.accumulate(cumPnls)
+        
+        return pd.DataFrame({
+            'sharpeRatio': np.sqrt(periods) * rolling.mean() / rolling.std(ddof=0),
+            'drawdown': rolling.apply(lambda values: drawdowns(values)[-1], raw=True),
+            'maxDrawDown': rolling.apply(lambda values: drawdowns(values).min(), raw=True)})
+
+
+class OnlineMetrics():
+    """
+    Incremental pnl metrics, updated with one daily pnl at a time in O(1)
+    time and memory. Gives the same metrics as Metrics.calcSharpeRatio and
+    Metrics.calcDrawdowns on the series of all pnls seen so far: mean and
+    population variance are kept with Welford's method, drawdowns against
+    the running peak of the cumulative pnl, which starts at the first day.
+    
+    Inputs:
+        periods -- number of periods in one year
+    """
+    # state kept in checkpoints, in this order
+    stateFields = ['n', 'mean', 'm2', 'cumPnl', 'peak', 'drawdown', 
+                   'maxDrawdown', 'streak', 'longestStreak']
+    
+    def __init__(self, periods=252):
+        self.periods = periods
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.cumPnl = 0.0
+        self.peak = 0.0
+        self.drawdown = 0.0
+        self.maxDrawdown = 0.0
+        self.streak = 0
+        self.longestStreak = 0
+    
+    def update(self, pnl):
+        """
+        Add one daily pnl
+        """
+        self.n += 1
+        delta = pnl - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (pnl - self.mean)
+        self.cumPnl += pnl
+        if self.n == 1 or self.cumPnl > self.peak:
+            self.peak = self.cumPnl
+        self.drawdown = self.cumPnl - self.peak
+        if self.drawdown < self.maxDrawdown:
+            self.maxDrawdown = self.drawdown
+        if self.drawdown < 0:
+            self.streak += 1
+            if self.streak > self.longestStreak:
+                self.longestStreak = self.streak
+        else:
+            self.streak = 0
+    
+    def sharpeRatio(self):
+        """
+        Annualized sharpe ratio of the pnls so far, nan before the first pnl
+        """
+        if self.n == 0:
+            return np.nan
+        std = math.sqrt(self.m2 / self.n)
+        if std == 0:
+            return np.sign(self.mean) * np.inf if self.mean != 0 else np.nan
+        return math.sqrt(self.periods) * self.mean / std
+    
+    def drawdowns(self):
+        """
+        Max drawdown and longest unprofitable period (days) so far, 
+        as returned by Metrics.calcDrawdowns
+        """
+        return self.maxDrawdown, self.longestStreak
+    
+    def getState(self):
+        """
+        State as an array of floats, to be saved in a checkpoint
+        """
+        return np.array([getattr(self, name) for name in self.stateFields], 
+                        dtype=np.float64)
+    
+    @classmethod
+    def fromState(cls, state, periods=252):
+        """
+        Restore metrics from an array returned by getState
+        """
+        metrics = cls(periods)
+        for name, value in zip(cls.stateFields, state.tolist()):
+            setattr(metrics, name, value)
+        metrics.n = int(metrics.n)
+        metrics.streak = int(metrics.streak)
+        metrics.longestStreak = int(metrics.longestStreak)
+        return metrics
+
+
+class RollingMetrics():
+    """
+    Incremental pnl metrics over a trailing window of days
+    
+    The rolling sharpe ratio uses Welford's method with removal of the pnl
+    leaving the window. The rolling drawdown of the last day is its 
+    cumulative pnl less the highest cumulative pnl of the window, kept with
+    a monotonic deque. The rolling max drawdown is the max drawdown of the
+    pnls of the window alone, with peaks inside the window only, i.e. in 
+    pandas for the window's pnls w
+        maxDrawdown = (w.cumsum() - w.cumsum().cummax()).min()
+    The cumulative pnls of the window are kept in a queue of two stacks 
+    holding the (peak, low, max drawdown) of their elements, which combine
+    in order, so an update costs O(1) amortized time and the memory is 
+    O(window).
+    
+    Inputs:
+        window -- number of days in the window
+        periods -- number of periods in one year
+    """
+    def __init__(self, window, periods=252):
+        if window < 1:
+            raise ValueError("window must be at least 1, got %r" % window)
+        self.window = window
+        self.periods = periods
+        self.day = 0
+        self.cumPnl = 0.0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.pnls = deque()
+        # (day, cumPnl) with decreasing cumPnl, front is the window's peak
+        self.peaks = deque()
+        # queue of the window's cumulative pnls: front holds the oldest ones 
+        # as (cumPnl, peak, low, maxDrawdown) of the elements from it to the 
+        # end of front, its last entry is the oldest day; back holds the 
+        # newer ones with their (peak, low, maxDrawdown) in backSummary
+        self.front = []
+        self.back = []
+        self.backSummary = None
+    
+    def update(self, pnl):
+        """
+        Add one daily pnl, dropping the pnl that leaves the window
+        """
+        day = self.day
+        self.day += 1
+        # sharpe ratio of the window
+        self.pnls.append(pnl)
+        n = len(self.pnls)
+        delta = pnl - self.mean
+        self.mean += delta / n
+        self.m2 += delta * (pnl - self.mean)
+        if n > self.window:
+            old = self.pnls.popleft()
+            n -= 1
+            delta = old - self.mean
+            self.mean -= delta / n
+            self.m2 -= delta * (old - self.mean)
+        # peak of the cumulative pnl over the window
+        self.cumPnl += pnl
+        while self.peaks and self.peaks[-1][1] <= self.cumPnl:
+            self.peaks.pop()
+        self.peaks.append((day, self.cumPnl))
+        if self.peaks[0][0] <= day - self.window:
+            self.peaks.popleft()
+        # cumulative pnls of the window
+        self.back.append(self.cumPnl)
+        self.backSummary = combineDrawdowns(
+                self.backSummary, (self.cumPnl, self.cumPnl, 0.0))
+        if len(self.front) + len(self.back) > self.window:
+            if not self.front:
+                summary = None
+                for cumPnl in reversed(self.back):
+                    summary = combineDrawdowns((cumPnl, cumPnl, 0.0), summary)
+                    self.front.append((cumPnl,) + summary)
+                self.back = []
+                self.backSummary = None
+            self.front.pop()
+    
+    def sharpeRatio(self):
+        """
+        Annualized sharpe ratio of the pnls in the window
+        """
+        n = len(self.pnls)
+        if n == 0:
+            return np.nan
+        std = math.sqrt(max(self.m2, 0.0) / n)
+        if std == 0:
+            return np.sign(self.mean) * np.inf if self.mean != 0 else np.nan
+        return math.sqrt(self.periods) * self.mean / std
+    
+    def drawdown(self):
+        """
+        Rolling drawdown of the last day
+        """
+        return self.cumPnl - self.peaks[0][1] if self.peaks else 0.0
+    
+    def maxDrawdown(self):
+        """
+        Max drawdown of the pnls in the window
+        """
+        summary = combineDrawdowns(self.front[-1][1:] if self.front else None,
+                                   self.backSummary)
+        return summary[2] if summary is not None else 0.0
+    
+    def windowCumPnls(self):
+        """
+        Cumulative pnls of the days in the window, oldest first
+        """
+        return [entry[0] for entry in reversed(self.front)] + self.back
+    
+    def getState(self):
+        """
+        State as a dictionary of arrays, to be saved in a checkpoint
+        """
+        return {'scalars': np.array([self.window, self.day, self.cumPnl, 
+                                     self.mean, self.m2], dtype=np.float64),
+                'pnls': np.array(self.pnls, dtype=np.float64),
+                'peaks': np.array(self.peaks, dtype=np.float64).reshape(-1, 2),
+                'cumPnls': np.array(self.windowCumPnls(), dtype=np.float64)}
+    
+    @classmethod
+    def fromState(cls, state, periods=252):
+        """
+        Restore metrics from a dictionary returned by getState
+        """
+        window, day, cumPnl, mean, m2 = state['scalars'].tolist()
+        metrics = cls(int(window), periods)
+        metrics.day = int(day)
+        metrics.cumPnl = cumPnl
+        metrics.mean = mean
+        metrics.m2 = m2
+        metrics.pnls = deque(state['pnls'].tolist())
+        metrics.peaks = deque((int(d), v) for d, v in state['peaks'].tolist())
+        if 'cumPnls' in state:
+            cumPnls = state['cumPnls'].tolist()
+        else:
+            # older checkpoints, rebuild the window from its pnls
+            pnls = np.array(metrics.pnls)
+            cumPnls = (cumPnl - np.r_[np.cumsum(pnls[::-1])[::-1][1:], 0.0]).tolist()
+        for cumPnl in cumPnls:
+            metrics.back.append(cumPnl)
+            metrics.backSummary = combineDrawdowns(metrics.backSummary, 
+                                                   (cumPnl, cumPnl, 0.0))
+        return metrics
+
+
+def combineDrawdowns(first, second):
+    """
+    Combine the (peak, low, maxDrawdown) of the cumulative pnls of two 
+    consecutive runs of days, None for no days
+    """
+    if first is None:
+        return second
+    if second is None:
+        return first
+    return (max(first[0], second[0]), min(first[1], second[1]),
+            min(first[2], second[2], second[1] - first[0]))
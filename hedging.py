@@ -0,0 +1,465 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Chengye
+"""
+
+import os
+import json
+import numpy as np
+import pandas as pd
+from admission import admitTrades, ACCEPTED, UNKNOWN_SYMBOL, AGREE_TYPE_MISMATCH
+from evaluation import Metrics
+from positionBook import parseOptionSymbols, dayNumber, NO_EXPIRY
+
+'''
+What-if hedging: evaluate hedge policies and signal lags on precomputed
+(day x contract) matrices instead of replaying the portfolio objects.
+
+Trade admission only depends on the signals and option vegas, never on
+the stock hedge, so the option positions of a portfolio are independent of
+its hedge policy. They are replayed once into a (day x contract) position
+matrix with replayPositions, per agree type, vega limit and signal lag.
+A HedgePolicy then turns the (day x stock) option delta matrix into
+(day x stock) stock positions with array operations, and HedgeEvaluator
+gives the daily hedge pnl, cost and turnover of any number of policies.
+
+    matrices = MarketMatrices.build(bt.optionSource)
+    positions = replayPositions(matrices, bt, agreeType=True, vegaLimit=5000)
+    evaluator = HedgeEvaluator(matrices, positions)
+    evaluator.compare([FullHedge(), BandHedge(50), PeriodicHedge(5),
+                       PartialHedge(0.5)], basePnls=dailyPnls)
+'''
+
+class MarketMatrices(object):
+    '''
+    Aligned (day x contract) matrices of an option history
+
+    Contracts are the union of the option symbols of all dates, ordered by
+    underlying (position in stockList) then symbol, so each underlying's
+    contracts are a contiguous range of columns. price, spot, delta and vega
+    carry a contract's last marks forward over the days it is missing, as
+    the position book does; signal is nan when the contract is not listed
+    and listed tells which contracts are in each day's chain. stockSpot is
+    the (day x stock) spot of each underlying, carried forward as well.
+
+    With a path the matrices are .npy files in that directory, memory-mapped
+    when read, so histories larger than memory can be used. Open them again
+    with MarketMatrices.open(path).
+
+    Inputs:
+        dates -- list of dates, one per matrix row
+        tickers -- list of underlying tickers
+        symbols -- array of option symbols, one per matrix column
+        stockIds -- array of int, underlying of each contract
+        multiplier -- array of contract multipliers
+        matrices -- dictionary of the matrices listed in matrixNames
+    '''
+    matrixNames = ['listed', 'price', 'spot', 'delta', 'vega', 'signal', 'stockSpot']
+
+    def __init__(self, dates, tickers, symbols, stockIds, multiplier, matrices):
+        self.dates = list(dates)
+        self.tickers = list(tickers)
+        self.symbols = np.asarray(symbols, dtype=object)
+        self.stockIds = np.asarray(stockIds, dtype=np.int64)
+        self.multiplier = np.asarray(multiplier, dtype=np.float64)
+        for name in self.matrixNames:
+            setattr(self, name, matrices[name])
+        self.columnIndex = pd.Index(self.symbols)
+        self.dayNumbers = np.array([dayNumber(date) for date in self.dates], dtype=np.int64)
+        self.expiry = parseOptionSymbols(self.symbols)['expiry'].to_numpy()
+        # first column of each stock's contracts, the last bound is nContracts
+        self.stockBounds = np.searchsorted(self.stockIds, np.arange(len(self.tickers) + 1))
+
+    @property
+    def shape(self):
+        return len(self.dates), len(self.symbols)
+
+    @classmethod
+    def build(cls, optionSource, dates=None, path=None):
+        '''
+        Build the matrices from an option source, in two passes over the
+        chains: the first collects the contracts, the second fills the rows
+
+        Parameters:
+        optionSource -- OptionSnapshotIndex, CsvOptionSource or
+                        PartitionedOptionSource, e.g. BackTest.optionSource
+        dates -- list of dates in date order, default all dates of the source
+        path -- directory to write memory-mapped matrices to, None to keep
+                them in memory
+
+        Returns:
+        MarketMatrices object
+        '''
+        tickers = list(optionSource.tickers)
+        tickerIndex = pd.Index(tickers)
+
+        def stockIdsOf(chain):
+            # position in tickers of each option's underlying
+            return tickerIndex.get_indexer(chain.tickers)[chain.underlyingIds]
+
+        # pass 1: contracts, their underlying and multiplier
+        contracts = {}
+        dateList = []
+        for chain in optionSource.iterChains(dates):
+            dateList.append(chain.date)
+            for symbol, stockId, multiplier in zip(
+                    chain.symbols.tolist(), stockIdsOf(chain).tolist(),
+                    chain.multiplier.tolist()):
+                contracts[symbol] = (stockId, multiplier)
+        symbols = sorted(contracts, key=lambda s: (contracts[s][0], s))
+        stockIds = np.array([contracts[s][0] for s in symbols], dtype=np.int64)
+        multiplier = np.array([contracts[s][1] for s in symbols], dtype=np.float64)
+        columnIndex = pd.Index(symbols)
+        nDays, nContracts, nStock = len(dateList), len(symbols), len(tickers)
+        matrices = {}
+        shapes = {'stockSpot': (nDays, nStock)}
+        for name in cls.matrixNames:
+            shape = shapes.get(name, (nDays, nContracts))
+            dtype = bool if name == 'listed' else np.float64
+            if path is None:
+                matrices[name] = np.zeros(shape, dtype=dtype)
+            else:
+                os.makedirs(path, exist_ok=True)
+                matrices[name] = np.lib.format.open_memmap(
+                        os.path.join(path, name + '.npy'), mode='w+', dtype=dtype, shape=shape)
+        # pass 2: fill each day's row, carrying the previous day's marks
+        marks = ['price', 'spot', 'delta', 'vega']
+        for d, chain in enumerate(optionSource.iterChains(dateList)):
+            columns = columnIndex.get_indexer(chain.symbols)
+            if d > 0:
+                for name in marks + ['stockSpot']:
+                    matrices[name][d] = matrices[name][d - 1]
+            matrices['signal'][d] = np.nan
+            matrices['listed'][d, columns] = True
+            matrices['price'][d, columns] = chain.price
+            matrices['spot'][d, columns] = chain.spot
+            matrices['delta'][d, columns] = chain.delta
+            matrices['vega'][d, columns] = chain.vega
+            matrices['signal'][d, columns] = chain.signal
+            # spot of the last option of each underlying, as the rehedge uses
+            matrices['stockSpot'][d, stockIdsOf(chain)] = chain.spot
+        if path is not None:
+            for matrix in matrices.values():
+                matrix.flush()
+            np.savez(os.path.join(path, 'contracts.npz'), symbols=np.array(symbols, dtype=str),
+                     stockIds=stockIds, multiplier=multiplier)
+            with open(os.path.join(path, 'meta.json'), 'w') as f:
+                json.dump({'dates': [str(pd.Timestamp(date)) for date in dateList],
+                           'tickers': tickers}, f)
+        return cls(dateList, tickers, symbols, stockIds, multiplier, matrices)
+
+    @classmethod
+    def open(cls, path):
+        '''
+        Open matrices written by build with a path, memory-mapped read-only
+        '''
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        with np.load(os.path.join(path, 'contracts.npz')) as contracts:
+            symbols = contracts['symbols'].astype(object)
+            stockIds = contracts['stockIds']
+            multiplier = contracts['multiplier']
+        matrices = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+                    for name in cls.matrixNames}
+        return cls([pd.Timestamp(date) for date in meta['dates']], meta['tickers'],
+                   symbols, stockIds, multiplier, matrices)
+
+    def byStock(self, matrix, blockDays=256):
+        '''
+        Sum a (day x contract) matrix over each underlying's contracts
+
+        Parameters:
+        matrix -- (day x contract) array, or a function of a slice of days
+                  returning the (days x contract) block, so that products of
+                  memory-mapped matrices are computed one block at a time
+        blockDays -- number of days per block
+
+        Returns:
+        (day x stock) array
+        '''
+        nDays = len(self.dates)
+        result = np.zeros((nDays, len(self.tickers)))
+        nonEmpty = np.flatnonzero(np.diff(self.stockBounds) > 0)
+        if len(nonEmpty) == 0:
+            return result
+        starts = self.stockBounds[nonEmpty]
+        for start in range(0, nDays, blockDays):
+            days = slice(start, min(start + blockDays, nDays))
+            block = matrix(days) if callable(matrix) else matrix[days]
+            result[days, nonEmpty] = np.add.reduceat(block, starts, axis=1)
+        return result
+
+def replayPositions(matrices, bt, agreeType, vegaLimit=None, signalLag=1, path=None):
+    '''
+    Replay the option positions of a portfolio on the matrices
+
+    Trades are admitted with the rules of Portfolio.handleTrades: the
+    contract must be in the previous day's chain, the trade must agree
+    (or disagree) with the contract's signal, and the total and per stock
+    vega limits are checked in trade order from the previous close's vegas.
+    Accepted trades of contracts in the day's chain are added to the
+    positions at the close, after the positions expiring since the previous
+    date are removed, as in Portfolio.updateEOD.
+
+    Parameters:
+    matrices -- MarketMatrices
+    bt -- BackTest holding the trades, its vegaLimit is the default
+    agreeType -- bool, see Portfolio
+    vegaLimit -- vega limit on stock and portfolio
+    signalLag -- number of days between the signal and the trades,
+                 1 uses the previous day's signal as the backtest does
+    path -- .npy file to write a memory-mapped position matrix to
+
+    Returns:
+    (day x contract) array of the positions held at each close
+    '''
+    if vegaLimit is None:
+        vegaLimit = bt.vegaLimit
+    nDays, nContracts = matrices.shape
+    nStock = len(matrices.tickers)
+    if path is None:
+        positions = np.zeros((nDays, nContracts))
+    else:
+        positions = np.lib.format.open_memmap(path, mode='w+', dtype=np.float64,
+                                              shape=(nDays, nContracts))
+    current = np.zeros(nContracts)
+    stockIds, multiplier = matrices.stockIds, matrices.multiplier
+    noExpiry = matrices.expiry == NO_EXPIRY
+    for d in range(1, nDays):
+        batch = bt.loadTrades(matrices.dates[d])
+        if len(batch) > 0:
+            columns = matrices.columnIndex.get_indexer(batch.symbols)
+            known = columns >= 0
+            known[known] = matrices.listed[d - 1, columns[known]]
+            if d - signalLag >= 0:
+                signal = np.where(known, matrices.signal[d - signalLag, columns], np.nan)
+            else:
+                signal = np.full(len(columns), np.nan)
+            known &= ~np.isnan(signal)
+            columns = np.where(known, columns, 0)
+            quantity = batch.quantities
+            reasons = np.full(len(columns), ACCEPTED, dtype=np.int64)
+            reasons[~known] = UNKNOWN_SYMBOL
+            agree = (quantity * signal > 0) == agreeType
+            reasons[known & ~agree] = AGREE_TYPE_MISMATCH
+            # vegas of the previous close
+            vega = current * matrices.vega[d - 1] * multiplier
+            stockVega = np.bincount(stockIds, weights=vega, minlength=nStock)
+            thisVega = quantity * batch.vegas * multiplier[columns]
+            admitTrades(thisVega, stockIds[columns], reasons, vega.sum(), stockVega,
+                        vegaLimit)
+            accepted = (reasons == ACCEPTED) & matrices.listed[d, columns]
+        # settle the positions expiring in [previous date, date)
+        expired = (matrices.expiry >= matrices.dayNumbers[d - 1]) & \
+                  (matrices.expiry < matrices.dayNumbers[d])
+        expired |= noExpiry & ~matrices.listed[d]
+        current[expired] = 0
+        if len(batch) > 0:
+            np.add.at(current, columns[accepted], quantity[accepted])
+        positions[d] = current
+    return positions
+
+class HedgePolicy(object):
+    '''
+    Base class of the hedge policies
+
+    A policy maps the (day x stock) delta of the option positions at each
+    close to the (day x stock) stock positions held after that close's
+    rehedge. Implement hedge() with array operations over the days and
+    stocks.
+    '''
+    name = 'hedge'
+
+    def hedge(self, optionDelta, stockSpot):
+        '''
+        Parameters:
+        optionDelta -- (day x stock) array of option delta at each close
+        stockSpot -- (day x stock) array of spots at each close
+
+        Returns:
+        (day x stock) array of stock positions after each close
+        '''
+        raise NotImplementedError
+
+    def __repr__(self):
+        return self.name
+
+class FullHedge(HedgePolicy):
+    '''
+    Rehedge all the delta at every close, as Portfolio.updateGreeksAndRehedge
+    '''
+    name = 'full'
+
+    def hedge(self, optionDelta, stockSpot):
+        return -optionDelta
+
+class PartialHedge(HedgePolicy):
+    '''
+    Hedge a fixed ratio of the delta at every close
+
+    Inputs:
+        ratio -- hedge ratio, 1 is a full hedge
+    '''
+    def __init__(self, ratio):
+        self.ratio = ratio
+        self.name = 'partial(%g)' % ratio
+
+    def hedge(self, optionDelta, stockSpot):
+        return -self.ratio * optionDelta
+
+class PeriodicHedge(HedgePolicy):
+    '''
+    Rehedge all the delta every period days, hold the hedge in between
+
+    Inputs:
+        period -- number of days between rehedges
+        offset -- first rehedge day
+    '''
+    def __init__(self, period, offset=0):
+        self.period = period
+        self.offset = offset
+        self.name = 'periodic(%d)' % period
+
+    def hedge(self, optionDelta, stockSpot):
+        days = np.arange(len(optionDelta))
+        # last rehedge day on or before each day, -1 before the first one
+        rehedgeDay = np.where(days >= self.offset,
+                              self.offset + (days - self.offset) // self.period * self.period,
+                              -1)
+        stockPosition = -optionDelta[np.maximum(rehedgeDay, 0)]
+        stockPosition[rehedgeDay < 0] = 0
+        return stockPosition
+
+class BandHedge(HedgePolicy):
+    '''
+    Rehedge a stock only when its net delta leaves a band around zero
+
+    The band is checked at every close, vectorized over the stocks. A stock
+    whose option delta plus stock position is outside the band is hedged
+    back to the edge of the band, or to zero with toCenter.
+
+    Inputs:
+        band -- half width of the band, in shares, or in dollar delta
+                (shares times spot) with dollar
+        toCenter -- rehedge to zero net delta instead of the band edge
+        dollar -- band in dollar delta
+    '''
+    def __init__(self, band, toCenter=False, dollar=False):
+        self.band = band
+        self.toCenter = toCenter
+        self.dollar = dollar
+        self.name = 'band(%g%s)' % (band, '$' if dollar else '')
+
+    def hedge(self, optionDelta, stockSpot):
+        stockPosition = np.zeros(optionDelta.shape)
+        held = np.zeros(optionDelta.shape[1])
+        for d in range(len(optionDelta)):
+            band = self.band / np.where(stockSpot[d] > 0, stockSpot[d], np.inf) \
+                   if self.dollar else self.band
+            net = optionDelta[d] + held
+            outside = np.abs(net) > band
+            if self.toCenter:
+                target = -optionDelta[d]
+            else:
+                target = -optionDelta[d] + np.sign(net) * band
+            held = np.where(outside, target, held)
+            stockPosition[d] = held
+        return stockPosition
+
+class HedgeEvaluator(object):
+    '''
+    Evaluate hedge policies on a replayed position matrix
+
+    The option delta of each stock is computed once. A policy's daily hedge
+    pnl is the previous close's stock positions times the spot change,
+    its cost is stockCost times the traded value of each rehedge.
+
+    The backtest books the hedge pnl of each option position against the
+    option's own spot, and none for positions expiring or missing from the
+    day's chain. That booked hedge pnl is computed once as well, so the
+    full hedge of the backtest can be swapped for a policy's hedge, see
+    compare.
+
+    Inputs:
+        matrices -- MarketMatrices
+        positions -- (day x contract) position matrix, see replayPositions
+        stockCost -- transaction cost ratio of the stock trades, the backtest
+                     assumes none for rehedges
+        blockDays -- number of days of the matrices processed at a time
+    '''
+    def __init__(self, matrices, positions, stockCost=0, blockDays=256):
+        self.matrices = matrices
+        self.stockCost = stockCost
+        multiplier = matrices.multiplier
+        self.optionDelta = matrices.byStock(
+                lambda days: positions[days] * multiplier * matrices.delta[days], blockDays)
+        self.stockSpot = np.asarray(matrices.stockSpot)
+        nDays = len(matrices.dates)
+        self.bookedHedgePnl = np.zeros(nDays)
+        for start in range(1, nDays, blockDays):
+            now = slice(start, min(start + blockDays, nDays))
+            pre = slice(start - 1, now.stop - 1)
+            expiry = matrices.expiry
+            expired = (expiry >= matrices.dayNumbers[pre, None]) & \
+                      (expiry < matrices.dayNumbers[now, None])
+            alive = matrices.listed[now] & ~expired
+            self.bookedHedgePnl[now] = -(positions[pre] * multiplier * matrices.delta[pre] *
+                                         (matrices.spot[now] - matrices.spot[pre]) *
+                                         alive).sum(axis=1)
+
+    def evaluate(self, policy):
+        '''
+        Daily results of a hedge policy
+
+        Returns:
+        dataFrame indexed by date with columns HedgePnl, HedgeCost,
+        Turnover (traded stock value) and NetDelta (sum over stocks of the
+        absolute dollar delta left unhedged)
+        '''
+        stockPosition = policy.hedge(self.optionDelta, self.stockSpot)
+        spot = self.stockSpot
+        hedgePnl = np.zeros(len(spot))
+        hedgePnl[1:] = (stockPosition[:-1] * np.diff(spot, axis=0)).sum(axis=1)
+        traded = np.abs(np.diff(stockPosition, axis=0, prepend=0)) * spot
+        turnover = traded.sum(axis=1)
+        netDelta = (np.abs(self.optionDelta + stockPosition) * spot).sum(axis=1)
+        return pd.DataFrame({'HedgePnl': hedgePnl,
+                             'HedgeCost': self.stockCost * turnover,
+                             'Turnover': turnover,
+                             'NetDelta': netDelta}, index=self.matrices.dates)
+
+    def compare(self, policies, basePnls=None):
+        '''
+        Summary of several hedge policies
+
+        Parameters:
+        policies -- list of HedgePolicy objects
+        basePnls -- dataFrame of daily pnls of the backtest of the positions
+                    (BackTest.run), if given each policy's daily total pnl
+                    is the backtest's with its booked hedge pnl swapped for
+                    the policy's hedge pnl and cost. The interest on the
+                    different stock cash flows is ignored.
+
+        Returns:
+        dataFrame with one row per policy: total hedge pnl, cost, turnover,
+        mean unhedged dollar delta and, with basePnls, total pnl, sharpe
+        ratio and max drawdown
+        '''
+        rows = []
+        for policy in policies:
+            result = self.evaluate(policy)
+            row = {'policy': repr(policy),
+                   'hedgePnl': result['HedgePnl'].sum(),
+                   'hedgeCost': result['HedgeCost'].sum(),
+                   'turnover': result['Turnover'].sum(),
+                   'meanNetDelta': result['NetDelta'].mean()}
+            if basePnls is not None:
+                dailyPnl = (basePnls['DailyTotPnl'].to_numpy() - self.bookedHedgePnl
+                            + result['HedgePnl'].to_numpy() - result['HedgeCost'].to_numpy())
+                dailyPnl = pd.Series(dailyPnl, index=result.index)
+                maxDrawdown, longestUnprofit = Metrics.calcDrawdowns(dailyPnl)
+                row.update({'totPnl': dailyPnl.sum(),
+                            'sharpeRatio': Metrics.calcSharpeRatio(dailyPnl),
+                            'maxDrawDown': maxDrawdown})
+            rows.append(row)
+        return pd.DataFrame(rows).set_index('policy')
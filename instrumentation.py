@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Chengye
+"""
+
+import time
+import cProfile
+import pandas as pd
+
+class StageTimer(object):
+    ''' Context manager adding the elapsed time of a block to a stage '''
+    __slots__ = ('instrument', 'name', 'start')
+
+    def __init__(self, instrument, name):
+        self.instrument = instrument
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.instrument.addTime(self.name, time.perf_counter() - self.start)
+        return False
+
+class NullTimer(object):
+    ''' Context manager doing nothing, used when instrumentation is off '''
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        return False
+
+nullTimer = NullTimer()
+
+class Instrumentation(object):
+    '''
+    Per-stage timers and counters of a backtest run
+
+    Stages and counters are recorded per date, set with setDate. Stage names
+    used by BackTest and Portfolio are loadOptions, loadTrades, tradeAdmission,
+    positionPnl, tradePnl, rehedge and metrics. Counters are trades and
+    acceptedTrades, summed over the portfolios of a run. Gauges keep the
+    largest value recorded for a date, openPositions is the largest number
+    of open positions of a portfolio at the end of the date.
+
+    Inputs:
+        profilePath -- if given, the run is also profiled with cProfile and
+                       the stats are dumped to this file, to be read with pstats
+    '''
+    enabled = True
+
+    def __init__(self, profilePath=None):
+        self.profilePath = profilePath
+        self.profiler = None
+        self.date = None
+        self.times = {}
+        self.counts = {}
+        self.gauges = {}
+
+    def setDate(self, date):
+        self.date = date
+
+    def stage(self, name):
+        '''
+        Context manager timing a block of code as part of a stage
+        '''
+        return StageTimer(self, name)
+
+    def addTime(self, name, seconds):
+        key = (self.date, name)
+        self.times[key] = self.times.get(key, 0.0) + seconds
+
+    def count(self, name, n=1):
+        key = (self.date, name)
+        self.counts[key] = self.counts.get(key, 0) + n
+
+    def gauge(self, name, value):
+        key = (self.date, name)
+        self.gauges[key] = max(self.gauges.get(key, value), value)
+
+    def startProfile(self):
+        if self.profilePath is not None:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def stopProfile(self):
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.profilePath)
+            self.profiler = None
+
+    def toFrame(self):
+        '''
+        Timings and counters per date
+
+        Returns:
+        dataFrame indexed by date, one column of seconds per stage and one
+        column per counter and gauge, records made outside of any date are 
+        in a 'run' row
+        '''
+        rows = {}
+        for records in (self.times, self.counts, self.gauges):
+            for (date, name), value in records.items():
+                # records outside of any date, e.g. metrics, go to a 'run' row
+                rows.setdefault('run' if date is None else date, {})[name] = value
+        return pd.DataFrame.from_dict(rows, orient='index').fillna(0)
+
+    def summary(self):
+        '''
+        Total seconds of each stage and total of each counter over the run,
+        largest value of each gauge
+        '''
+        frame = self.toFrame()
+        gauges = frame.columns.isin([name for date, name in self.gauges])
+        return pd.concat([frame.loc[:, ~gauges].sum(), frame.loc[:, gauges].max()])
+
+class NullInstrumentation(object):
+    ''' Instrumentation that records nothing, with next to no overhead '''
+    enabled = False
+    profilePath = None
+
+    def setDate(self, date):
+        pass
+
+    def stage(self, name):
+        return nullTimer
+
+    def addTime(self, name, seconds):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+    def gauge(self, name, value):
+        pass
+
+    def startProfile(self):
+        pass
+
+    def stopProfile(self):
+        pass
+
+nullInstrumentation = NullInstrumentation()
@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Chengye
+"""
+
+import os
+import time
+import asyncio
+import argparse
+import logging
+import numpy as np
+import pandas as pd
+from base import TradeBatch
+from portfolio import Portfolio
+from snapshot import chainFromFrame
+
+'''
+Live replay: paper trade the agree/disagree portfolios during the day.
+
+Fills arrive on asyncio streams (a tailed csv file, a local socket, or the
+in-process submitFill call) and are admitted with Portfolio.handleTrades in
+bursts: the session takes the first waiting fill and everything queued
+behind it, up to maxBatch fills, and admits them as one batch, which gives
+the same result as admitting them one by one. End-of-day option snapshots
+are queued with the fills, so a snapshot is only applied once every fill
+received before it has been admitted. Fills and snapshots use the csv
+formats of trade_sample.csv and option_sample.csv.
+'''
+
+# Queue item kinds
+FILL = 0
+SNAPSHOT = 1
+STOP = 2
+
+class LatencyStats(object):
+    '''
+    Per-fill admission latency, from the time a fill is received to the
+    time its admission is done, in seconds. Only the latest fills are kept
+    in a ring buffer for the percentiles, the max and count cover all fills.
+
+    Inputs:
+        capacity -- number of latest fills kept for the percentiles
+    '''
+    def __init__(self, capacity=1000000):
+        self.latencies = np.empty(capacity)
+        # position of the next write in the ring buffer
+        self.position = 0
+        self.count = 0
+        self.max = 0.0
+
+    def add(self, receivedTimes, doneTime):
+        latencies = doneTime - np.asarray(receivedTimes, dtype=float)
+        if len(latencies) == 0:
+            return
+        self.count += len(latencies)
+        self.max = max(self.max, latencies.max())
+        capacity = len(self.latencies)
+        # a burst larger than the buffer only leaves its last fills
+        latencies = latencies[-capacity:]
+        end = self.position + len(latencies)
+        if end <= capacity:
+            self.latencies[self.position:end] = latencies
+        else:
+            split = capacity - self.position
+            self.latencies[self.position:] = latencies[:split]
+            self.latencies[:end - capacity] = latencies[split:]
+        self.position = end % capacity
+
+    def percentiles(self, q=(50, 90, 99, 99.9)):
+        '''
+        Returns:
+        pandas Series of latency percentiles over the latest fills and max
+        in microseconds, and the number of fills
+        '''
+        if self.count == 0:
+            return pd.Series({'count': 0})
+        latencies = self.latencies[:min(self.count, len(self.latencies))] * 1e6
+        result = {'p%g' % p: value for p, value in zip(q, np.percentile(latencies, q))}
+        result['max'] = self.max * 1e6
+        result['count'] = self.count
+        return pd.Series(result)
+
+class LiveSession(object):
+    '''
+    Class for a live paper trading session of several portfolios
+
+    Inputs:
+        portfolios -- list of Portfolio objects, as of the previous close,
+                      e.g. loaded with Portfolio.loadCheckpoint
+        maxBatch -- largest number of fills admitted in one batch, the event
+                    loop is given back to the fill sources after each batch
+        checkpointPaths -- list of paths, one per portfolio, to save the
+                           portfolio checkpoints to after each end-of-day
+    '''
+    def __init__(self, portfolios, maxBatch=10000, checkpointPaths=None):
+        self.portfolios = portfolios
+        self.maxBatch = maxBatch
+        self.checkpointPaths = checkpointPaths
+        self.queue = None
+        self.loop = None
+        self.latency = LatencyStats()
+        # daily pnls of each portfolio, one row per snapshot
+        self.pnlRows = [[] for pf in portfolios]
+
+    def start(self):
+        '''
+        Create the queue on the running event loop, called by run()
+        '''
+        if self.queue is None:
+            self.loop = asyncio.get_running_loop()
+            self.queue = asyncio.Queue()
+
+    def submitFill(self, tradeTime, optionSymbol, tradePrice, tradeVega, quantity,
+                   receivedTime=None):
+        '''
+        Queue a fill for admission, must be called from the event loop thread
+
+        Parameters:
+        tradeTime -- time of the trade
+        optionSymbol, tradePrice, tradeVega, quantity -- the fill
+        receivedTime -- time.perf_counter() when the fill was received,
+                        default now
+        '''
+        if receivedTime is None:
+            receivedTime = time.perf_counter()
+        self.queue.put_nowait((FILL, (tradeTime, optionSymbol, tradePrice, tradeVega,
+                                      quantity, receivedTime)))
+
+    def submitFillThreadsafe(self, tradeTime, optionSymbol, tradePrice, tradeVega,
+                             quantity):
+        '''
+        Queue a fill from another thread
+        '''
+        self.loop.call_soon_threadsafe(self.submitFill, tradeTime, optionSymbol,
+                                       tradePrice, tradeVega, quantity,
+                                       time.perf_counter())
+
+    def publishSnapshot(self, optionChain):
+        '''
+        Queue an end-of-day option chain, applied after the fills queued before it
+        '''
+        self.queue.put_nowait((SNAPSHOT, optionChain))
+
+    def stop(self):
+        '''
+        Stop the session once the items queued before have been processed
+        '''
+        self.queue.put_nowait((STOP, None))
+
+    def admitFills(self, fills):
+        '''
+        Admit a burst of fills as one batch for every portfolio
+        '''
+        tradeTimes, symbols, prices, vegas, quantities, receivedTimes = zip(*fills)
+        batch = TradeBatch(None, tradeTimes, symbols, prices, vegas,
+                           np.array(quantities))
+        for pf in self.portfolios:
+            pf.handleTrades(batch)
+        self.latency.add(receivedTimes, time.perf_counter())
+
+    def endOfDay(self, optionChain):
+        '''
+        Update every portfolio with an end-of-day option chain
+        '''
+        for pf, rows in zip(self.portfolios, self.pnlRows):
+            pf.updateEOD(optionChain, optionChain.date)
+            rows.append((optionChain.date, pf.dailyTradePnl, pf.dailyPositionPnl,
+                         pf.dailyTotPnl, pf.totPnl))
+        if self.checkpointPaths is not None:
+            for pf, path in zip(self.portfolios, self.checkpointPaths):
+                pf.saveCheckpoint(path)
+        logging.info('Updated portfolios for %s', str(optionChain.date)[:10])
+
+    async def run(self):
+        '''
+        Process fills and snapshots until stop() is called
+        '''
+        self.start()
+        queue = self.queue
+        while True:
+            kind, item = await queue.get()
+            fills = []
+            # drain the burst queued behind the first item
+            while kind == FILL:
+                fills.append(item)
+                if len(fills) >= self.maxBatch or queue.empty():
+                    break
+                kind, item = queue.get_nowait()
+            if fills:
+                self.admitFills(fills)
+            if kind == SNAPSHOT:
+                # end-of-day runs in a worker thread, fill sources keep reading
+                # into the queue, their fills are admitted after the update
+                await self.loop.run_in_executor(None, self.endOfDay, item)
+            elif kind == STOP:
+                return
+            # let the fill sources run between bursts
+            await asyncio.sleep(0)
+
+    def dailyPnls(self):
+        '''
+        Returns:
+        list of dataFrames, one per portfolio, in the format of BackTest.run
+        '''
+        return [pd.DataFrame([row[1:] for row in rows],
+                             index=[row[0] for row in rows],
+                             columns=['DailyTradePnl', 'DailyPositionPnl',
+                                      'DailyTotPnl', 'CumTotPnl'])
+                for rows in self.pnlRows]
+
+def parseFill(line):
+    '''
+    Parse a fill line in the trade_sample.csv format,
+    Date,Time,OptionSymbol,Price,Vega,Quantity
+
+    Returns:
+    (tradeTime, optionSymbol, tradePrice, tradeVega, quantity),
+    None for the header and empty lines
+    '''
+    fields = line.strip().split(',')
+    if len(fields) < 6 or fields[0] == 'Date':
+        return None
+    return fields[1], fields[2], float(fields[3]), float(fields[4]), int(fields[5])
+
+def submitLine(session, line, receivedTime):
+    try:
+        fill = parseFill(line)
+    except ValueError:
+        logging.warning('Invalid fill line %r', line)
+        return
+    if fill is not None:
+        session.submitFill(*fill, receivedTime=receivedTime)
+
+async def tailFills(session, fileName, pollInterval=0.01):
+    '''
+    Fill source tailing a csv file that another process appends to.
+    Runs until cancelled.
+    '''
+    with open(fileName) as f:
+        pending = ''
+        while True:
+            data = f.read()
+            if not data:
+                await asyncio.sleep(pollInterval)
+                continue
+            receivedTime = time.perf_counter()
+            lines = (pending + data).split('\n')
+            # the last line may not be complete yet
+            pending = lines.pop()
+            for line in lines:
+                submitLine(session, line, receivedTime)
+
+async def serveFills(session, host='127.0.0.1', port=9100):
+    '''
+    Fill source accepting fill lines on a local tcp socket,
+    several clients can connect. Runs until cancelled.
+    '''
+    async def handleClient(reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                submitLine(session, line.decode(), time.perf_counter())
+        finally:
+            writer.close()
+    server = await asyncio.start_server(handleClient, host, port)
+    async with server:
+        await server.serve_forever()
+
+async def watchSnapshots(session, directory, tickers, pollInterval=1.0):
+    '''
+    Snapshot source publishing each new option file of a directory, named
+    YYYYMMDD.csv as written by snapshot.partitionOptionFile. Files present
+    when the watch starts are skipped. Runs until cancelled.
+
+    A file is read as soon as its name shows up, so writers must publish
+    complete files by rename: write YYYYMMDD.csv.tmp (or any name not
+    ending in .csv) and os.replace it to YYYYMMDD.csv when done.
+
+    Parameters:
+    tickers -- list of all underlying tickers, the portfolios' stockList
+    '''
+    tickerIndex = pd.Index(tickers)
+    seen = set(os.listdir(directory))
+    while True:
+        for fileName in sorted(os.listdir(directory)):
+            if fileName in seen or not fileName.endswith('.csv'):
+                continue
+            seen.add(fileName)
+            frame = pd.read_csv(os.path.join(directory, fileName))
+            session.publishSnapshot(chainFromFrame(pd.Timestamp(fileName[:-4]), frame,
+                                                   tickers, tickerIndex))
+        await asyncio.sleep(pollInterval)
+
+async def replayHistory(session, bt, dateRange=None, fillsPerSecond=None, burstSize=50):
+    '''
+    Replay a BackTest's historical trades and option chains through a
+    session, each date's fills followed by its option chain, then stop.
+    The session's portfolios must be as of the first date of the replay.
+
+    Parameters:
+    bt -- BackTest object
+    dateRange -- (start, end) tuple of dates, inclusive, see BackTest.runDates
+    fillsPerSecond -- fill rate, None to replay as fast as possible
+    burstSize -- number of fills sent at once at the given fill rate
+    '''
+    dates = bt.runDates(dateRange)
+    chains = bt.optionSource.iterChains(dates)
+    next(chains)
+    for date, optionChain in zip(dates[1:], chains):
+        batch = bt.loadTrades(date)
+        trades = list(zip(batch.times.tolist(), batch.symbols.tolist(),
+                          batch.prices.tolist(), batch.vegas.tolist(),
+                          batch.quantities.tolist()))
+        if fillsPerSecond is None:
+            burstSize = max(len(trades), 1)
+        for i in range(0, len(trades), burstSize):
+            for trade in trades[i:i+burstSize]:
+                session.submitFill(*trade)
+            if fillsPerSecond is not None:
+                await asyncio.sleep(burstSize / fillsPerSecond)
+        session.publishSnapshot(optionChain)
+        await asyncio.sleep(0)
+    session.stop()
+
+async def runLive(session, sources):
+    '''
+    Run a session with fill and snapshot source coroutines,
+    the sources are cancelled once the session stops. A source that fails
+    stops the session: its error is logged and raised, sources that return
+    normally (e.g. replayHistory) do not.
+    '''
+    session.start()
+    runTask = asyncio.ensure_future(session.run())
+    tasks = [asyncio.ensure_future(source) for source in sources]
+    try:
+        pending = set(tasks) | {runTask}
+        while not runTask.done():
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task is not runTask and not task.cancelled() and \
+                        task.exception() is not None:
+                    logging.error("Source %d of the session failed, stopping", 
+                                  tasks.index(task), exc_info=task.exception())
+                    raise task.exception()
+        runTask.result()
+    finally:
+        for task in tasks + [runTask]:
+            task.cancel()
+        await asyncio.gather(*tasks, runTask, return_exceptions=True)
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description='Live paper trading of option portfolios')
+    parser.add_argument('--checkpoint', nargs='+', required=True,
+                        help='portfolio checkpoints as of the previous close, '
+                             'overwritten after each end-of-day')
+    parser.add_argument('--tradeFile', default=None, help='csv file of fills to tail')
+    parser.add_argument('--port', type=int, default=None, help='tcp port for fill lines')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--snapshotDir', required=True,
+                        help='directory where YYYYMMDD.csv option snapshots are published')
+    parser.add_argument('--maxBatch', type=int, default=10000)
+    return parser.parse_args(argv)
+
+async def main(args):
+    portfolios = [Portfolio.loadCheckpoint(path) for path in args.checkpoint]
+    # snapshots carry the tickers of every portfolio, and every portfolio 
+    # knows all of them
+    tickers = sorted(set().union(*[pf.stockList for pf in portfolios]))
+    if any(list(pf.stockList) != tickers for pf in portfolios):
+        portfolios = [Portfolio.loadCheckpoint(path, tickers) for path in args.checkpoint]
+    session = LiveSession(portfolios, args.maxBatch, args.checkpoint)
+    session.start()
+    sources = [watchSnapshots(session, args.snapshotDir, tickers)]
+    if args.tradeFile is not None:
+        sources.append(tailFills(session, args.tradeFile))
+    if args.port is not None:
+        sources.append(serveFills(session, args.host, args.port))
+    try:
+        await runLive(session, sources)
+    finally:
+        logging.warning("Admission latency (us):\n%s", session.latency.percentiles())
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(main(parseArgs()))
+    except KeyboardInterrupt:
+        pass
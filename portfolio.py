@@ -3,8 +3,98 @@
 @author: Chengye
 """
 
+import os
+import warnings
+import threading
+import numpy as np
 import pandas as pd
 import logging
+from base import OptionChain, TradeBatch
+from concurrent.futures import ThreadPoolExecutor
+from instrumentation import nullInstrumentation
+from evaluation import OnlineMetrics, RollingMetrics
+from positionBook import PositionBook, NO_EXPIRY
+from attribution import AttributionStore
+from admission import admitTrades, rejectReasons, ACCEPTED, UNKNOWN_SYMBOL, \
+    AGREE_TYPE_MISMATCH, BREACH_TOTAL_VEGA, BREACH_STOCK_VEGA
+
+def sequentialSum(start, values):
+    '''
+    Add values to start one by one, in order. Gives exactly the same result
+    as a python loop of +=, unlike np.sum which sums pairwise
+    '''
+    if len(values) == 0:
+        return start
+    return float(np.cumsum(np.r_[start, values])[-1])
+
+# Thread pool shared by the portfolios of the 'sharded' eodMode, 
+# created on first use
+shardPool = None
+shardPoolLock = threading.Lock()
+
+def getShardPool():
+    '''
+    Thread pool of the sharded end-of-day updates, one thread per core
+    '''
+    global shardPool
+    with shardPoolLock:
+        if shardPool is None:
+            shardPool = ThreadPoolExecutor(os.cpu_count() or 1, 
+                                           thread_name_prefix='eodShard')
+    return shardPool
+
+def shardBounds(nStock, nShards):
+    '''
+    Split stockList positions into nShards contiguous ranges
+    
+    Returns:
+    array of nShards + 1 bounds, shard k holds stocks bounds[k] to bounds[k+1]
+    '''
+    nShards = max(1, min(nShards, nStock))
+    return np.arange(nShards + 1) * nStock // nShards
+
+def positionPnlShard(positions, multiplier, delta, pricePre, spotPre, 
+                     priceNow, spotNow):
+    '''
+    Position pnl of the alive option positions of one shard, 
+    same operations as calcDailyPositionPnlVectorized
+    '''
+    optionPnl = positions * multiplier * (priceNow - pricePre)
+    stockPnl = -positions * multiplier * delta * (spotNow - spotPre)
+    return optionPnl, stockPnl
+
+def rehedgeShard(stockIds, nStock, positions, multiplier, delta, vega, spot, 
+                 stockPosition):
+    '''
+    Greeks and rehedge of the option positions and stocks of one shard, 
+    same operations as updateGreeksAndRehedgeVectorized
+    
+    Parameters:
+    stockIds -- shard-local stock position of each option position
+    nStock -- number of stocks of the shard
+    positions, multiplier, delta, vega, spot -- arrays, one per option position
+    stockPosition -- stock positions of the shard
+    
+    Returns:
+    vega of each option position, and per stock of the shard: vega, 
+    delta and position after the rehedge, cash of the rehedge
+    '''
+    delta = delta * positions * multiplier
+    vega = vega * positions * multiplier
+    stockVega = np.bincount(stockIds, weights=vega, minlength=nStock)
+    stockDelta = np.bincount(stockIds, weights=delta, minlength=nStock)
+    # spot of the last position of each stock, as in the loop
+    stockSpot = np.zeros(nStock)
+    stockSpot[stockIds] = spot
+    remainingDelta = stockDelta + stockPosition
+    rehedge = remainingDelta != 0
+    rehedgeCash = remainingDelta[rehedge] * stockSpot[rehedge]
+    stockPosition = np.where(rehedge, stockPosition + -remainingDelta, stockPosition)
+    stockDelta = np.where(rehedge, 0.0, remainingDelta)
+    return vega, stockVega, stockDelta, stockPosition, rehedgeCash
+
+# Layout version of portfolio checkpoints, bump when the stored arrays change
+CHECKPOINT_VERSION = 3
 
 class Portfolio(object):
     ''' Class for a portfolio
@@ -12,22 +102,37 @@ class Portfolio(object):
         agreeType -- agree or disagree with previous day's signal
         vegaLimit -- vega limit on stock and portfolio
         stockList -- a list of all underlying tickers
-        optionDict -- a dictionary of all options in the option data file
+        optionChain -- OptionChain of all options on the portfolio's date,
+                       a dictionary of Option objects is also accepted
         today -- current date of the portfolio
         ir -- overnight interest rate, assume it's constant
         cost -- option transaction cost ratio
+        eodMode -- 'vectorized' (default) computes end-of-day updates with 
+                   array operations, 'loop' goes through positions one by one,
+                   'sharded' splits positions and stocks by underlying into 
+                   nShards shards run on executor, with the same results
+        rollingWindow -- number of days of the rolling pnl metrics, 
+                         None for no rolling metrics
+        symbolTable -- positionBook.SymbolTable interning the option symbols,
+                       shared by the portfolios of a BackTest
+        attributionPath -- directory to write the per contract, per day pnl 
+                           attribution to, see attribution.AttributionStore,
+                           None to keep only the contract total pnls
     '''
-    def __init__(self, agreeType, vegaLimit, stockList, optionDict, today, 
-                 ir, cost):
+    def __init__(self, agreeType, vegaLimit, stockList, optionChain, today,
+                 ir, cost, eodMode='vectorized', rollingWindow=None, 
+                 symbolTable=None, attributionPath=None):
         # Input
         self.agreeType = agreeType
         self.vegaLimit = vegaLimit
         self.stockList = stockList
-        self.optionDict = optionDict
-        self.optionSymbolList = list(set(self.optionDict.keys()))
+        self.optionChain = self.toChain(optionChain)
         self.today = today
         self.ir = ir
         self.cost = cost
+        if eodMode not in ('vectorized', 'loop', 'sharded'):
+            raise ValueError("Unknown eodMode %r" % eodMode)
+        self.eodMode = eodMode
         
         # Portfolio total metrics
         self.dailyTradePnl = 0
@@ -37,111 +142,362 @@ class Portfolio(object):
         self.totVega = 0
         self.totCash = 0
         
-        # Metrics per option contract
-        self.contractTotPnl = {}
-        
-        # Metrics per stock name
-        self.stockDelta = pd.Series(0, index = stockList)
-        self.stockVega = pd.Series(0, index = stockList)
+        # Pnl metrics updated at every end-of-day, 
+        # the start date counts as a zero pnl day as in BackTest results
+        self.metrics = OnlineMetrics()
+        self.metrics.update(0.0)
+        self.rollingMetrics = None
+        if rollingWindow is not None:
+            self.rollingMetrics = RollingMetrics(rollingWindow)
+            self.rollingMetrics.update(0.0)
         
-        # Portfolio positions
-        self.stockPosition = pd.Series(0, index = stockList)
-        self.optionPosition = {}
+        # Portfolio positions, metrics per stock and per option contract,
+        # indexed by stockList position and interned symbol id
+        self.book = PositionBook(len(stockList), symbolTable)
+        self.symbolTable = self.book.symbolTable
         self.newDailyTrade = []
+        # option, hedge and trade pnl of each contract and date,
+        # grouped by contract into the contract total pnls
+        self.attribution = AttributionStore(self.symbolTable, attributionPath)
+        
+        # per-stage timers and counters, set by BackTest
+        self.instrument = nullInstrumentation
+        
+        # shards of the 'sharded' eodMode, run on the shared thread pool 
+        # by default, any concurrent.futures executor can be set
+        self.nShards = os.cpu_count() or 1
+        self.executor = None
+        
+        # chain ticker id -> stockList position map, cached per ticker list
+        self.tickerMapKey = None
+        self.tickerMap = None
+    
+    @property
+    def optionPosition(self):
+        ''' Open option positions, dictionary of option symbol to quantity '''
+        return self.book.optionPosition()
+    
+    @property
+    def optionDict(self):
+        '''
+        Deprecated, options of the open positions on the current date,
+        dictionary of option symbol to Option object. Use optionChain and
+        optionPosition instead.
+        '''
+        warnings.warn("Portfolio.optionDict is deprecated, use optionChain and "
+                      "optionPosition", DeprecationWarning, stacklevel=2)
+        return {optionSymbol: self.optionChain[optionSymbol] 
+                for optionSymbol in self.optionPosition 
+                if optionSymbol in self.optionChain}
+    
+    @property
+    def contractTotPnl(self):
+        ''' Total pnl of each option contract traded, dictionary of doubles '''
+        return self.attribution.contractTotPnl()
+    
+    @property
+    def stockPosition(self):
+        ''' Stock hedge positions, read-only Series indexed by stockList '''
+        return self.stockSeries(self.book.stockPosition)
+    
+    @stockPosition.setter
+    def stockPosition(self, values):
+        self.book.stockPosition = self.stockValues(values)
+    
+    @property
+    def stockDelta(self):
+        ''' Delta of each stock, read-only Series indexed by stockList '''
+        return self.stockSeries(self.book.stockDelta)
+    
+    @stockDelta.setter
+    def stockDelta(self, values):
+        self.book.stockDelta = self.stockValues(values)
+    
+    @property
+    def stockVega(self):
+        ''' Vega of each stock, read-only Series indexed by stockList '''
+        return self.stockSeries(self.book.stockVega)
+    
+    @stockVega.setter
+    def stockVega(self, values):
+        self.book.stockVega = self.stockValues(values)
+    
+    def stockSeries(self, values):
+        '''
+        Series on a read-only view of a per stock array of the book, so 
+        writes to it raise instead of being lost, assign the whole 
+        stockPosition, stockDelta or stockVega attribute to change the book
+        '''
+        values = values.view()
+        values.flags.writeable = False
+        return pd.Series(values, index=self.stockList, copy=False)
     
+    def stockValues(self, values):
+        '''
+        Convert a Series indexed by ticker, or an array in stockList order,
+        to a per stock array of the book
+        '''
+        if isinstance(values, pd.Series):
+            values = values.reindex(self.stockList)
+            if values.isna().any():
+                raise ValueError("Missing tickers %s" 
+                                 % list(values.index[values.isna()]))
+        values = np.array(values, dtype=float)
+        if values.shape != (len(self.stockList),):
+            raise ValueError("Expected %d stock values, got shape %s" 
+                             % (len(self.stockList), values.shape))
+        return values
+    
+    def openPositions(self):
+        '''
+        Open option positions, in the order they were opened
+        
+        Returns:
+        slots -- array of int, slots in the position book
+        symbols -- list of option symbols
+        positions -- array of quantities
+        '''
+        slots = self.book.openSlots()
+        symbols = self.symbolTable.symbolsOf(self.book.ids(slots))
+        return slots, symbols, self.book.quantities(slots)
+    
+    def toChain(self, optionChain):
+        '''
+        Convert a dictionary of Option objects to an OptionChain,
+        an OptionChain is returned as it is
+        '''
+        if isinstance(optionChain, OptionChain):
+            return optionChain
+        return OptionChain.fromOptions(optionChain, self.stockList)
+    
+    def stockIds(self, chain):
+        '''
+        Map a chain's underlying ids to positions in stockList
+        
+        Returns:
+        array of int, position in stockList of each ticker in chain.tickers
+        '''
+        if chain.tickers is not self.tickerMapKey:
+            if list(chain.tickers) == list(self.stockList):
+                tickerMap = np.arange(len(self.stockList))
+            else:
+                stockIndex = dict(zip(self.stockList, range(len(self.stockList))))
+                tickerMap = np.array([stockIndex[ticker] for ticker in chain.tickers],
+                                     dtype=np.int64)
+            self.tickerMapKey = chain.tickers
+            self.tickerMap = tickerMap
+        return self.tickerMap
+
     def handleTrade(self, trade):
         '''
-        Handle a new trade, add the trade to newDailyTrade if all conditions met
+        Handle a new trade, add the trade to newDailyTrade if all conditions met.
+        Scalar version of handleTrades for single fills, e.g. of a live 
+        session, with the same results
         
         Parameters:
         trade -- Trade object
+        
+        Returns:
+        reason -- int, index into admission.rejectReasons
+        '''
+        with self.instrument.stage('tradeAdmission'):
+            reason = self.admitTrade(trade)
+        self.instrument.count('trades')
+        if reason == ACCEPTED:
+            self.instrument.count('acceptedTrades')
+            self.newDailyTrade.append(TradeBatch.fromTrades([trade]))
+        if logging.getLogger().isEnabledFor(logging.INFO):
+            logging.info('Check trade %s', trade.getOptionSymbol())
+            if reason != ACCEPTED:
+                logging.info(rejectReasons[reason])
+        return reason
+    
+    def admitTrade(self, trade):
         '''
-        tradeVega = trade.getTradeVega()
-        tradeSymbol = trade.getOptionSymbol()
+        Check one trade against the portfolio's agree type and vega limits,
+        update totVega and stockVega if it is accepted
+        
+        Returns:
+        reason -- int, index into admission.rejectReasons
+        '''
+        chain = self.optionChain
+        row = chain.symbolIndex.get(trade.getOptionSymbol())
+        if row is None:
+            return UNKNOWN_SYMBOL
         quantity = trade.getQuantity()
-        logging.info('Check trade '+tradeSymbol)
-        if tradeSymbol not in self.optionDict:
-            logging.info("tradeSymbol not appear in the past")
-            return
+        if (quantity * chain.signal[row] > 0) != self.agreeType:
+            return AGREE_TYPE_MISMATCH
+        thisVega = quantity * trade.getTradeVega() * chain.multiplier[row]
+        if abs(self.totVega + thisVega) > self.vegaLimit:
+            return BREACH_TOTAL_VEGA
+        stockVega = self.book.stockVega
+        stockId = self.stockIds(chain)[chain.underlyingIds[row]]
+        if abs(stockVega[stockId] + thisVega) > self.vegaLimit:
+            return BREACH_STOCK_VEGA
+        self.totVega += thisVega
+        stockVega[stockId] += thisVega
+        return ACCEPTED
+    
+    def handleTrades(self, tradeBatch):
+        '''
+        Handle a batch of new trades in the batch order, 
+        add the accepted trades to newDailyTrade
         
-        option = self.optionDict[tradeSymbol]
-        underlyer = option.getUnderlyingTicker()
+        Parameters:
+        tradeBatch -- TradeBatch, in trade time ascending order
         
-        # check if this trade matches the agree type of this portfolio
-        if (quantity * option.getSignal()>0)!=self.agreeType:
-            logging.info("Agree type not match")
-            return
+        Returns:
+        accepted -- boolean array, true if the trade is accepted
+        reasons -- int array, index into admission.rejectReasons
+        '''
+        with self.instrument.stage('tradeAdmission'):
+            accepted, reasons = self.admitTrades(tradeBatch)
+        self.instrument.count('trades', len(reasons))
+        self.instrument.count('acceptedTrades', int(np.count_nonzero(accepted)))
+        if logging.getLogger().isEnabledFor(logging.INFO):
+            for tradeSymbol, reason in zip(tradeBatch.symbols.tolist(), reasons.tolist()):
+                logging.info('Check trade %s', tradeSymbol)
+                if reason != ACCEPTED:
+                    logging.info(rejectReasons[reason])
+        if accepted.any():
+            self.newDailyTrade.append(tradeBatch.take(accepted))
+        return accepted, reasons
+    
+    def admitTrades(self, tradeBatch):
+        '''
+        Check a batch of trades against the portfolio's agree type and vega 
+        limits, with the same results as checking them one by one.
+        Update totVega and stockVega with the accepted trades.
         
+        Parameters:
+        tradeBatch -- TradeBatch, in trade time ascending order
+        
+        Returns:
+        accepted -- boolean array, true if the trade is accepted
+        reasons -- int array, index into admission.rejectReasons
+        '''
+        chain = self.optionChain
+        rows = chain.indexOf(tradeBatch.symbols)
+        known = rows >= 0
+        rows = rows[known]
+        quantity = tradeBatch.quantities[known]
+        reasons = np.full(len(known), UNKNOWN_SYMBOL, dtype=np.int64)
+        # check if trades match the agree type of this portfolio
+        agree = (quantity * chain.signal[rows] > 0) == self.agreeType
+        reasons[known] = np.where(agree, ACCEPTED, AGREE_TYPE_MISMATCH)
         # check if meet the risk limits
         # assume vega of existing positions didn't change from
-        # previous close values
-        thisVega = quantity * tradeVega * option.getContractMultiplier()
-        if abs(self.totVega + thisVega) > self.vegaLimit:
-            logging.info("Breach total vega")
-            return
-        if abs(self.stockVega.loc[underlyer] + thisVega) > self.vegaLimit:
-            logging.info("Breach stock vega")
-            return
+        # previous close values, unknown trades have no vega
+        thisVega = np.zeros(len(known))
+        thisVega[known] = quantity * tradeBatch.vegas[known] * chain.multiplier[rows]
+        stockIds = np.zeros(len(known), dtype=np.int64)
+        stockIds[known] = self.stockIds(chain)[chain.underlyingIds[rows]]
+        self.totVega = admitTrades(thisVega, stockIds, reasons, self.totVega, 
+                                   self.book.stockVega, self.vegaLimit)
+        return reasons == ACCEPTED, reasons
         
-        # accept the trade and update
-        self.totVega += thisVega
-        self.stockVega[underlyer] += thisVega
-        self.newDailyTrade.append(trade)
-        
-    def calcDailyTradePnl(self, optionDictNew):
+    def calcDailyTradePnl(self, optionChainNew, date):
         '''
         Calculate the sum of daily trade pnl of all the new accepted trades
         Also update option positions of new trades
         This function should be used after calcDailyPositionPnl to avoid double-count
 
         Parameters:
-        optionDictNew : dictionary of option objects
+        optionChainNew -- OptionChain, option information of that date
+        date -- datetime, the date of the trades
         '''
         logging.info("Calculating daily trade Pnl")
         self.dailyTradePnl = 0
-        for trade in self.newDailyTrade:
-            optionSymbol = trade.getOptionSymbol()
-            logging.info('Calculating trade '+optionSymbol)
-            if optionSymbol not in optionDictNew:
-                logging.warning("Can't find trade's option in optionDictNew")
-                continue
-            option = optionDictNew[optionSymbol]
-            quantity = trade.getQuantity()
-            multiplier = option.getContractMultiplier()
-            if quantity>0:
-                tradePrice = trade.getTradePrice() * (1 + self.cost)
-            else:
-                tradePrice = trade.getTradePrice() * (1 - self.cost)    
-            cashChange = -tradePrice * quantity * multiplier
-            tradePnl = (option.getOptionPrice() - tradePrice) * quantity * multiplier
-            
-            # update pnls
-            self.dailyTradePnl += tradePnl
-            if optionSymbol in self.contractTotPnl:
-                self.contractTotPnl[optionSymbol] += tradePnl
-            else:
-                self.contractTotPnl[optionSymbol] = tradePnl
-            
-            # update positions
-            self.totCash += cashChange
-            if optionSymbol in self.optionPosition:
-                self.optionPosition[optionSymbol] += quantity
-            else:
-                self.optionPosition[optionSymbol] = quantity
+        if not self.newDailyTrade:
+            return
+        trades = TradeBatch.concat(self.newDailyTrade)
+        rows = optionChainNew.indexOf(trades.symbols)
+        found = rows >= 0
+        if not found.all():
+            logging.warning("Can't find %d trades' options in optionChainNew", 
+                            np.count_nonzero(~found))
+            trades = trades.take(found)
+            rows = rows[found]
+        quantity = trades.quantities
+        multiplier = optionChainNew.multiplier[rows]
+        tradePrice = trades.prices * np.where(quantity>0, 1 + self.cost, 1 - self.cost)
+        cashChange = -tradePrice * quantity * multiplier
+        tradePnl = (optionChainNew.price[rows] - tradePrice) * quantity * multiplier
+        
+        # update pnls
+        self.dailyTradePnl = sequentialSum(0, tradePnl)
+        # update positions
+        self.totCash = sequentialSum(self.totCash, cashChange)
+        symbolIds = self.symbolTable.intern(trades.symbols)
+        self.attribution.append(date, symbolIds, tradePnl=tradePnl)
+        self.book.addPositions(symbolIds, quantity)
         # reset new daily trade list
         self.newDailyTrade = []
     
-    def calcDailyPositionPnl(self, optionDictNew, date):
+    def splitPositions(self, optionChainNew, date):
+        '''
+        Split the open positions for the position pnl of date
+        
+        Positions expiring on a day in [today, date), found with the expiry 
+        calendar of the position book, are settled at their last marks. 
+        The others are marked to optionChainNew, or carried forward with 
+        their last marks when missing from it. Positions whose symbol has 
+        no OCC expiry are settled when missing from optionChainNew.
+        
+        Parameters:
+        optionChainNew -- OptionChain, option information of that date
+        date -- datetime, the date to calculate daily position pnl.
+        
+        Returns:
+        slots -- array of int, slots of the open positions in open order
+        positions -- array of quantities
+        marks -- tuple of arrays of the last marks, see PositionBook.markNames
+        rowsNow -- array of int, row of each position in optionChainNew
+        expired -- array of bool, positions to settle
+        '''
+        slots, symbols, positions = self.openPositions()
+        marks = self.book.marks(slots)
+        rowsNow = optionChainNew.indexOf(symbols)
+        missing = rowsNow < 0
+        expired = self.book.expiringMask(slots, self.today, date)
+        expired |= missing & (self.book.open['expiry'][slots] == NO_EXPIRY)
+        gaps = np.count_nonzero(missing & ~expired)
+        if gaps > 0:
+            logging.warning("%d option positions missing from the option chain, "
+                            "carried forward", gaps)
+        return slots, positions, marks, rowsNow, expired
+    
+    def refreshMarks(self):
+        '''
+        Mark the open positions found in today's option chain, 
+        positions missing from it keep their last marks
+        
+        Returns:
+        slots -- array of int, slots of the open positions in open order
+        positions -- array of quantities
+        marks -- tuple of arrays of the marks, see PositionBook.markNames
+        '''
+        chain = self.optionChain
+        slots, symbols, positions = self.openPositions()
+        rows = chain.indexOf(symbols)
+        found = rows >= 0
+        marked, rows = slots[found], rows[found]
+        self.book.setMarks(marked, self.stockIds(chain)[chain.underlyingIds[rows]], 
+                           chain.multiplier[rows], chain.price[rows], 
+                           chain.spot[rows], chain.delta[rows], chain.vega[rows])
+        return slots, positions, self.book.marks(slots)
+    
+    def calcDailyPositionPnl(self, optionChainNew, date):
         '''
         calculate daily position pnl
         positionPnl = optionPositionPnl + stockPositionPnl + cashPnl
         also aggregate contract total pnl
         contractTotPnl += optionContractPositionPnl
-        also check if option position has expired, 
-        if expired, move option position value to cash
+        also settle the option positions expiring since the previous date, 
+        move their value to cash, see splitPositions
 
         Parameters:
-        optionDictNew -- dictionary of Option objects, option information of that date
+        optionChainNew -- OptionChain, option information of that date
         date -- datetime, the date to calculate daily position pnl.
         '''
         logging.info("Calculating daily position Pnl")
@@ -150,35 +506,33 @@ class Portfolio(object):
         days = (date - self.today).days
         cashPnl = self.totCash * self.ir * days / 360
         self.dailyPositionPnl += cashPnl
+        slots, positions, marks, rowsNow, expired = self.splitPositions(optionChainNew, date)
+        stockIds, multipliers, pricesPre, spotsPre, deltas, vegas = marks
+        markedIds, optionPnls, stockPnls = [], [], []
         # Calculate position pnl for each contract
-        tempPosition = self.optionPosition.copy()
-        for optionSymbol in tempPosition:
-            if optionSymbol in optionDictNew:
-                # optionSymbol still in today's optionDict,
-                # meaning it's not expired, calculate pnl
-                position = tempPosition[optionSymbol]
-                optionPre = self.optionDict[optionSymbol]
-                optionNow = optionDictNew[optionSymbol]
-                multiplier = optionPre.getContractMultiplier()
-                delta = optionPre.getDelta()
-                optionPriceChange = optionNow.getOptionPrice() - optionPre.getOptionPrice()
-                spotPriceChange = optionNow.getSpot() - optionPre.getSpot()
-                optionPnl = position * multiplier * optionPriceChange
-                stockPnl = -position * multiplier * delta * spotPriceChange
-                self.contractTotPnl[optionSymbol] += optionPnl + stockPnl
-                self.dailyPositionPnl += optionPnl + stockPnl
-            else:
+        for symbolId, position, rowNow, isExpired, multiplier, delta, pricePre, spotPre in zip(
+                self.book.ids(slots).tolist(), positions.tolist(), 
+                rowsNow.tolist(), expired.tolist(), multipliers.tolist(), 
+                deltas.tolist(), pricesPre.tolist(), spotsPre.tolist()):
+            if isExpired:
                 # option expired, no actual pnl
-                position = tempPosition[optionSymbol]
-                optionPre = self.optionDict[optionSymbol]
-                multiplier = optionPre.getContractMultiplier()
-                delta = optionPre.getDelta()
                 if delta!=0:
                     logging.warning("An option expired with delta not equals 0")
                 # update cash positon
-                self.totCash += position * multiplier * optionPre.getOptionPrice()
-                # remove option position
-                del self.optionPosition[optionSymbol]
+                self.totCash += position * multiplier * pricePre
+            elif rowNow >= 0:
+                # mark the option to today's optionChain
+                optionPriceChange = optionChainNew.price[rowNow] - pricePre
+                spotPriceChange = optionChainNew.spot[rowNow] - spotPre
+                optionPnl = position * multiplier * optionPriceChange
+                stockPnl = -position * multiplier * delta * spotPriceChange
+                markedIds.append(symbolId)
+                optionPnls.append(optionPnl)
+                stockPnls.append(stockPnl)
+                self.dailyPositionPnl += optionPnl + stockPnl
+        self.attribution.append(date, markedIds, optionPnls, stockPnls)
+        # remove expired option positions
+        self.book.removeSlots(slots[expired])
     
     def updateGreeksAndRehedge(self):
         '''
@@ -186,54 +540,359 @@ class Portfolio(object):
         calculate portfolio vega, stock vega and remaining stock delta
         if remaining delta is not 0, rehedge stock positons
         '''
+        book = self.book
+        nStock = len(self.stockList)
         self.totVega = 0
-        self.stockDelta = pd.Series(0, index = self.stockList)
-        self.stockVega = pd.Series(0, index = self.stockList)
-        stockSpot = pd.Series(0, index = self.stockList)
-        for optionSymbol in self.optionPosition:
-            position = self.optionPosition[optionSymbol]
-            option = self.optionDict[optionSymbol]
-            underlyingTicker = option.getUnderlyingTicker()
-            stockSpot.loc[underlyingTicker] = option.getSpot()
-            multiplier = option.getContractMultiplier()
-            delta = option.getDelta() * position * multiplier
-            vega = option.getVega() * position * multiplier
-            self.stockVega.loc[underlyingTicker] += vega
-            self.stockDelta.loc[underlyingTicker] += delta
+        book.stockDelta = np.zeros(nStock)
+        book.stockVega = np.zeros(nStock)
+        stockSpot = np.zeros(nStock)
+        slots, positions, marks = self.refreshMarks()
+        stockIds, multipliers, prices, spots, deltas, vegas = marks
+        for position, stockId, spot, multiplier, delta, vega in zip(
+                positions.tolist(), stockIds.tolist(), spots.tolist(), 
+                multipliers.tolist(), deltas.tolist(), vegas.tolist()):
+            stockSpot[stockId] = spot
+            delta = delta * position * multiplier
+            vega = vega * position * multiplier
+            book.stockVega[stockId] += vega
+            book.stockDelta[stockId] += delta
             self.totVega += vega
-        for stock in self.stockList:
-            self.stockDelta.loc[stock] += self.stockPosition.loc[stock]
-            remainingDelta = self.stockDelta.loc[stock]
+        for stockId in range(nStock):
+            book.stockDelta[stockId] += book.stockPosition[stockId]
+            remainingDelta = book.stockDelta[stockId]
             if remainingDelta != 0:
                 # has remaining delta, 
                 # need to sell remaining delta amount of stock
-                self.stockPosition.loc[stock] += -remainingDelta
-                self.totCash += remainingDelta * stockSpot.loc[stock]
-                self.stockDelta.loc[stock] = 0
+                book.stockPosition[stockId] += -remainingDelta
+                self.totCash += remainingDelta * stockSpot[stockId]
+                book.stockDelta[stockId] = 0
+                
+    def settleExpired(self, slots, positions, multiplier, delta, pricePre, expired):
+        '''
+        Move the value of expired option positions to cash at their last 
+        marks and remove them, in position order
+        '''
+        if not expired.any():
+            return
+        nonZeroDelta = np.count_nonzero(delta[expired])
+        if nonZeroDelta > 0:
+            logging.warning("%d options expired with delta not equals 0",
+                            nonZeroDelta)
+        self.totCash = sequentialSum(self.totCash, positions[expired] * 
+                                     multiplier[expired] * pricePre[expired])
+        self.book.removeSlots(slots[expired])
+    
+    def calcDailyPositionPnlVectorized(self, optionChainNew, date):
+        '''
+        Vectorized version of calcDailyPositionPnl, same results as the loop
+        
+        Parameters:
+        optionChainNew -- OptionChain, option information of that date
+        date -- datetime, the date to calculate daily position pnl.
+        '''
+        logging.info("Calculating daily position Pnl")
+        # Calculate cash pnl, positive if totCash>0, negative if totCash<0
+        days = (date - self.today).days
+        cashPnl = self.totCash * self.ir * days / 360
+        slots, positions, marks, rowsNow, expired = self.splitPositions(optionChainNew, date)
+        stockIds, multiplier, pricePre, spotPre, delta, vega = marks
+        # positions marked to today's chain
+        alive = ~expired & (rowsNow >= 0)
+        rowsAlive = rowsNow[alive]
+        optionPnl = positions[alive] * multiplier[alive] * (
+                optionChainNew.price[rowsAlive] - pricePre[alive])
+        stockPnl = -positions[alive] * multiplier[alive] * delta[alive] * (
+                optionChainNew.spot[rowsAlive] - spotPre[alive])
+        self.dailyPositionPnl = sequentialSum(cashPnl, optionPnl + stockPnl)
+        self.attribution.append(date, self.book.ids(slots[alive]), optionPnl, stockPnl)
+        # move expired option positions' value to cash
+        self.settleExpired(slots, positions, multiplier, delta, pricePre, expired)
+    
+    def updateGreeksAndRehedgeVectorized(self):
+        '''
+        Vectorized version of updateGreeksAndRehedge, same results as the loop
+        Greeks are aggregated per stock with np.bincount
+        '''
+        nStock = len(self.stockList)
+        slots, positions, marks = self.refreshMarks()
+        stockIds, multiplier, price, spot, delta, vega = marks
+        delta = delta * positions * multiplier
+        vega = vega * positions * multiplier
+        stockVega = np.bincount(stockIds, weights=vega, minlength=nStock)
+        stockDelta = np.bincount(stockIds, weights=delta, minlength=nStock)
+        # spot of the last position of each stock, as in the loop
+        stockSpot = np.zeros(nStock)
+        stockSpot[stockIds] = spot
+        self.totVega = sequentialSum(0, vega)
+        # rehedge remaining delta of each stock
+        stockPosition = self.book.stockPosition
+        remainingDelta = stockDelta + stockPosition
+        rehedge = remainingDelta != 0
+        self.totCash = sequentialSum(self.totCash, 
+                                     remainingDelta[rehedge] * stockSpot[rehedge])
+        stockPosition = np.where(rehedge, stockPosition + -remainingDelta, stockPosition)
+        stockDelta = np.where(rehedge, 0.0, remainingDelta)
+        self.book.stockVega = stockVega
+        self.book.stockDelta = stockDelta
+        self.book.stockPosition = stockPosition
                 
-    def updateEOD(self, optionDictNew, date):
+    def mapShards(self, func, argLists):
+        '''
+        Run func on every shard's arguments, on the executor when there is 
+        more than one shard
+        
+        Returns:
+        list of results, in shard order
+        '''
+        if len(argLists) <= 1:
+            return [func(*args) for args in argLists]
+        executor = self.executor if self.executor is not None else getShardPool()
+        futures = [executor.submit(func, *args) for args in argLists]
+        return [future.result() for future in futures]
+    
+    def calcDailyPositionPnlSharded(self, optionChainNew, date):
+        '''
+        Sharded version of calcDailyPositionPnl, same results as the loop
+        
+        Positions are split by underlying and the pnl of each shard's alive 
+        positions is computed on the executor. Totals are then summed in 
+        position order, as in the serial versions.
+        
+        Parameters:
+        optionChainNew -- OptionChain, option information of that date
+        date -- datetime, the date to calculate daily position pnl.
+        '''
+        logging.info("Calculating daily position Pnl")
+        # Calculate cash pnl, positive if totCash>0, negative if totCash<0
+        days = (date - self.today).days
+        cashPnl = self.totCash * self.ir * days / 360
+        slots, positions, marks, rowsNow, expired = self.splitPositions(optionChainNew, date)
+        stockIds, multiplier, pricePre, spotPre, delta, vega = marks
+        # positions marked to today's chain
+        alive = ~expired & (rowsNow >= 0)
+        bounds = shardBounds(len(self.stockList), self.nShards)
+        shardIds = np.searchsorted(bounds, stockIds, side='right') - 1
+        shards = [np.flatnonzero(alive & (shardIds == k)) for k in range(len(bounds) - 1)]
+        shards = [index for index in shards if len(index) > 0]
+        results = self.mapShards(positionPnlShard, [
+                (positions[index], multiplier[index], delta[index], pricePre[index], 
+                 spotPre[index], optionChainNew.price[rowsNow[index]], 
+                 optionChainNew.spot[rowsNow[index]]) for index in shards])
+        # reduce in position order
+        optionPnl = np.zeros(len(slots))
+        stockPnl = np.zeros(len(slots))
+        for index, (shardOptionPnl, shardStockPnl) in zip(shards, results):
+            optionPnl[index] = shardOptionPnl
+            stockPnl[index] = shardStockPnl
+        optionPnl, stockPnl = optionPnl[alive], stockPnl[alive]
+        self.dailyPositionPnl = sequentialSum(cashPnl, optionPnl + stockPnl)
+        self.attribution.append(date, self.book.ids(slots[alive]), optionPnl, stockPnl)
+        # move expired option positions' value to cash
+        self.settleExpired(slots, positions, multiplier, delta, pricePre, expired)
+    
+    def updateGreeksAndRehedgeSharded(self):
+        '''
+        Sharded version of updateGreeksAndRehedge, same results as the loop
+        
+        Positions and stocks are split into contiguous ranges of stockList,
+        each shard aggregates its Greeks and rehedges its stocks on the 
+        executor. totVega and totCash are then summed in position and stock 
+        order, as in the serial versions.
+        '''
+        nStock = len(self.stockList)
+        slots, positions, marks = self.refreshMarks()
+        stockIds, multiplier, price, spot, delta, vega = marks
+        stockPosition = self.book.stockPosition
+        bounds = shardBounds(nStock, self.nShards)
+        shardIds = np.searchsorted(bounds, stockIds, side='right') - 1
+        shards = [np.flatnonzero(shardIds == k) for k in range(len(bounds) - 1)]
+        results = self.mapShards(rehedgeShard, [
+                (stockIds[index] - bounds[k], bounds[k+1] - bounds[k], positions[index], 
+                 multiplier[index], delta[index], vega[index], spot[index], 
+                 stockPosition[bounds[k]:bounds[k+1]]) 
+                for k, index in enumerate(shards)])
+        # reduce in position and stock order
+        vega = np.zeros(len(slots))
+        for index, result in zip(shards, results):
+            vega[index] = result[0]
+        self.totVega = sequentialSum(0, vega)
+        self.totCash = sequentialSum(self.totCash, 
+                                     np.concatenate([result[4] for result in results]))
+        self.book.stockVega = np.concatenate([result[1] for result in results])
+        self.book.stockDelta = np.concatenate([result[2] for result in results])
+        self.book.stockPosition = np.concatenate([result[3] for result in results])
+    
+    def updateEOD(self, optionChainNew, date):
         '''
         Update at the end of date, using the steps below:
         1. calculate daily position pnl
-        2. calculate daily trade pnl
+        2. calculate daily trade pnl, skipped if no new trades
         3. update total pnls
         4. update option information
         5. update Greeks and rehedge 
+        6. update pnl metrics
         
         Parameters:
-        optionDictNew -- dictionary of Option objects, option info for that date
+        optionChainNew -- OptionChain, option info for that date,
+                          a dictionary of Option objects is also accepted
         date -- datetime, representing the date needs to update
         '''
+        optionChainNew = self.toChain(optionChainNew)
+        eodMode = self.eodMode
+        instrument = self.instrument
         # 1. calculate daily position pnl 
-        self.calcDailyPositionPnl(optionDictNew, date)
+        with instrument.stage('positionPnl'):
+            if eodMode == 'vectorized':
+                self.calcDailyPositionPnlVectorized(optionChainNew, date)
+            elif eodMode == 'sharded':
+                self.calcDailyPositionPnlSharded(optionChainNew, date)
+            else:
+                self.calcDailyPositionPnl(optionChainNew, date)
         # 2. calculate daily trade pnl
-        self.calcDailyTradePnl(optionDictNew)
+        if self.newDailyTrade:
+            with instrument.stage('tradePnl'):
+                self.calcDailyTradePnl(optionChainNew, date)
+        else:
+            self.dailyTradePnl = 0
         # 3. update total pnls
         self.dailyTotPnl = self.dailyPositionPnl + self.dailyTradePnl
         self.totPnl += self.dailyTotPnl
         # 4. update option info from previous day to today's date
-        self.optionDict = optionDictNew
+        self.optionChain = optionChainNew
         # 5. update Greeks and rehdge
-        self.updateGreeksAndRehedge()
+        with instrument.stage('rehedge'):
+            if eodMode == 'vectorized':
+                self.updateGreeksAndRehedgeVectorized()
+            elif eodMode == 'sharded':
+                self.updateGreeksAndRehedgeSharded()
+            else:
+                self.updateGreeksAndRehedge()
+        instrument.gauge('openPositions', len(self.book))
+        # 6. update pnl metrics
+        with instrument.stage('metrics'):
+            self.metrics.update(self.dailyTotPnl)
+            if self.rollingMetrics is not None:
+                self.rollingMetrics.update(self.dailyTotPnl)
         # all updates are done, set today to date
-        self.today = date
\ No newline at end of file
+        self.today = date
+
+    def saveCheckpoint(self, fileName):
+        '''
+        Save the portfolio state after updateEOD to a compressed .npz file: 
+        parameters, today, cash, vega and pnl totals, option and stock 
+        positions with the last marks of the options, contract total pnls, 
+        pnl metrics and today's option chain. 
+        Symbols are stored as fixed width strings, no pickling is involved.
+        The file is written to a temporary name first and then renamed.
+        
+        Parameters:
+        fileName -- path of the checkpoint file
+        '''
+        chain = self.optionChain
+        book = self.book
+        slots, positionSymbols, positions = self.openPositions()
+        stockIds, multiplier, price, spot, delta, vega = book.marks(slots)
+        contractIds, contractTotPnl = self.attribution.contractTotals()
+        state = {'version': CHECKPOINT_VERSION,
+                 'agreeType': self.agreeType,
+                 'vegaLimit': self.vegaLimit,
+                 'ir': self.ir,
+                 'cost': self.cost,
+                 'today': np.datetime64(pd.Timestamp(self.today), 'ns'),
+                 'totals': np.array([self.dailyTradePnl, self.dailyPositionPnl, 
+                                     self.dailyTotPnl, self.totPnl, 
+                                     self.totVega, self.totCash], dtype=np.float64),
+                 'stockList': np.array(list(self.stockList), dtype=str),
+                 'stockPosition': book.stockPosition,
+                 'stockDelta': book.stockDelta,
+                 'stockVega': book.stockVega,
+                 'positionSymbols': np.array(positionSymbols, dtype=str),
+                 'positions': positions,
+                 'positionTickers': np.array(list(self.stockList), dtype=str)[stockIds],
+                 'positionMarks': np.column_stack([multiplier, price, spot, delta, vega]),
+                 'contractSymbols': np.array(self.symbolTable.symbolsOf(contractIds), 
+                                             dtype=str),
+                 'contractTotPnl': contractTotPnl,
+                 'chainDate': np.datetime64(pd.Timestamp(chain.date), 'ns'),
+                 'chainSymbols': chain.symbols.astype(str),
+                 'chainUnderlyingIds': chain.underlyingIds,
+                 'chainTickers': np.array(list(chain.tickers), dtype=str),
+                 'chainDelta': chain.delta,
+                 'chainSpot': chain.spot,
+                 'chainSignal': chain.signal,
+                 'chainMultiplier': chain.multiplier,
+                 'chainVega': chain.vega,
+                 'chainPrice': chain.price,
+                 'metrics': self.metrics.getState()}
+        if self.rollingMetrics is not None:
+            for name, values in self.rollingMetrics.getState().items():
+                state['rolling_' + name] = values
+        tempName = fileName + '.tmp'
+        with open(tempName, 'wb') as f:
+            np.savez_compressed(f, **state)
+        os.replace(tempName, fileName)
+    
+    @classmethod
+    def loadCheckpoint(cls, fileName, stockList=None, eodMode='vectorized', 
+                       symbolTable=None, attributionPath=None):
+        '''
+        Restore a portfolio saved by saveCheckpoint, ready for the trades 
+        and updateEOD of the dates after its today
+        
+        Parameters:
+        fileName -- path of the checkpoint file
+        stockList -- list of underlying tickers of the backtest, tickers not 
+                     in the checkpoint are added with zero positions, the 
+                     stocks are kept sorted as in a backtest's stockList
+        eodMode -- end-of-day update mode, see Portfolio
+        symbolTable -- SymbolTable of the option symbols, see Portfolio
+        attributionPath -- directory of the pnl attribution, the dates after
+                           the checkpoint are appended to it, see Portfolio
+        
+        Returns:
+        Portfolio object
+        '''
+        with np.load(fileName, allow_pickle=False) as state:
+            state = dict(state)
+        if int(state['version']) != CHECKPOINT_VERSION:
+            raise ValueError("Unsupported checkpoint version %d in %s" % 
+                             (int(state['version']), fileName))
+        tickers = state['chainTickers'].tolist()
+        chain = OptionChain(pd.Timestamp(state['chainDate'][()]), 
+                            state['chainSymbols'].astype(object), 
+                            state['chainUnderlyingIds'], tickers, 
+                            state['chainDelta'], state['chainSpot'], 
+                            state['chainSignal'], state['chainMultiplier'], 
+                            state['chainVega'], state['chainPrice'])
+        savedStocks = state['stockList'].tolist()
+        if stockList is None:
+            stockList = savedStocks
+        else:
+            stockList = sorted(set(savedStocks) | set(stockList))
+        pf = cls(bool(state['agreeType']), state['vegaLimit'].item(), stockList, 
+                 chain, pd.Timestamp(state['today'][()]), state['ir'].item(), 
+                 state['cost'].item(), eodMode, symbolTable=symbolTable)
+        # the attribution of the dates after the checkpoint is appended
+        # to the attribution of the run that saved it
+        pf.attribution = AttributionStore(pf.symbolTable, attributionPath, 
+                                          resumeAfter=pf.today)
+        (pf.dailyTradePnl, pf.dailyPositionPnl, pf.dailyTotPnl, pf.totPnl, 
+         pf.totVega, pf.totCash) = state['totals'].tolist()
+        book = pf.book
+        for name in ['stockPosition', 'stockDelta', 'stockVega']:
+            values = pd.Series(state[name], index=savedStocks)
+            setattr(book, name, values.reindex(stockList, fill_value=0.0)
+                                      .to_numpy(dtype=np.float64))
+        contractIds = pf.symbolTable.intern(state['contractSymbols'].astype(object))
+        pf.attribution.seedTotals(contractIds, state['contractTotPnl'])
+        positionIds = pf.symbolTable.intern(state['positionSymbols'].astype(object))
+        slots = book.addPositions(positionIds, state['positions'].astype(np.float64))
+        stockIds = pd.Index(stockList).get_indexer(state['positionTickers'])
+        marks = state['positionMarks'].reshape(len(slots), 5)
+        book.setMarks(slots, stockIds, *marks.T)
+        pf.metrics = OnlineMetrics.fromState(state['metrics'])
+        if 'rolling_scalars' in state:
+            pf.rollingMetrics = RollingMetrics.fromState(
+                    {name[len('rolling_'):]: values for name, values in state.items()
+                     if name.startswith('rolling_')})
+        return pf
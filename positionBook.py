@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Chengye
+"""
+
+import numpy as np
+import pandas as pd
+
+# Expiry of symbols that are not OCC style, such positions are settled 
+# when they are missing from the option chain
+NO_EXPIRY = np.iinfo(np.int64).min
+
+# OCC option symbol: root (padded with spaces in the OSI format), 
+# expiry YYMMDD, C or P, strike times 1000 on 8 digits, e.g. AAPL190830C00130000
+occPattern = r'^(?P<root>[A-Z0-9.]+?) *(?P<expiry>\d{6})(?P<callPut>[CP])(?P<strike>\d{8})$'
+
+def dayNumber(date):
+    '''
+    Number of days since 1970-01-01 of a date, the key of the expiry calendar
+    '''
+    return int(np.datetime64(pd.Timestamp(date), 'D').astype(np.int64))
+
+def parseOptionSymbols(symbols):
+    '''
+    Parse OCC style option symbols into columns
+
+    Parameters:
+    symbols -- list or array of option symbols
+
+    Returns:
+    dataFrame with columns root (str), expiry (int, day number, NO_EXPIRY 
+    for symbols that do not parse), isCall (bool) and strike (float), 
+    one row per symbol
+    '''
+    parts = pd.Series(np.asarray(symbols, dtype=object), dtype=object).str.extract(occPattern)
+    valid = parts['root'].notna().to_numpy()
+    expiry = pd.to_datetime(parts['expiry'], format='%y%m%d', errors='coerce')
+    expiry = expiry.to_numpy().astype('datetime64[D]').astype(np.int64)
+    return pd.DataFrame({
+            'root': parts['root'].to_numpy(),
+            'expiry': np.where(valid, expiry, NO_EXPIRY),
+            'isCall': (parts['callPut'] == 'C').to_numpy(),
+            'strike': np.where(valid, pd.to_numeric(parts['strike']).to_numpy() / 1000, 
+                               np.nan)})
+
+class SymbolTable(object):
+    '''
+    Interned option symbols, each symbol gets an integer id the first time
+    it is seen. Shared by all portfolios of a BackTest. New symbols are 
+    parsed once into root, expiry, call/put and strike columns, indexed by id.
+
+    Inputs:
+        symbols -- list of symbols to intern first
+    '''
+    def __init__(self, symbols=()):
+        self.ids = {}
+        self.symbols = []
+        self.roots = []
+        self.columns = GrowingArrays([('expiry', np.int64), ('isCall', bool), 
+                                      ('strike', np.float64)])
+        self.intern(symbols)
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def intern(self, symbols):
+        '''
+        Ids of a list of symbols, new symbols get the next ids
+        in order of first appearance
+
+        Returns:
+        array of int
+        '''
+        codes, uniques = pd.factorize(np.asarray(symbols, dtype=object))
+        ids = self.ids
+        nKnown = len(self.symbols)
+        uniqueIds = np.empty(len(uniques), dtype=np.int64)
+        for i, symbol in enumerate(uniques.tolist()):
+            symbolId = ids.get(symbol)
+            if symbolId is None:
+                symbolId = len(self.symbols)
+                ids[symbol] = symbolId
+                self.symbols.append(symbol)
+            uniqueIds[i] = symbolId
+        if len(self.symbols) > nKnown:
+            newSymbols = self.symbols[nKnown:]
+            parsed = parseOptionSymbols(newSymbols)
+            rows = self.columns.extend(len(newSymbols))
+            for name in ['expiry', 'isCall', 'strike']:
+                self.columns[name][rows] = parsed[name].to_numpy()
+            self.roots.extend(parsed['root'].tolist())
+        return uniqueIds.take(codes)
+
+    def symbolsOf(self, symbolIds):
+        '''
+        Symbols of an array of ids, as a list
+        '''
+        symbols = self.symbols
+        return [symbols[i] for i in symbolIds.tolist()]
+
+    def expiries(self, symbolIds):
+        '''
+        Expiry day numbers of an array of ids, NO_EXPIRY if not OCC style
+        '''
+        return self.columns['expiry'][symbolIds]
+
+class GrowingArrays(object):
+    '''
+    Set of named parallel numpy arrays with a used size, growing by doubling
+
+    Inputs:
+        columns -- list of (name, dtype) tuples
+        capacity -- initial number of rows
+    '''
+    def __init__(self, columns, capacity=64):
+        self.size = 0
+        self.names = [name for name, dtype in columns]
+        self.arrays = [np.zeros(capacity, dtype=dtype) for name, dtype in columns]
+
+    def __getitem__(self, name):
+        ''' Whole array of a column, rows past size are not used '''
+        return self.arrays[self.names.index(name)]
+
+    def extend(self, n):
+        '''
+        Add n rows at the end
+
+        Returns:
+        slice of the new rows
+        '''
+        start = self.size
+        if start + n > len(self.arrays[0]):
+            capacity = max(2 * len(self.arrays[0]), start + n)
+            for i, array in enumerate(self.arrays):
+                grown = np.zeros(capacity, dtype=array.dtype)
+                grown[:start] = array[:start]
+                self.arrays[i] = grown
+        self.size = start + n
+        # rows freed by removals may hold old values
+        for array in self.arrays:
+            array[start:self.size] = 0
+        return slice(start, self.size)
+
+class PositionBook(object):
+    '''
+    Positions of a portfolio, indexed by integer ids
+
+    Per-underlying state (stock position, delta, vega) is held in dense
+    arrays indexed by the position of the ticker in stockList. Open option
+    positions are a sparse table of rows holding the contract id, quantity,
+    open sequence number, expiry day, and the last marks of the contract (stock id, multiplier, price, spot, delta, vega), so 
+    a position missing from an option chain keeps its last marks. Expired 
+    positions are swap-removed: the last rows are moved into the freed 
+    slots, so removing k positions costs O(k). The open sequence number 
+    keeps the order positions were opened in, which is the order totals 
+    are summed in. An expiry calendar maps each expiry day to the ids of 
+    the positions expiring that day.
+
+    Inputs:
+        nStock -- number of underlying tickers
+        symbolTable -- SymbolTable of the contract ids
+    '''
+    markNames = ['stockId', 'multiplier', 'price', 'spot', 'delta', 'vega']
+
+    def __init__(self, nStock, symbolTable=None):
+        self.symbolTable = symbolTable if symbolTable is not None else SymbolTable()
+        # dense per-underlying state
+        self.stockPosition = np.zeros(nStock)
+        self.stockDelta = np.zeros(nStock)
+        self.stockVega = np.zeros(nStock)
+        # sparse open option positions
+        self.open = GrowingArrays([('id', np.int64), ('quantity', np.float64), 
+                                   ('seq', np.int64), ('expiry', np.int64), ('stockId', np.int64), 
+                                   ('multiplier', np.float64), ('price', np.float64), 
+                                   ('spot', np.float64), ('delta', np.float64), 
+                                   ('vega', np.float64)])
+        self.slotOf = {}
+        self.nextSeq = 0
+        # expiry day -> set of ids of the open positions expiring that day
+        self.expiryCalendar = {}
+
+    def __len__(self):
+        return self.open.size
+
+    def openSlots(self):
+        '''
+        Slots of the open positions, in the order they were opened
+        '''
+        seq = self.open['seq'][:self.open.size]
+        return np.argsort(seq, kind='stable')
+
+    def ids(self, slots):
+        return self.open['id'][slots]
+
+    def quantities(self, slots):
+        return self.open['quantity'][slots]
+
+    def marks(self, slots):
+        '''
+        Last marks of open positions
+
+        Returns:
+        tuple of arrays in the order of markNames
+        '''
+        return tuple(self.open[name][slots] for name in self.markNames)
+
+    def setMarks(self, slots, *marks):
+        '''
+        Set the marks of open positions, arrays in the order of markNames
+        '''
+        for name, values in zip(self.markNames, marks):
+            self.open[name][slots] = values
+
+    def openSlot(self, symbolId):
+        '''
+        Append a new open position of a contract, with the next open sequence 
+        number, and add it to the expiry calendar
+        '''
+        table = self.open
+        slot = table.extend(1).start
+        self.slotOf[symbolId] = slot
+        table['id'][slot] = symbolId
+        table['seq'][slot] = self.nextSeq
+        self.nextSeq += 1
+        expiry = int(self.symbolTable.expiries(symbolId))
+        table['expiry'][slot] = expiry
+        if expiry != NO_EXPIRY:
+            self.expiryCalendar.setdefault(expiry, set()).add(symbolId)
+        return slot
+
+    def addPositions(self, symbolIds, quantities):
+        '''
+        Add trade quantities to the option positions, in trade order,
+        opening new positions for contracts not held, in order of first 
+        appearance
+
+        Parameters:
+        symbolIds -- contract id of each trade
+        quantities -- quantity of each trade
+
+        Returns:
+        array of int, slot of each trade's position
+        '''
+        slots = np.empty(len(symbolIds), dtype=np.int64)
+        slotOf = self.slotOf
+        for i, symbolId in enumerate(symbolIds.tolist()):
+            slot = slotOf.get(symbolId)
+            if slot is None:
+                slot = self.openSlot(symbolId)
+            slots[i] = slot
+        np.add.at(self.open['quantity'], slots, quantities)
+        return slots
+
+    def expiringMask(self, slots, start, end):
+        '''
+        Flag the positions expiring on a day in [start, end), 
+        from the expiry calendar
+
+        Parameters:
+        slots -- array of open slots, e.g. from openSlots
+        start, end -- datetime, or day numbers
+
+        Returns:
+        array of bool, one per slot
+        '''
+        start, end = dayNumber(start), dayNumber(end)
+        mask = np.zeros(len(slots), dtype=bool)
+        expiring = [self.slotOf[symbolId] for day, symbolIds in self.expiryCalendar.items()
+                    if start <= day < end for symbolId in symbolIds]
+        if expiring:
+            # position of each slot in slots
+            rank = np.empty(self.open.size, dtype=np.int64)
+            rank[slots] = np.arange(len(slots))
+            mask[rank[np.array(expiring, dtype=np.int64)]] = True
+        return mask
+
+    def removeSlots(self, slots):
+        '''
+        Remove open positions by swap-remove, the last rows of the table are
+        moved into the freed slots that remain within the new size
+        '''
+        if len(slots) == 0:
+            return
+        table = self.open
+        size = table.size
+        newSize = size - len(slots)
+        removed = np.zeros(size - newSize, dtype=bool)
+        tail = slots[slots >= newSize]
+        removed[tail - newSize] = True
+        holes = np.sort(slots[slots < newSize])
+        movers = np.flatnonzero(~removed) + newSize
+        for symbolId, expiry in zip(table['id'][slots].tolist(), 
+                                    table['expiry'][slots].tolist()):
+            del self.slotOf[symbolId]
+            if expiry != NO_EXPIRY:
+                expiring = self.expiryCalendar[expiry]
+                expiring.discard(symbolId)
+                if not expiring:
+                    del self.expiryCalendar[expiry]
+        for array in table.arrays:
+            array[holes] = array[movers]
+        for symbolId, slot in zip(table['id'][holes].tolist(), holes.tolist()):
+            self.slotOf[symbolId] = slot
+        table.size = newSize
+
+    def optionPosition(self):
+        '''
+        Open option positions as a dictionary of symbol to quantity,
+        in the order they were opened
+        '''
+        slots = self.openSlots()
+        return dict(zip(self.symbolTable.symbolsOf(self.ids(slots)),
+                        self.quantities(slots).tolist()))
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Chengye
+"""
+
+import os
+import glob
+import queue
+import threading
+import numpy as np
+import pandas as pd
+
+'''
+Result sinks: writers of backtest results.
+
+A run's results are its parameters (a dictionary, e.g. a portfolio spec),
+its daily pnls (the dataFrame returned by BackTest.run), its contract total
+pnls (a dictionary of option symbol to pnl) and its summary metrics (a
+dictionary, e.g. maxDrawDown, longestUnprofitDays and sharpeRatio). Every
+sink has write(params, dailyPnls, contractTotPnl, metrics) and close().
+
+CsvSink writes the portfolio_pnls, contract_total_pnls and other_metrics
+csv files of each run. The columnar sinks append the runs to one dataset
+of three tables, daily, contracts and metrics, with the run parameters
+and a run id as columns; ParquetSink needs pyarrow, NpzSink writes numpy
+.npz files. AsyncSink runs any sink on a background thread.
+'''
+
+class ResultSink(object):
+    '''
+    Base class of the result sinks
+    '''
+    def write(self, params, dailyPnls, contractTotPnl, metrics):
+        '''
+        Write the results of one run
+
+        Parameters:
+        params -- dictionary of run parameters
+        dailyPnls -- dataFrame of daily pnls indexed by date
+        contractTotPnl -- dictionary of option symbol to total pnl
+        metrics -- dictionary of summary metrics
+        '''
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+class CsvSink(ResultSink):
+    '''
+    Write each run as portfolio_pnls, contract_total_pnls and other_metrics
+    csv files, named after the run parameters in nameKeys
+
+    Inputs:
+        savePath -- directory of the csv files
+        nameKeys -- run parameters in the file names, e.g. agreeType gives
+                    portfolio_pnls_True.csv
+    '''
+    def __init__(self, savePath, nameKeys=('agreeType',)):
+        self.savePath = savePath
+        self.nameKeys = list(nameKeys)
+
+    def write(self, params, dailyPnls, contractTotPnl, metrics):
+        suffix = '_'.join('%r' % (params[key],) for key in self.nameKeys)
+        dailyPnls.to_csv(os.path.join(self.savePath, "portfolio_pnls_%s.csv" % suffix))
+        pd.DataFrame.from_dict(data=contractTotPnl, orient='index').to_csv(
+                os.path.join(self.savePath, "contract_total_pnls_%s.csv" % suffix),
+                header=['totalPnls'])
+        pd.Series(metrics).to_csv(
+                os.path.join(self.savePath, "other_metrics_%s.csv" % suffix),
+                header=['values'])
+
+class ColumnarSink(ResultSink):
+    '''
+    Base class of the sinks appending runs to a columnar dataset
+
+    Each table is a directory of part files under path. Rows of several runs
+    are buffered column by column and written as one part file once
+    rowsPerPart rows are buffered, and at close. Every row has the run's
+    parameters and run id as columns. Run ids continue after the runs
+    already in the dataset, so several sessions can append to the same
+    dataset.
+
+    Inputs:
+        path -- directory of the dataset
+        rowsPerPart -- number of rows of the daily and contracts part files
+    '''
+    tables = ['daily', 'contracts', 'metrics']
+    extension = None
+
+    def __init__(self, path, rowsPerPart=1 << 20):
+        self.path = path
+        self.rowsPerPart = rowsPerPart
+        self.buffers = {table: [] for table in self.tables}
+        self.bufferedRows = {table: 0 for table in self.tables}
+        self.nParts = {}
+        for table in self.tables:
+            os.makedirs(os.path.join(path, table), exist_ok=True)
+            self.nParts[table] = len(self.partFiles(table))
+        self.nextRunId = sum(self.countRows(fileName)
+                             for fileName in self.partFiles('metrics'))
+
+    def partFiles(self, table):
+        return sorted(glob.glob(os.path.join(self.path, table, 'part-*' + self.extension)))
+
+    def countRows(self, fileName):
+        raise NotImplementedError
+
+    def writePart(self, fileName, columns):
+        '''
+        Write a dictionary of column arrays to a part file
+        '''
+        raise NotImplementedError
+
+    def paramColumns(self, params, n):
+        # missing parameters are stored as nan, columns of objects 
+        # could not be read back without pickling
+        return {key: np.full(n, np.nan if value is None else value) 
+                for key, value in params.items()}
+
+    def append(self, table, columns):
+        n = len(next(iter(columns.values())))
+        if n == 0:
+            return
+        self.buffers[table].append(columns)
+        self.bufferedRows[table] += n
+        if self.bufferedRows[table] >= self.rowsPerPart:
+            self.flush(table)
+
+    def write(self, params, dailyPnls, contractTotPnl, metrics):
+        params = dict(params, runId=self.nextRunId)
+        self.nextRunId += 1
+        nDays = len(dailyPnls)
+        daily = self.paramColumns(params, nDays)
+        daily['Date'] = dailyPnls.index.to_numpy(dtype='datetime64[ns]')
+        for name in dailyPnls.columns:
+            daily[name] = dailyPnls[name].to_numpy(dtype=np.float64)
+        self.append('daily', daily)
+        contracts = self.paramColumns(params, len(contractTotPnl))
+        contracts['OptionSymbol'] = np.array(list(contractTotPnl), dtype=str)
+        contracts['totalPnls'] = np.fromiter(contractTotPnl.values(), dtype=np.float64,
+                                             count=len(contractTotPnl))
+        self.append('contracts', contracts)
+        row = self.paramColumns(params, 1)
+        row.update({name: np.array([value]) for name, value in metrics.items()})
+        self.append('metrics', row)
+
+    def flush(self, table):
+        blocks = self.buffers[table]
+        if not blocks:
+            return
+        # runs may have different parameters or metrics, a column missing
+        # from a run is stored as nan for its rows, as missing parameters
+        names = list(dict.fromkeys(name for block in blocks for name in block))
+        columns = {}
+        for name in names:
+            columns[name] = np.concatenate([
+                    block[name] if name in block 
+                    else np.full(len(next(iter(block.values()))), np.nan)
+                    for block in blocks])
+        fileName = os.path.join(self.path, table,
+                                'part-%05d%s' % (self.nParts[table], self.extension))
+        tempName = fileName + '.tmp'
+        self.writePart(tempName, columns)
+        os.replace(tempName, fileName)
+        self.nParts[table] += 1
+        self.buffers[table] = []
+        self.bufferedRows[table] = 0
+
+    def close(self):
+        for table in self.tables:
+            self.flush(table)
+
+class ParquetSink(ColumnarSink):
+    '''
+    Columnar sink writing parquet part files, needs pyarrow.
+    Read a table with pandas.read_parquet(os.path.join(path, table)).
+    '''
+    extension = '.parquet'
+
+    def __init__(self, path, rowsPerPart=1 << 20, compression='snappy'):
+        # pyarrow is only imported when a parquet sink is used
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("ParquetSink needs pyarrow, use NpzSink or CsvSink instead")
+        self.pyarrow = pyarrow
+        self.compression = compression
+        ColumnarSink.__init__(self, path, rowsPerPart)
+
+    def countRows(self, fileName):
+        return self.pyarrow.parquet.read_metadata(fileName).num_rows
+
+    def writePart(self, fileName, columns):
+        self.pyarrow.parquet.write_table(self.pyarrow.table(columns), fileName, 
+                                         compression=self.compression)
+
+class NpzSink(ColumnarSink):
+    '''
+    Columnar sink writing numpy .npz part files, one array per column.
+    Read a table with readNpzTable.
+    '''
+    extension = '.npz'
+
+    def countRows(self, fileName):
+        with np.load(fileName) as part:
+            return len(part[part.files[0]])
+
+    def writePart(self, fileName, columns):
+        with open(fileName, 'wb') as f:
+            np.savez(f, **columns)
+
+def readNpzTable(path, table):
+    '''
+    Read a table of a dataset written by NpzSink
+
+    Parameters:
+    path -- directory of the dataset
+    table -- 'daily', 'contracts' or 'metrics'
+
+    Returns:
+    dataFrame of all the runs' rows
+    '''
+    frames = []
+    for fileName in sorted(glob.glob(os.path.join(path, table, 'part-*.npz'))):
+        with np.load(fileName) as part:
+            frames.append(pd.DataFrame({name: part[name] for name in part.files}))
+    if not frames:
+        return pd.DataFrame()
+    return pd.concat(frames, ignore_index=True)
+
+class AsyncSink(ResultSink):
+    '''
+    Run a sink on a background thread, write() only queues the run
+
+    The queue holds at most maxPending runs, write() blocks when it is full
+    so a slow disk cannot fill the memory. An error of the wrapped sink is
+    raised by the next write() or by close().
+
+    Inputs:
+        sink -- ResultSink to run on the background thread
+        maxPending -- largest number of queued runs
+    '''
+    def __init__(self, sink, maxPending=64):
+        self.sink = sink
+        self.queue = queue.Queue(maxPending)
+        self.error = None
+        self.thread = threading.Thread(target=self.work, name='resultSink', daemon=True)
+        self.thread.start()
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is None:
+                try:
+                    self.sink.write(*item)
+                except Exception as e:
+                    self.error = e
+        try:
+            self.sink.close()
+        except Exception as e:
+            if self.error is None:
+                self.error = e
+
+    def raiseError(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def write(self, params, dailyPnls, contractTotPnl, metrics):
+        self.raiseError()
+        self.queue.put((params, dailyPnls, contractTotPnl, metrics))
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.raiseError()
+
+def makeSink(path, fmt='csv', background=True, **kwargs):
+    '''
+    Make a result sink
+
+    Parameters:
+    path -- directory of the results
+    fmt -- 'csv', 'parquet' or 'npz'
+    background -- True to write on a background thread, see AsyncSink
+    kwargs -- arguments of the sink class
+
+    Returns:
+    ResultSink object
+    '''
+    sinkClasses = {'csv': CsvSink, 'parquet': ParquetSink, 'npz': NpzSink}
+    if fmt not in sinkClasses:
+        raise ValueError("Unknown result format %r" % fmt)
+    sink = sinkClasses[fmt](path, **kwargs)
+    return AsyncSink(sink) if background else sink
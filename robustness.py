@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Chengye
+"""
+
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+'''
+Robustness of backtest results: walk-forward windows, block bootstrap
+confidence intervals and subperiod breakdowns of daily pnls.
+
+The inputs are daily pnls as returned by BackTest.run (the DailyTotPnl
+column is used), as Series, or as a dataFrame with one column of daily pnls
+per portfolio, e.g. the agree and disagree portfolios of one backtest:
+    pnls = pd.DataFrame({agreeType: bt.run(agreeType)[0]['DailyTotPnl']
+                         for agreeType in [True, False]})
+    blockBootstrap(pnls, nResamples=5000)
+    walkForward(pnls, trainDays=120, testDays=20)
+    subperiods(pnls, freq='Q')
+
+Metrics are computed on (resample x day) arrays at once: every resample
+or window is one row of a 2-D array of indices into the daily pnls, and
+sharpeRatios and maxDrawdowns reduce the rows. They give the same values
+as Metrics.calcSharpeRatio and Metrics.calcDrawdowns on each row.
+'''
+
+def toPnlFrame(pnls):
+    '''
+    Daily pnls as a dataFrame with one column per portfolio
+
+    Parameters:
+    pnls -- dataFrame returned by BackTest.run, Series of daily pnls,
+            dataFrame of daily pnls per portfolio or dictionary of any of
+            them by portfolio name
+    '''
+    if isinstance(pnls, dict):
+        return pd.DataFrame({name: toPnlFrame(value).iloc[:, 0]
+                             for name, value in pnls.items()})
+    if isinstance(pnls, pd.Series):
+        return pnls.to_frame(pnls.name if pnls.name is not None else 'pnl')
+    if 'DailyTotPnl' in pnls.columns:
+        return pnls[['DailyTotPnl']]
+    return pnls
+
+def sharpeRatios(pnls, periods=252):
+    '''
+    Annualized sharpe ratio of each row, as Metrics.calcSharpeRatio
+
+    Parameters:
+    pnls -- (rows x days) array of daily pnls
+    periods -- number of periods in one year
+
+    Returns:
+    array of the sharpe ratio of each row, +-inf or nan for rows of
+    constant pnls
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.sqrt(periods) * pnls.mean(axis=-1) / pnls.std(axis=-1)
+
+def maxDrawdowns(pnls):
+    '''
+    Max drawdown of each row, as Metrics.calcDrawdowns, the peak of the
+    cumulative pnl starts at the first day
+
+    Parameters:
+    pnls -- (rows x days) array of daily pnls
+
+    Returns:
+    array of the max drawdown (zero or negative) of each row
+    '''
+    cumPnls = np.cumsum(pnls, axis=-1)
+    return (cumPnls - np.maximum.accumulate(cumPnls, axis=-1)).min(axis=-1)
+
+def blockIndices(nDays, nResamples, blockSize, rng):
+    '''
+    Indices of circular block bootstrap resamples
+
+    Each resample joins blocks of blockSize consecutive days starting at
+    random days, wrapping around the end of the history, cut to nDays.
+
+    Returns:
+    (nResamples x nDays) array of int
+    '''
+    nBlocks = -(-nDays // blockSize)
+    starts = rng.integers(0, nDays, size=(nResamples, nBlocks, 1))
+    indices = (starts + np.arange(blockSize)) % nDays
+    return indices.reshape(nResamples, nBlocks * blockSize)[:, :nDays]
+
+def blockBootstrap(pnls, nResamples=2000, blockSize=None, confidence=0.95, seed=0,
+                   periods=252, chunkSize=1000):
+    '''
+    Block bootstrap confidence intervals of the sharpe ratio and max drawdown
+
+    Blocks of consecutive days keep the autocorrelation of the daily pnls.
+    All the portfolios of pnls are resampled with the same indices, so
+    their intervals are comparable day for day. The resamples are drawn
+    chunkSize at a time to bound the memory.
+
+    Parameters:
+    pnls -- daily pnls, see toPnlFrame
+    nResamples -- number of resamples
+    blockSize -- number of days per block, default the cube root of the
+                 number of days
+    confidence -- confidence level of the intervals
+    seed -- seed of the random generator, or a numpy Generator
+    periods -- number of periods in one year
+
+    Returns:
+    dataFrame indexed by (portfolio, metric) with columns estimate (full
+    history), mean, stdError, lower and upper bounds of the interval and
+    probPositive (fraction of resamples with a positive sharpe ratio, or
+    with no drawdown)
+    '''
+    frame = toPnlFrame(pnls)
+    values = frame.to_numpy(dtype=np.float64).T
+    nDays = values.shape[1]
+    if nDays == 0:
+        raise ValueError("No daily pnls to resample")
+    if blockSize is None:
+        blockSize = max(1, int(round(nDays ** (1 / 3))))
+    rng = np.random.default_rng(seed)
+    sharpe = np.empty((len(values), nResamples))
+    drawdown = np.empty((len(values), nResamples))
+    for start in range(0, nResamples, chunkSize):
+        stop = min(start + chunkSize, nResamples)
+        indices = blockIndices(nDays, stop - start, blockSize, rng)
+        for i, column in enumerate(values):
+            resampled = column[indices]
+            sharpe[i, start:stop] = sharpeRatios(resampled, periods)
+            drawdown[i, start:stop] = maxDrawdowns(resampled)
+    tail = (1 - confidence) / 2 * 100
+    rows = []
+    for i, name in enumerate(frame.columns):
+        for metric, samples, estimate in [
+                ('sharpeRatio', sharpe[i], sharpeRatios(values[i], periods)),
+                ('maxDrawDown', drawdown[i], maxDrawdowns(values[i]))]:
+            finite = samples[np.isfinite(samples)]
+            lower, upper = np.percentile(finite, [tail, 100 - tail]) if len(finite) \
+                           else (np.nan, np.nan)
+            rows.append({'portfolio': name, 'metric': metric, 'estimate': estimate,
+                         'mean': finite.mean() if len(finite) else np.nan,
+                         'stdError': finite.std() if len(finite) else np.nan,
+                         'lower': lower, 'upper': upper,
+                         'probPositive': np.mean(samples > 0) if metric == 'sharpeRatio'
+                                         else np.mean(samples == 0)})
+    return pd.DataFrame(rows).set_index(['portfolio', 'metric'])
+
+def windowSharpeRatios(values, starts, stops, periods=252):
+    '''
+    Sharpe ratio of the days [start, stop) of each window from cumulative
+    sums, for windows of any length
+
+    Parameters:
+    values -- (portfolios x days) array of daily pnls
+    starts, stops -- arrays of int, bounds of each window
+
+    Returns:
+    (portfolios x windows) array
+    '''
+    cumPnls = np.concatenate([np.zeros((len(values), 1)), np.cumsum(values, axis=1)], axis=1)
+    mean = (cumPnls[:, stops] - cumPnls[:, starts]) / (stops - starts)
+    # variance from the deviations to the window mean, not from sums of
+    # squares, so large pnls do not lose precision
+    nDays = stops - starts
+    days = starts[:, None] + np.arange(nDays.max())
+    inWindow = days < stops[:, None]
+    deviation = values[:, np.where(inWindow, days, 0)] - mean[:, :, None]
+    variance = np.where(inWindow, deviation ** 2, 0).sum(axis=2) / nDays
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.sqrt(periods) * mean / np.sqrt(variance)
+
+def walkForward(pnls, trainDays, testDays, step=None, anchored=False, periods=252):
+    '''
+    Walk-forward windows of the daily pnls
+
+    Each window has trainDays days of training followed by testDays days of
+    testing, the windows move forward by step days. With anchored the
+    training days always start at the first day. In each window the
+    portfolio with the best training sharpe ratio is selected, and its test
+    pnl is the out-of-sample pnl of the selection.
+
+    Parameters:
+    pnls -- daily pnls, see toPnlFrame
+    trainDays -- number of training days
+    testDays -- number of test days
+    step -- number of days between windows, default testDays
+    anchored -- train from the first day instead of a moving window
+    periods -- number of periods in one year
+
+    Returns:
+    dataFrame with one row per window: the train and test dates, the train
+    and test sharpe ratios, test pnl and test max drawdown of each portfolio
+    (columns named e.g. trainSharpe_True) and the selected portfolio with
+    its test pnl
+    '''
+    frame = toPnlFrame(pnls)
+    values = frame.to_numpy(dtype=np.float64).T
+    dates = frame.index
+    nDays = values.shape[1]
+    step = testDays if step is None else step
+    testStarts = np.arange(trainDays, nDays - testDays + 1, step)
+    if len(testStarts) == 0:
+        raise ValueError("%d days are too few for %d train and %d test days"
+                         % (nDays, trainDays, testDays))
+    trainStarts = np.zeros_like(testStarts) if anchored else testStarts - trainDays
+    trainSharpe = windowSharpeRatios(values, trainStarts, testStarts, periods)
+    # test windows have the same length, one (window x day) index array
+    testIndices = testStarts[:, None] + np.arange(testDays)
+    result = {'trainStart': dates[trainStarts], 'trainEnd': dates[testStarts - 1],
+              'testStart': dates[testStarts], 'testEnd': dates[testStarts + testDays - 1]}
+    testPnl = np.empty_like(trainSharpe)
+    for i, name in enumerate(frame.columns):
+        tested = values[i][testIndices]
+        testPnl[i] = tested.sum(axis=1)
+        result['trainSharpe_%s' % name] = trainSharpe[i]
+        result['testSharpe_%s' % name] = sharpeRatios(tested, periods)
+        result['testPnl_%s' % name] = testPnl[i]
+        result['testMaxDrawDown_%s' % name] = maxDrawdowns(tested)
+    selected = np.argmax(np.where(np.isnan(trainSharpe), -np.inf, trainSharpe), axis=0)
+    result['selected'] = frame.columns[selected]
+    result['selectedTestPnl'] = testPnl[selected, np.arange(len(testStarts))]
+    return pd.DataFrame(result)
+
+def subperiods(pnls, freq='Q', periods=252):
+    '''
+    Metrics of each calendar subperiod of the daily pnls
+
+    Parameters:
+    pnls -- daily pnls indexed by date, see toPnlFrame
+    freq -- pandas period frequency of the subperiods, e.g. 'M', 'Q', 'Y'
+    periods -- number of periods in one year
+
+    Returns:
+    dataFrame indexed by (subperiod, portfolio) with columns days, totPnl,
+    sharpeRatio and maxDrawDown
+    '''
+    frame = toPnlFrame(pnls)
+    period = pd.DatetimeIndex(frame.index).to_period(freq)
+    frames = []
+    for name in frame.columns:
+        pnl = pd.Series(frame[name].to_numpy(dtype=np.float64), index=frame.index)
+        groups = pnl.groupby(period)
+        cumPnls = groups.cumsum()
+        drawdown = cumPnls - cumPnls.groupby(period).cummax()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sharpe = np.sqrt(periods) * groups.mean() / groups.std(ddof=0)
+        frames.append(pd.DataFrame({'portfolio': name,
+                                    'days': groups.size(),
+                                    'totPnl': groups.sum(),
+                                    'sharpeRatio': sharpe,
+                                    'maxDrawDown': drawdown.groupby(period).min()}))
+    result = pd.concat(frames)
+    result.index.name = 'subperiod'
+    return result.set_index('portfolio', append=True).sort_index(level=0, sort_remaining=False)
+
+def bootstrapMany(pnlsByRun, maxWorkers=None, seed=0, **kwargs):
+    '''
+    Block bootstrap of many runs, e.g. the portfolios of a sweep, across a
+    process pool
+
+    Every run gets its own random stream spawned from seed, so the results
+    do not depend on the number of workers.
+
+    Parameters:
+    pnlsByRun -- dictionary of run name to daily pnls, see toPnlFrame
+    maxWorkers -- number of worker processes, 1 to run in this process,
+                  default the number of cpus
+    seed -- seed of the random streams
+    kwargs -- arguments of blockBootstrap
+
+    Returns:
+    dataFrame of the blockBootstrap results, indexed by (run, portfolio,
+    metric)
+    '''
+    names = list(pnlsByRun)
+    seeds = [np.random.default_rng(child) for child in
+             np.random.SeedSequence(seed).spawn(len(names))]
+    args = [(pnlsByRun[name], rng) for name, rng in zip(names, seeds)]
+    if maxWorkers == 1 or len(names) <= 1:
+        results = [runBootstrap(arg, kwargs) for arg in args]
+    else:
+        with ProcessPoolExecutor(maxWorkers) as executor:
+            results = list(executor.map(runBootstrap, args, [kwargs] * len(args)))
+    if not results:
+        return pd.DataFrame()
+    return pd.concat(results, keys=names, names=['run'])
+
+def runBootstrap(arg, kwargs):
+    ''' blockBootstrap of one run, on a worker process '''
+    pnls, rng = arg
+    return blockBootstrap(pnls, seed=rng, **kwargs)
@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Chengye
+"""
+
+import os
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from base import OptionChain, TradeBatch
+
+class OptionSnapshotIndex(object):
+    '''
+    Per-date partition of the option data, built once per BackTest
+
+    The option data is sorted by DataDate (stable, so the original row order
+    within a date is kept) and the start/end row offsets of every date are
+    stored. Looking up one day's snapshot is then a slice of the sorted data
+    instead of a boolean mask over the whole table.
+
+    Inputs:
+        optionData -- dataFrame of all options information
+        cachedDates -- number of dates whose symbol -> row maps are kept,
+                       the most recently used ones
+    '''
+    def __init__(self, optionData, cachedDates=4):
+        if optionData['DataDate'].is_monotonic_increasing:
+            # already partitioned by date, use the data as it is without a copy
+            self.optionData = optionData
+        else:
+            self.optionData = optionData.sort_values(
+                    'DataDate', kind='mergesort').reset_index(drop=True)
+        dates = self.optionData['DataDate'].values
+        # first row of each date in the sorted data
+        starts = np.flatnonzero(np.r_[True, dates[1:] != dates[:-1]]) \
+                 if len(dates) > 0 else np.array([], dtype=np.int64)
+        ends = np.r_[starts[1:], len(dates)].astype(np.int64)
+        self.dateList = list(self.optionData['DataDate'].iloc[starts])
+        self.bounds = dict(zip(self.dateList, zip(starts.tolist(), ends.tolist())))
+        # underlying tickers interned once, so chains share ticker ids
+        self.tickers = sorted(set(self.optionData['UnderlyingSymbol']))
+        self.underlyingIds = np.searchsorted(
+                self.tickers, self.optionData['UnderlyingSymbol'].values.astype(str))
+        # numeric columns as arrays, chains are views into them
+        self.columns = {col: self.optionData[col].to_numpy(dtype=np.float64) 
+                        for col in ['Delta', 'UnderlyingPrice', 'Signal', 
+                                    'Multiplier', 'Vega', 'Last']}
+        self.symbols = self.optionData['OptionSymbol'].to_numpy(dtype=object)
+        # symbol -> row position maps of the recently used dates, shared by 
+        # the portfolios of a run, older ones are dropped so the maps do not
+        # grow to one entry per row of the history
+        self.cachedDates = cachedDates
+        self.symbolIndex = OrderedDict()
+
+    def getRows(self, date):
+        '''
+        Get all the option rows of a certain date
+
+        Parameters:
+        date -- datetime
+
+        Returns:
+        dataFrame slice of the sorted option data, empty if date not found
+        '''
+        start, end = self.bounds.get(date, (0, 0))
+        return self.optionData.iloc[start:end]
+
+    def getSymbolIndex(self, date):
+        '''
+        Get the option symbol -> row position map of a certain date,
+        row positions are relative to the date's slice
+
+        Parameters:
+        date -- datetime
+
+        Returns:
+        dictionary of option symbol to row position
+        '''
+        symbolIndex = self.symbolIndex.get(date)
+        if symbolIndex is None:
+            start, end = self.bounds.get(date, (0, 0))
+            symbolIndex = dict(zip(self.symbols[start:end].tolist(), range(end - start)))
+            self.symbolIndex[date] = symbolIndex
+            if len(self.symbolIndex) > self.cachedDates:
+                self.symbolIndex.popitem(last=False)
+        else:
+            self.symbolIndex.move_to_end(date)
+        return symbolIndex
+
+    def getChain(self, date):
+        '''
+        Get the option chain of a certain date
+
+        Parameters:
+        date -- datetime
+
+        Returns:
+        OptionChain, arrays are views into the index columns
+        '''
+        start, end = self.bounds.get(date, (0, 0))
+        rows = slice(start, end)
+        return OptionChain(date, 
+                           self.symbols[rows], 
+                           self.underlyingIds[rows], 
+                           self.tickers, 
+                           self.columns['Delta'][rows], 
+                           self.columns['UnderlyingPrice'][rows], 
+                           self.columns['Signal'][rows], 
+                           self.columns['Multiplier'][rows], 
+                           self.columns['Vega'][rows], 
+                           self.columns['Last'][rows],
+                           self.getSymbolIndex(date))
+
+    def iterChains(self, dates=None):
+        '''
+        Generator of the option chains of all dates, in date order
+
+        Parameters:
+        dates -- list of dates to load, in date order, default all dates
+        '''
+        for date in (self.dateList if dates is None else dates):
+            yield self.getChain(date)
+
+class TradeBlotter(object):
+    '''
+    Per-date index of the trade data
+
+    The trades are sorted once by (Date, Time), stable so fills with the same
+    time keep their file order, and the start/end offsets of every date are
+    stored. One date's trades are then a TradeBatch of array slices, no 
+    filtering, sorting or per-fill objects are needed.
+
+    Inputs:
+        tradeData -- dataFrame of all trade information
+    '''
+    def __init__(self, tradeData):
+        tradeData = tradeData.sort_values(['Date', 'Time'], kind='mergesort')
+        dates = tradeData['Date'].values
+        starts = np.flatnonzero(np.r_[True, dates[1:] != dates[:-1]]) \
+                 if len(dates) > 0 else np.array([], dtype=np.int64)
+        ends = np.r_[starts[1:], len(dates)].astype(np.int64)
+        self.dateList = list(tradeData['Date'].iloc[starts])
+        self.bounds = dict(zip(self.dateList, zip(starts.tolist(), ends.tolist())))
+        self.times = tradeData['Time'].to_numpy(dtype=object)
+        self.symbols = tradeData['OptionSymbol'].to_numpy(dtype=object)
+        self.prices = tradeData['Price'].to_numpy(dtype=np.float64)
+        self.vegas = tradeData['Vega'].to_numpy(dtype=np.float64)
+        self.quantities = tradeData['Quantity'].to_numpy()
+
+    def getBatch(self, date):
+        '''
+        Get all the trades of a certain date
+
+        Parameters:
+        date -- datetime
+
+        Returns:
+        TradeBatch in trade time ascending order, empty if no trades that date
+        '''
+        start, end = self.bounds.get(date, (0, 0))
+        rows = slice(start, end)
+        return TradeBatch(date, self.times[rows], self.symbols[rows], 
+                          self.prices[rows], self.vegas[rows], 
+                          self.quantities[rows])
+
+def chainFromFrame(date, frame, tickers, tickerIndex):
+    '''
+    Build the option chain of one date from a dataFrame of that date's rows
+
+    Parameters:
+    date -- datetime
+    frame -- dataFrame with the option data columns, rows of one date
+    tickers -- list of all underlying tickers
+    tickerIndex -- pandas Index of tickers
+
+    Returns:
+    OptionChain
+    '''
+    underlyingIds = tickerIndex.get_indexer(frame['UnderlyingSymbol'])
+    if (underlyingIds < 0).any():
+        raise ValueError("Unknown underlying ticker on %s" % str(date)[:10])
+    return OptionChain(date, 
+                       frame['OptionSymbol'].to_numpy(dtype=object), 
+                       underlyingIds, 
+                       tickers, 
+                       frame['Delta'].to_numpy(dtype=np.float64), 
+                       frame['UnderlyingPrice'].to_numpy(dtype=np.float64), 
+                       frame['Signal'].to_numpy(dtype=np.float64), 
+                       frame['Multiplier'].to_numpy(dtype=np.float64), 
+                       frame['Vega'].to_numpy(dtype=np.float64), 
+                       frame['Last'].to_numpy(dtype=np.float64))
+
+class CsvOptionSource(object):
+    '''
+    Streaming option source reading a csv file in chunks
+
+    The file must be in date order (all rows of a date together, dates
+    ascending). Only the rows of the current chunk and the current date are
+    held in memory. Dates and tickers are found by a first pass that only
+    parses the DataDate and UnderlyingSymbol columns.
+
+    Inputs:
+        fileName -- path of the option csv file
+        chunkSize -- number of rows per csv chunk
+        tickers -- list of all underlying tickers, scanned from the file if None
+    '''
+    def __init__(self, fileName, chunkSize=200000, tickers=None):
+        self.fileName = fileName
+        self.chunkSize = chunkSize
+        dates = set()
+        scanTickers = set()
+        for chunk in pd.read_csv(fileName, usecols=['DataDate', 'UnderlyingSymbol'], 
+                                 chunksize=chunkSize):
+            dates.update(pd.to_datetime(chunk['DataDate']).unique())
+            if tickers is None:
+                scanTickers.update(chunk['UnderlyingSymbol'].unique())
+        self.dateList = sorted(pd.Timestamp(date) for date in dates)
+        self.tickers = sorted(scanTickers) if tickers is None else list(tickers)
+        self.tickerIndex = pd.Index(self.tickers)
+
+    def iterChains(self, dates=None):
+        '''
+        Generator of the option chains of all dates, in date order
+
+        Parameters:
+        dates -- list of dates to load, in date order, default all dates,
+                 chunks before the first date are parsed but not kept
+        '''
+        wanted = None if dates is None else set(dates)
+        pending = None
+        for chunk in pd.read_csv(self.fileName, chunksize=self.chunkSize):
+            chunk['DataDate'] = pd.to_datetime(chunk['DataDate'])
+            if pending is not None:
+                chunk = pd.concat([pending, chunk], ignore_index=True)
+            dates = chunk['DataDate'].to_numpy()
+            if (dates[1:] < dates[:-1]).any():
+                raise ValueError("%s is not in date order" % self.fileName)
+            # the last date of the chunk may continue in the next chunk
+            last = np.searchsorted(dates, dates[-1], side='left')
+            for date, frame in chunk.iloc[:last].groupby('DataDate', sort=False):
+                if wanted is None or date in wanted:
+                    yield chainFromFrame(date, frame, self.tickers, self.tickerIndex)
+            pending = chunk.iloc[last:]
+        if pending is not None and len(pending) > 0:
+            date = pending['DataDate'].iloc[0]
+            if wanted is None or date in wanted:
+                yield chainFromFrame(date, pending, self.tickers, self.tickerIndex)
+
+class PartitionedOptionSource(object):
+    '''
+    Streaming option source reading one csv file per date, 
+    as written by partitionOptionFile
+
+    Inputs:
+        directory -- directory of the per-date files, named YYYYMMDD.csv
+        tickers -- list of all underlying tickers, scanned from the files if None
+    '''
+    def __init__(self, directory, tickers=None):
+        self.directory = directory
+        fileNames = sorted(f for f in os.listdir(directory) if f.endswith('.csv'))
+        self.files = [(pd.Timestamp(f[:-4]), os.path.join(directory, f)) 
+                      for f in fileNames]
+        self.dateList = [date for date, path in self.files]
+        if tickers is None:
+            scanTickers = set()
+            for date, path in self.files:
+                scanTickers.update(pd.read_csv(path, usecols=['UnderlyingSymbol'])
+                                   ['UnderlyingSymbol'].unique())
+            tickers = sorted(scanTickers)
+        self.tickers = list(tickers)
+        self.tickerIndex = pd.Index(self.tickers)
+
+    def iterChains(self, dates=None):
+        '''
+        Generator of the option chains of all dates, in date order
+
+        Parameters:
+        dates -- list of dates to load, in date order, default all dates,
+                 files of other dates are not read
+        '''
+        wanted = None if dates is None else set(dates)
+        for date, path in self.files:
+            if wanted is None or date in wanted:
+                yield chainFromFrame(date, pd.read_csv(path), self.tickers, self.tickerIndex)
+
+def partitionOptionFile(fileName, directory, chunkSize=200000):
+    '''
+    Split an option csv file into one csv file per date, reading it in chunks,
+    the input file does not need to be in date order. The files are written
+    as YYYYMMDD.csv.tmp and renamed once the whole input is read, so readers
+    watching the directory never see a partly written file.
+
+    Parameters:
+    fileName -- path of the option csv file
+    directory -- output directory, files are named YYYYMMDD.csv
+    chunkSize -- number of rows per csv chunk
+    '''
+    os.makedirs(directory, exist_ok=True)
+    written = set()
+    for chunk in pd.read_csv(fileName, chunksize=chunkSize):
+        for date, frame in chunk.groupby(pd.to_datetime(chunk['DataDate']), sort=False):
+            path = os.path.join(directory, date.strftime('%Y%m%d') + '.csv')
+            # start fresh files on first write, append afterwards
+            frame.to_csv(path + '.tmp', mode='a' if path in written else 'w', 
+                         header=path not in written, index=False)
+            written.add(path)
+    # publish each file by rename, a date can get rows from any chunk
+    for path in sorted(written):
+        os.replace(path + '.tmp', path)
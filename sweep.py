@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Chengye
+"""
+
+import os
+import math
+import argparse
+import itertools
+import logging
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from backTester import BackTest, readData
+from resultSink import makeSink
+
+class SharedFrame(object):
+    '''
+    Class for a dataFrame stored column by column in shared memory
+
+    Numeric and datetime columns are copied into shared memory blocks as they
+    are. Other columns (symbols, trade times) are stored as integer codes in
+    shared memory plus a small array of unique values. The object itself only
+    holds the block names and metadata, so it is cheap to pickle to workers.
+
+    Inputs:
+        frame -- dataFrame to share
+    '''
+    def __init__(self, frame):
+        self.length = len(frame)
+        self.columns = []
+        # shared memory blocks, only kept by the process that created them
+        self.blocks = []
+        for name in frame.columns:
+            values = frame[name].to_numpy()
+            uniques = None
+            if values.dtype == object:
+                codes, uniques = pd.factorize(values)
+                values = codes.astype(np.int32)
+            elif values.dtype.kind == 'M':
+                values = values.astype('datetime64[ns]')
+            block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+            np.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)[:] = values
+            self.blocks.append(block)
+            self.columns.append((name, block.name, values.dtype.str, uniques))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['blocks'] = []
+        return state
+
+    def attach(self):
+        '''
+        Build a dataFrame on top of the shared memory blocks,
+        numeric columns are not copied
+
+        Returns:
+        dataFrame with the same columns as the shared frame
+        '''
+        data = {}
+        for name, blockName, dtype, uniques in self.columns:
+            block = shared_memory.SharedMemory(name=blockName)
+            # keep the block open as long as this object lives
+            self.blocks.append(block)
+            values = np.ndarray((self.length,), dtype=np.dtype(dtype), buffer=block.buf)
+            if uniques is not None:
+                codes = values
+                values = np.asarray(uniques, dtype=object).take(codes)
+                # missing values are stored as code -1
+                missing = codes < 0
+                if missing.any():
+                    values[missing] = np.nan
+            data[name] = values
+        return pd.DataFrame(data, copy=False)
+
+    def unlink(self):
+        '''
+        Release the shared memory blocks, only called by the creating process
+        '''
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+def makeGrid(vegaLimits, irs, costs, agreeTypes=(True, False)):
+    '''
+    Make the list of portfolio specs of a parameter grid
+
+    Parameters:
+    vegaLimits, irs, costs -- lists of parameter values
+    agreeTypes -- list of bool
+
+    Returns:
+    list of portfolio spec dictionaries, one per combination
+    '''
+    return [{'vegaLimit': vegaLimit, 'ir': ir, 'cost': cost, 'agreeType': agreeType}
+            for vegaLimit, ir, cost, agreeType
+            in itertools.product(vegaLimits, irs, costs, agreeTypes)]
+
+def prepareOptionData(optionData):
+    '''
+    Sort option data by date and cast the numeric columns to float, so the
+    workers can build their snapshot index on the shared data without copies
+    '''
+    optionData = optionData.sort_values('DataDate', kind='mergesort').reset_index(drop=True)
+    for col in ['Delta', 'UnderlyingPrice', 'Signal', 'Multiplier', 'Vega', 'Last']:
+        optionData[col] = optionData[col].astype(np.float64)
+    return optionData
+
+def summarize(spec, portfolio):
+    '''
+    Summary metrics of one backtest, from the portfolio's online pnl metrics
+
+    Returns:
+    dictionary of spec parameters and pnl metrics
+    '''
+    maxDrawdown, longestUnprofit = portfolio.metrics.drawdowns()
+    sharpeRatio = portfolio.metrics.sharpeRatio()
+    row = dict(spec)
+    row.update({'totPnl': portfolio.totPnl,
+                'maxDrawDown': maxDrawdown,
+                'longestUnprofitDays': longestUnprofit,
+                'sharpeRatio': sharpeRatio})
+    return row
+
+# BackTest of a worker process, built once from the shared data
+workerState = {}
+
+def initWorker(sharedOption, sharedTrade, vegaLimit, ir, cost):
+    optionData = sharedOption.attach()
+    tradeData = sharedTrade.attach()
+    workerState['shared'] = (sharedOption, sharedTrade)
+    workerState['bt'] = BackTest(optionData, tradeData, vegaLimit, ir, cost)
+
+def runSpecs(specs, keepResults=False):
+    '''
+    Run a chunk of portfolio specs in a single pass, in a worker process
+    
+    Returns:
+    list of summary rows, and the list of (dailyPnls, contractTotPnl) 
+    results of runMany if keepResults, else None
+    '''
+    bt = workerState['bt']
+    results = bt.runMany(specs)
+    rows = [summarize(spec, pf) for spec, pf in zip(specs, bt.portfolios)]
+    return rows, results if keepResults else None
+
+def runSweep(optionData, tradeData, specs, maxWorkers=None, chunkSize=None, 
+             sink=None):
+    '''
+    Run backtests for a list of portfolio specs across a process pool.
+    Option and trade data are put into shared memory once and every worker
+    builds its BackTest from them. Specs are sent in chunks, each chunk is
+    run with BackTest.runMany in a single pass over the dates.
+
+    Parameters:
+    optionData -- dataFrame of all options information
+    tradeData -- dataFrame of all trade information
+    specs -- list of portfolio spec dictionaries, see makeGrid
+    maxWorkers -- number of worker processes, default number of cores
+    chunkSize -- number of specs per task, default spreads the specs evenly
+                 over the workers
+    sink -- resultSink.ResultSink the daily pnls, contract total pnls and 
+            summary metrics of every spec are written to as the chunks 
+            complete, None to only return the summaries
+
+    Returns:
+    dataFrame with one row per spec, spec parameters and pnl metrics
+    '''
+    if maxWorkers is None:
+        maxWorkers = os.cpu_count() or 1
+    if chunkSize is None:
+        chunkSize = max(1, math.ceil(len(specs) / (maxWorkers * 4)))
+    chunks = [specs[i:i+chunkSize] for i in range(0, len(specs), chunkSize)]
+    sharedOption = SharedFrame(prepareOptionData(optionData))
+    sharedTrade = SharedFrame(tradeData)
+    specKeys = set(key for spec in specs for key in spec)
+    rows = []
+    try:
+        # BackTest defaults are never used, every spec sets all parameters
+        with ProcessPoolExecutor(maxWorkers, initializer=initWorker,
+                                 initargs=(sharedOption, sharedTrade, 0, 0, 0)) as pool:
+            keepResults = [sink is not None] * len(chunks)
+            for chunkRows, results in pool.map(runSpecs, chunks, keepResults):
+                rows.extend(chunkRows)
+                if sink is not None:
+                    for row, (dailyPnls, contractTotPnl) in zip(chunkRows, results):
+                        params = {key: row[key] for key in row if key in specKeys}
+                        metrics = {key: row[key] for key in row if key not in specKeys}
+                        sink.write(params, dailyPnls, contractTotPnl, metrics)
+    finally:
+        sharedOption.unlink()
+        sharedTrade.unlink()
+    return pd.DataFrame(rows)
+
+def parseArgs(argv=None):
+    path = os.path.abspath(os.path.join(__file__, '..'))
+    parser = argparse.ArgumentParser(description='Parameter sweep of option backtests')
+    parser.add_argument('--optionFile', default=os.path.join(path, 'option_sample.csv'))
+    parser.add_argument('--tradeFile', default=os.path.join(path, 'trade_sample.csv'))
+    parser.add_argument('--vegaLimit', type=float, nargs='+', default=[5000])
+    parser.add_argument('--ir', type=float, nargs='+', default=[0.015])
+    parser.add_argument('--cost', type=float, nargs='+', default=[0.005])
+    parser.add_argument('--agreeType', nargs='+', default=['True', 'False'],
+                        choices=['True', 'False'])
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--chunkSize', type=int, default=None)
+    parser.add_argument('--output', default=os.path.join(path, 'sweep_results.csv'))
+    parser.add_argument('--resultsDir', default=None, 
+                        help='directory to write the daily and contract pnls of every run to')
+    parser.add_argument('--format', default='npz', choices=['npz', 'parquet', 'csv'],
+                        help='format of the results in resultsDir')
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    args = parseArgs()
+    optionData, tradeData = readData(args.optionFile, args.tradeFile)
+    specs = makeGrid(args.vegaLimit, args.ir, args.cost,
+                     [agreeType == 'True' for agreeType in args.agreeType])
+    logging.info("Sweeping %d portfolio specs" % len(specs))
+    sink = None
+    if args.resultsDir is not None:
+        os.makedirs(args.resultsDir, exist_ok=True)
+        sink = makeSink(args.resultsDir, args.format, 
+                        **({'nameKeys': ['vegaLimit', 'ir', 'cost', 'agreeType']} 
+                           if args.format == 'csv' else {}))
+    try:
+        results = runSweep(optionData, tradeData, specs, args.workers, args.chunkSize, 
+                           sink)
+    finally:
+        if sink is not None:
+            sink.close()
+    results.to_csv(args.output, index=False)
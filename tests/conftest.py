@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Chengye
+"""
+
+import os
+import sys
+import pytest
+
+# the library modules are flat files in the repo root
+libraryPath = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, libraryPath)
+
+@pytest.fixture(scope='module')
+def sampleBackTest():
+    from backTester import BackTest, readData
+    optionData, tradeData = readData(os.path.join(libraryPath, 'option_sample.csv'),
+                                     os.path.join(libraryPath, 'trade_sample.csv'))
+    return BackTest(optionData, tradeData, 5000, 0.015, 0.005)
@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Chengye
+"""
+
+import pytest
+
+def test_emptyDateRange(sampleBackTest):
+    with pytest.raises(ValueError, match='2020-01-01'):
+        sampleBackTest.run(True, dateRange=('2020-01-01', None))
+    # the BackTest is still usable after the error
+    dailyPnls, contractTotPnl = sampleBackTest.run(True, dateRange=(None, '2019-08-23'))
+    assert len(dailyPnls) == 3
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Chengye
+"""
+
+import os
+import numpy as np
+import pandas as pd
+from dataCache import ColumnCache
+
+def test_mixedCategories(tmp_path):
+    fileName = os.path.join(tmp_path, 'data.csv')
+    pd.DataFrame({'Date': ['2019-08-21', '2019-08-22', '2019-08-22'],
+                  'Name': ['a', 'b', None],
+                  'Flag': [True, None, False]}).to_csv(fileName, index=False)
+    cache = ColumnCache(fileName, os.path.join(tmp_path, 'cache'), ['Date'], 'Date')
+    data = cache.read()
+    assert list(data['Flag'][[0, 2]]) == [True, False]
+    assert isinstance(data['Flag'][0], (bool, np.bool_))
+    assert list(data['Name'][[0, 1]]) == ['a', 'b']
+    assert data['Name'].isna().tolist() == [False, False, True]
+    assert data['Flag'].isna().tolist() == [False, True, False]
+
+def test_rebuildStaleCache(tmp_path):
+    fileName = os.path.join(tmp_path, 'data.csv')
+    pd.DataFrame({'Date': ['2019-08-21'], 'Value': [1.0]}).to_csv(fileName, index=False)
+    cache = ColumnCache(fileName, os.path.join(tmp_path, 'cache'), ['Date'], 'Date')
+    assert cache.read()['Value'].tolist() == [1.0]
+    pd.DataFrame({'Date': ['2019-08-21', '2019-08-22'],
+                  'Value': [1.0, 2.0]}).to_csv(fileName, index=False)
+    assert not cache.isValid()
+    assert cache.read()['Value'].tolist() == [1.0, 2.0]
+    # a build finishing after an identical one keeps the cache in place
+    cache.build()
+    assert cache.isValid()
+    assert os.listdir(os.path.join(tmp_path, 'cache')) == [os.path.basename(cache.path)]
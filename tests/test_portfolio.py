@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Chengye
+"""
+
+import pytest
+from base import Option
+
+def test_optionDictDeprecated(sampleBackTest):
+    sampleBackTest.run(True)
+    portfolio = sampleBackTest.portfolios[0]
+    with pytest.warns(DeprecationWarning):
+        optionDict = portfolio.optionDict
+    assert optionDict
+    assert set(optionDict) <= set(portfolio.optionPosition)
+    for optionSymbol, option in optionDict.items():
+        assert isinstance(option, Option)
+        assert option.getOptionSymbol() == optionSymbol
+
+def test_stockPositionWrites(sampleBackTest):
+    sampleBackTest.run(True)
+    portfolio = sampleBackTest.portfolios[0]
+    ticker = portfolio.stockList[0]
+    # writes to the returned Series would be lost, so they raise
+    with pytest.raises(ValueError):
+        portfolio.stockPosition[ticker] = 1.0
+    stockPosition = portfolio.stockPosition.copy()
+    stockPosition[ticker] += 100.0
+    portfolio.stockPosition = stockPosition
+    assert portfolio.book.stockPosition[0] == stockPosition[ticker]
+    assert portfolio.stockPosition.equals(stockPosition)
+    with pytest.raises(ValueError):
+        portfolio.stockPosition = stockPosition.iloc[1:]
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Chengye
+"""
+
+import pickle
+import numpy as np
+import pandas as pd
+from sweep import SharedFrame
+
+def test_sharedFrameMissingValues():
+    frame = pd.DataFrame({'symbol': ['A', None, 'B', np.nan, 'A'],
+                          'qty': [1.0, 2.0, 3.0, 4.0, 5.0]})
+    shared = SharedFrame(frame)
+    try:
+        # workers attach to a pickled copy and keep it alive, as in initWorker
+        workerShared = pickle.loads(pickle.dumps(shared))
+        attached = workerShared.attach()
+        assert list(attached['symbol'][[0, 2, 4]]) == ['A', 'B', 'A']
+        assert attached['symbol'][[1, 3]].isna().all()
+        assert np.array_equal(attached['qty'].to_numpy(), frame['qty'].to_numpy())
+    finally:
+        shared.unlink()